@@ -0,0 +1,86 @@
+"""
+Бенчмарки функций разбора фида на синтетическом YML фиде: parse_categories, разбор товаров,
+process_offer, fill_category_levels, post_processing_offer_df.
+
+Запуск из корня проекта:
+python -m benchmarks.bench_functions --offers 20000 --category-depth 5 --params 10 --output functions.json
+"""
+import argparse
+import os
+import tempfile
+
+import pandas as pd
+from lxml import etree
+
+from utils.additional_utils import parse_categories, process_offer, process_offer_fast, fast_json_dumps, \
+    fill_category_levels, category_levels, post_processing_offer_df, offer_in_bigint_range
+from utils.feed_utils import iter_feed_offer_batches, read_feed_header
+from .feed_generator import generate_feed
+from .results import BenchmarkResults, best_of
+
+
+def run_benchmarks(feed_path: str, repeat: int, results: BenchmarkResults) -> None:
+    """Замеряет функции на фиде feed_path, лучшее время из repeat прогонов."""
+    results.add('parse_categories', best_of(lambda: parse_categories(feed_path), repeat))
+
+    offers_total = 0
+
+    def parse_feed() -> None:
+        nonlocal offers_total
+        offers_total = sum(len(batch) for batch in iter_feed_offer_batches(feed_path, 10000))
+
+    results.add('iter_feed_offer_batches', best_of(parse_feed, repeat), offers_total)
+
+    with open(feed_path, 'rb') as feed:
+        category_map = read_feed_header(feed)[1]
+    elements = list(etree.parse(feed_path).iter('offer'))
+
+    for name, function, kwargs in (
+            ('process_offer', process_offer, {}),
+            ('process_offer_fast', process_offer_fast, {}),
+            ('process_offer_fast+fast_json', process_offer_fast, {'json_dumps': fast_json_dumps}),
+    ):
+        seconds = best_of(lambda: [function(offer, category_map, **kwargs) for offer in elements], repeat)
+        results.add(name, seconds, len(elements))
+
+    category_ids = [offer.findtext('categoryId') for offer in elements]
+    results.add('fill_category_levels',
+                best_of(lambda: [fill_category_levels(cat_id, category_map) for cat_id in category_ids], repeat),
+                len(category_ids))
+    results.add('category_levels',
+                best_of(lambda: [category_levels(cat_id, category_map) for cat_id in category_ids], repeat),
+                len(category_ids))
+
+    offers = [process_offer_fast(offer, category_map) for offer in elements]
+    offer_df = pd.DataFrame(offers)
+    results.add('post_processing_offer_df', best_of(lambda: post_processing_offer_df(offer_df), repeat), len(offers))
+    results.add('offer_in_bigint_range',
+                best_of(lambda: [offer for offer in offers if offer_in_bigint_range(offer)], repeat), len(offers))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--feed', help='Готовый фид, по умолчанию генерируется синтетический')
+    parser.add_argument('--offers', type=int, default=20000)
+    parser.add_argument('--categories', type=int, default=500)
+    parser.add_argument('--category-depth', type=int, default=4)
+    parser.add_argument('--params', type=int, default=8)
+    parser.add_argument('--text-words', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='JSON файл результатов для benchmarks.compare')
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key != 'output'}
+    results = BenchmarkResults('functions', params)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feed_path = args.feed or generate_feed(os.path.join(tmp_dir, 'feed.xml'), args.offers, args.categories,
+                                               args.category_depth, args.params, args.text_words)
+        run_benchmarks(feed_path, args.repeat, results)
+
+    if args.output:
+        results.save(args.output)
+
+
+if __name__ == '__main__':
+    main()
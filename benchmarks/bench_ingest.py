@@ -0,0 +1,184 @@
+"""
+Сквозной бенчмарк: загрузка синтетического фида в PostgreSQL и Elasticsearch и пересчет похожих товаров.
+
+Elasticsearch заменяется локальным fake_es. PostgreSQL нужен настоящий, SQLite не подходит: загрузка
+использует COPY, uuid[] и ON CONFLICT. Источник бд выбирается так:
+ - BENCH_POSTGRES_HOST (и BENCH_POSTGRES_PORT, BENCH_POSTGRES_USER, BENCH_POSTGRES_PASSWORD) - на этом сервере
+   создается временная бд sku_bench_<pid>, после прогона удаляется;
+ - иначе initdb и pg_ctl из BENCH_PG_BIN или PATH - запускается временный кластер;
+ - иначе бенчмарк пропускается.
+
+Запуск из корня проекта:
+BENCH_POSTGRES_HOST=127.0.0.1 python -m benchmarks.bench_ingest --offers 20000 --workers 2 --output ingest.json
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Iterator
+
+import psycopg2
+
+from .fake_es import start_fake_es
+from .feed_generator import generate_feed
+from .results import BenchmarkResults, REPO_DIR
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def server_database() -> Iterator[dict]:
+    """Создает временную бд на сервере из BENCH_POSTGRES_*, после прогона удаляет ее."""
+    server = {
+        'host': os.environ['BENCH_POSTGRES_HOST'],
+        'port': os.environ.get('BENCH_POSTGRES_PORT', '5432'),
+        'user': os.environ.get('BENCH_POSTGRES_USER', 'postgres'),
+        'password': os.environ.get('BENCH_POSTGRES_PASSWORD', ''),
+    }
+    name = f'sku_bench_{os.getpid()}'
+    admin = psycopg2.connect(dbname=os.environ.get('BENCH_POSTGRES_DB', 'postgres'), **server)
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cursor:
+            cursor.execute(f'create database {name}')
+        try:
+            yield {**server, 'dbname': name}
+        finally:
+            with admin.cursor() as cursor:
+                cursor.execute(f'drop database if exists {name} with (force)')
+    finally:
+        admin.close()
+
+
+@contextlib.contextmanager
+def temporary_cluster(bin_dir: str) -> Iterator[dict]:
+    """Запускает временный кластер PostgreSQL через initdb и pg_ctl из bin_dir."""
+    with tempfile.TemporaryDirectory(prefix='sku_bench_pg_') as data_dir:
+        port = _free_port()
+        subprocess.run([os.path.join(bin_dir, 'initdb'), '-D', data_dir, '-U', 'postgres', '--auth=trust',
+                        '-E', 'UTF8'], check=True, capture_output=True)
+        pg_ctl = os.path.join(bin_dir, 'pg_ctl')
+        subprocess.run([pg_ctl, '-D', data_dir, '-w', '-l', os.path.join(data_dir, 'server.log'),
+                        '-o', f'-p {port} -h 127.0.0.1 -k {data_dir} -c fsync=off', 'start'],
+                       check=True, capture_output=True)
+        try:
+            yield {'host': '127.0.0.1', 'port': str(port), 'user': 'postgres', 'password': '', 'dbname': 'postgres'}
+        finally:
+            subprocess.run([pg_ctl, '-D', data_dir, '-m', 'immediate', 'stop'], capture_output=True)
+
+
+@contextlib.contextmanager
+def benchmark_database() -> Iterator[dict | None]:
+    """Выдает параметры подключения к пустой временной бд или None, если PostgreSQL недоступен."""
+    if os.environ.get('BENCH_POSTGRES_HOST'):
+        with server_database() as database:
+            yield database
+        return
+
+    initdb = shutil.which('initdb', path=os.environ.get('BENCH_PG_BIN') or os.environ.get('PATH'))
+    if initdb is None:
+        yield None
+        return
+    with temporary_cluster(os.path.dirname(initdb)) as database:
+        yield database
+
+
+def init_schema(database: dict) -> None:
+    """Создает таблицы из initdb.sql."""
+    with open(os.path.join(REPO_DIR, 'initdb.sql'), encoding='utf-8') as sql_file:
+        script = sql_file.read()
+    connection = psycopg2.connect(**database)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute(script)
+    finally:
+        connection.close()
+
+
+def configure_environment(database: dict, es_port: int) -> None:
+    """Передает временные бд и Elasticsearch в config_file через переменные окружения."""
+    os.environ.update({
+        'POSTGRES_HOST': database['host'],
+        'POSTGRES_PORT': str(database['port']),
+        'POSTGRES_USER': database['user'],
+        'POSTGRES_PASSWORD': database['password'],
+        'POSTGRES_DB': database['dbname'],
+        'DB_SCHEMA': 'public',
+        'DB_TABLE': 'sku',
+        'ELASTIC_HOST': '127.0.0.1',
+        'ES_PORT': str(es_port),
+        'ELASTIC_PASSWORD': 'bench',
+    })
+
+
+def record_stages(results: BenchmarkResults, snapshot: dict) -> None:
+    """Добавляет суммарное время стадий из метрик прогона."""
+    for name, histogram in sorted(snapshot['histograms'].items()):
+        if name.endswith('_seconds'):
+            stage = name[:-len('_seconds')]
+            results.add(f'stage.{stage}', histogram['sum'], snapshot['counters'].get(f'{stage}_items'),
+                        calls=histogram['count'])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offers', type=int, default=20000)
+    parser.add_argument('--categories', type=int, default=500)
+    parser.add_argument('--category-depth', type=int, default=4)
+    parser.add_argument('--params', type=int, default=8)
+    parser.add_argument('--text-words', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--similarity-backend', choices=('elastic', 'tfidf'), default='elastic')
+    parser.add_argument('--output', help='JSON файл результатов для benchmarks.compare')
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key != 'output'}
+    results = BenchmarkResults('ingest', params)
+
+    with tempfile.TemporaryDirectory() as tmp_dir, benchmark_database() as database:
+        if database is None:
+            print('->PostgreSQL недоступен: задайте BENCH_POSTGRES_HOST или BENCH_PG_BIN, бенчмарк пропущен <-')
+            return
+
+        feed_path = generate_feed(os.path.join(tmp_dir, 'feed.xml'), args.offers, args.categories,
+                                  args.category_depth, args.params, args.text_words)
+        init_schema(database)
+        es_server, es_store = start_fake_es()
+        configure_environment(database, es_server.server_address[1])
+
+        # config_file читает окружение при импорте, поэтому main импортируется после настройки
+        sys.path.insert(0, REPO_DIR)
+        main_module = importlib.import_module('main')
+        from utils.metrics import metrics
+        metrics.reset()
+
+        log = io.StringIO()
+        started = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(log):
+                main_module.match_elastic_offer(feed_path, args.batch_size, args.workers,
+                                                similarity_backend=args.similarity_backend)
+        finally:
+            es_server.shutdown()
+        results.add('ingest_total', time.perf_counter() - started, args.offers,
+                    es_requests=len(es_store.requests))
+        record_stages(results, metrics.snapshot())
+
+    if args.output:
+        results.save(args.output)
+
+
+if __name__ == '__main__':
+    main()
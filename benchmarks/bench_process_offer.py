@@ -0,0 +1,87 @@
+"""
+Микро-бенчмарк process_offer_fast против process_offer.
+
+Запуск из корня проекта: python -m benchmarks.bench_process_offer --offers 20000 --params 15
+"""
+import argparse
+import random
+import time
+
+from lxml import etree
+
+from utils.additional_utils import process_offer, process_offer_fast, fast_json_dumps, assign_levels, \
+    build_category_index
+
+
+def build_offers(offers: int, params: int, categories: int = 200, seed: int = 1) -> tuple:
+    """Строит XML-элементы товаров и словарь категорий в памяти."""
+    rnd = random.Random(seed)
+    category_map = {
+        str(cat_id): {
+            'name': f'Категория {cat_id}',
+            'parentId': str(rnd.randint(1, cat_id - 1)) if cat_id > 1 else None,
+            'level': None,
+            'categoryId': str(cat_id),
+        }
+        for cat_id in range(1, categories + 1)
+    }
+    assign_levels(category_map)
+    build_category_index(category_map)
+
+    elements = []
+    for offer_id in range(1, offers + 1):
+        offer = etree.Element('offer', id=str(offer_id))
+        for tag, value in (
+                ('name', f'Товар {offer_id}'), ('description', 'Описание товара ' * 5),
+                ('price', str(rnd.randint(100, 1000))), ('oldprice', str(rnd.randint(1000, 2000))),
+                ('categoryId', str(rnd.randint(1, categories))), ('vendor', 'Бренд'), ('group_id', '1'),
+                ('seller_id', '7'), ('seller_name', 'Продавец'), ('picture', f'https://img/{offer_id}.jpg'),
+                ('currencyId', 'RUR'), ('barcode', str(rnd.randint(1, 10 ** 12))), ('rating_count', '3'),
+                ('rating_value', '4.5'), ('bonuses', '10'), ('sales', '2'),
+        ):
+            etree.SubElement(offer, tag).text = value
+        for param_no in range(params):
+            etree.SubElement(offer, 'param', name=f'Параметр {param_no}').text = str(rnd.randint(0, 100))
+        elements.append(offer)
+    return elements, category_map
+
+
+def measure(function, elements: list, category_map: dict, repeat: int, **kwargs) -> float:
+    """Возвращает лучшее время обработки всех элементов из repeat прогонов, сек."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for offer in elements:
+            function(offer, category_map, **kwargs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--offers', type=int, default=20000)
+    parser.add_argument('--params', type=int, default=15)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    elements, category_map = build_offers(args.offers, args.params)
+
+    for offer in elements:
+        expected = process_offer(offer, category_map)
+        actual = process_offer_fast(offer, category_map)
+        expected.pop('uuid')
+        actual.pop('uuid')
+        assert actual == expected, f'Результат process_offer_fast расходится для товара {offer.get("id")}'
+
+    baseline = measure(process_offer, elements, category_map, args.repeat)
+    fast = measure(process_offer_fast, elements, category_map, args.repeat)
+    fast_json = measure(process_offer_fast, elements, category_map, args.repeat, json_dumps=fast_json_dumps)
+
+    print(f'offers={args.offers} params={args.params}')
+    for name, seconds in (('process_offer', baseline), ('process_offer_fast', fast),
+                          ('process_offer_fast+fast_json', fast_json)):
+        print(f'{name:<30} {seconds:8.3f} s {args.offers / seconds:12.0f} offers/s x{baseline / seconds:.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Проверка параллельного парсинга: товары и их кол-во совпадают с последовательным парсингом фида.
+
+В синтетический фид добавляются случаи, на которых ошибается поиск концов товаров по тексту:
+'</offer>' внутри CDATA описания и внутри комментария, товары без содержимого <offer .../>,
+в том числе с '>' в значении атрибута. Фид разбирается при разных размерах фрагментов и точках продолжения.
+
+Запуск из корня проекта:
+python -m benchmarks.check_feed_fragments --offers 3000
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+from .feed_generator import generate_feed
+from .results import REPO_DIR
+
+DESCRIPTION_RE = re.compile(rb'<description>.*?</description>', re.S)
+
+
+def add_edge_cases(path: str, offers: int) -> list:
+    """
+    Дописывает в фид граничные случаи.
+
+    :return: Номера товаров, рядом с которыми стоят граничные случаи, для выбора точек продолжения.
+    """
+    with open(path, 'rb') as feed_file:
+        data = feed_file.read()
+
+    cdata_offer, comment_offer, empty_offer = offers // 2, offers * 2 // 3, offers // 4
+    descriptions = list(DESCRIPTION_RE.finditer(data))
+    match = descriptions[cdata_offer]
+    data = (data[:match.start()] + b'<description><![CDATA[text </offer> <!-- x --> ]]></description>'
+            + data[match.end():])
+
+    position = data.index(f'<offer id="{comment_offer + 1}"'.encode())
+    data = data[:position] + b'<!-- removed </offer> -->' + data[position:]
+    position = data.index(f'<offer id="{empty_offer + 1}"'.encode())
+    data = (data[:position] + b'<offer id="900001" available="true"/>\n<offer id="900002" note="a>b" />'
+            + data[position:])
+
+    with open(path, 'wb') as feed_file:
+        feed_file.write(data)
+    return [cdata_offer, comment_offer + 1, empty_offer, empty_offer + 1, empty_offer + 2]
+
+
+def read_offers(batches) -> tuple:
+    uuids = []
+    parsed = 0
+    for batch in batches:
+        uuids.extend(batch['uuid'])
+        parsed += batch.parsed
+    return uuids, parsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offers', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIR)
+    from utils.feed_utils import iter_feed_offer_batches, iter_offer_batches_parallel
+
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        feed_path = generate_feed(os.path.join(tmp_dir, 'feed.xml'), args.offers, 100, 3, 4, 20)
+        edge_offers = add_edge_cases(feed_path, args.offers)
+        serial_uuids, serial_parsed = read_offers(iter_feed_offer_batches(feed_path, args.batch_size))
+
+        skips = sorted({0, *edge_offers, *(offer - 1 for offer in edge_offers), serial_parsed - 1})
+        for fragment_size in (1, 1000, 50000):
+            for skip in skips:
+                try:
+                    uuids, parsed = read_offers(iter_offer_batches_parallel(
+                        feed_path, args.batch_size, args.workers, fragment_size=fragment_size, skip_offers=skip))
+                    ok = uuids == serial_uuids[skip:] and parsed == serial_parsed - skip
+                    result = f'{len(uuids)} товаров'
+                except Exception as e:
+                    ok = False
+                    result = f'{type(e).__name__}: {e}'
+                if not ok:
+                    failed += 1
+                    print(f'фрагмент {fragment_size} байт, пропуск {skip}: расхождение, {result}')
+
+    print(f'Последовательно разобрано {serial_parsed} товаров, расхождений: {failed}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
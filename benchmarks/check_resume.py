@@ -0,0 +1,213 @@
+"""
+Проверка продолжения загрузки после сбоя, когда бд обогнала Elasticsearch.
+
+Получатель Elasticsearch ждет, пока бд загрузит еще queue_size пачек, и падает. Затем загрузка продолжается
+с сохраненной точки, для второго продолжения сбой повторяется. После последнего продолжения в индексе должны быть
+документы всех товаров бд. Проверяются полная и дельта-загрузка. Бд и Elasticsearch - как в bench_ingest.
+
+Отдельно проверяется отказ Elasticsearch в отдельном документе пачки: загрузка должна остановиться, не сдвинув
+точку продолжения за отклоненный товар, а продолжение - догрузить его в индекс.
+
+Запуск из корня проекта:
+BENCH_POSTGRES_HOST=127.0.0.1 python -m benchmarks.check_resume --offers 3000 --batch-size 200
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import psycopg2
+from elasticsearch import helpers
+
+from .bench_ingest import benchmark_database, init_schema, configure_environment
+from .fake_es import start_fake_es
+from .feed_generator import generate_feed
+from .results import REPO_DIR
+
+
+class ElasticSinkFailure(RuntimeError):
+    pass
+
+
+def count_rows(database: dict) -> int:
+    connection = psycopg2.connect(**database)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('select count(*) from sku')
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def fail_after_postgres_ahead(updater, database: dict, es_batches: int, rows_ahead: int,
+                              timeout: float = 30) -> None:
+    """
+    Подменяет загрузку в Elasticsearch: после es_batches пачек ждет, пока в бд станет rows_ahead строк, и падает.
+    """
+    load = updater.load_data_to_elasticsearch
+    loaded = 0
+
+    def load_then_fail(batch_data) -> None:
+        nonlocal loaded
+        if loaded < es_batches:
+            loaded += 1
+            return load(batch_data)
+        deadline = time.monotonic() + timeout
+        while count_rows(database) < rows_ahead and time.monotonic() < deadline:
+            time.sleep(0.05)
+        raise ElasticSinkFailure('сбой загрузки в Elasticsearch')
+
+    updater.load_data_to_elasticsearch = load_then_fail
+
+
+def reject_after(updater, es_store, es_batches: int) -> None:
+    """Подменяет загрузку в Elasticsearch: после es_batches пачек первый документ следующей пачки отклоняется."""
+    load = updater.load_data_to_elasticsearch
+    loaded = 0
+
+    def load_then_reject(batch_data) -> None:
+        nonlocal loaded
+        if loaded == es_batches:
+            es_store.reject_documents = 1
+        loaded += 1
+        return load(batch_data)
+
+    updater.load_data_to_elasticsearch = load_then_reject
+
+
+def read_checkpoint(database: dict) -> int:
+    connection = psycopg2.connect(**database)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('select offers_done from sku_ingest_checkpoint')
+            return cursor.fetchone()[0]
+    finally:
+        connection.close()
+
+
+def index_matches_db(database: dict, es_store, mode: str, offers: int) -> bool:
+    """Сравнивает uuid товаров бд и документов индекса."""
+    connection = psycopg2.connect(**database)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('select uuid::text from sku')
+            db_uuids = {row[0] for row in cursor}
+    finally:
+        connection.close()
+    index_uuids = set(es_store.get_index('offer_index').docs)
+    missing = db_uuids - index_uuids
+    orphans = index_uuids - db_uuids
+    print(f'{mode}: в бд {len(db_uuids)} товаров, в индексе {len(index_uuids)}, '
+          f'нет в индексе {len(missing)}, лишних в индексе {len(orphans)}')
+    return len(db_uuids) == offers and not missing and not orphans
+
+
+def reset_state(database: dict, es_store) -> None:
+    connection = psycopg2.connect(**database)
+    try:
+        with connection, connection.cursor() as cursor:
+            cursor.execute('truncate sku')
+            cursor.execute('drop table if exists sku_ingest_checkpoint')
+    finally:
+        connection.close()
+    es_store.indices.pop('offer_index', None)
+
+
+def check_mode(main_module, database: dict, es_store, feed_path: str, args, delta: bool) -> bool:
+    """Загружает фид со сбоями и продолжениями, возвращает True, если индекс совпал с бд."""
+    reset_state(database, es_store)
+    mode = 'дельта' if delta else 'полная'
+    queue_size = 2
+    for attempt in range(args.crashes + 1):
+        updater = main_module.create_elastic_updater()
+        updater.create_index()
+        crash = attempt < args.crashes
+        if crash:
+            rows_ahead = count_rows(database) + (args.es_batches + queue_size) * args.batch_size
+            fail_after_postgres_ahead(updater, database, args.es_batches, rows_ahead)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main_module.load_offers(feed_path, updater, args.batch_size, queue_size=queue_size, delta=delta,
+                                        resume=attempt > 0)
+        except ElasticSinkFailure:
+            print(f'{mode}: сбой {attempt + 1}, в бд {count_rows(database)} товаров, '
+                  f'в индексе {len(es_store.get_index("offer_index").docs)}')
+        finally:
+            updater.close()
+        if not crash:
+            break
+
+    return index_matches_db(database, es_store, mode, args.offers)
+
+
+def check_rejected(main_module, database: dict, es_store, feed_path: str, args) -> bool:
+    """
+    Загружает фид, пока Elasticsearch не отклонит документ, и продолжает загрузку.
+    Возвращает True, если загрузка остановилась, точка не ушла за отклоненный товар и после продолжения
+    индекс совпал с бд.
+    """
+    reset_state(database, es_store)
+    mode = 'отказ в документе'
+    # Отклоняется первый товар пачки es_batches, точка продолжения не должна уйти дальше него
+    rejected_offer = args.es_batches * args.batch_size
+    stopped = False
+    for attempt in range(2):
+        updater = main_module.create_elastic_updater()
+        updater.create_index()
+        if attempt == 0:
+            reject_after(updater, es_store, args.es_batches)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                main_module.load_offers(feed_path, updater, args.batch_size, queue_size=2, resume=attempt > 0)
+        except helpers.BulkIndexError:
+            stopped = True
+        finally:
+            updater.close()
+
+        if attempt == 0:
+            offers_done = read_checkpoint(database)
+            print(f'{mode}: загрузка остановлена {stopped}, точка продолжения {offers_done}, '
+                  f'отклонен товар {rejected_offer}')
+            if not stopped or offers_done > rejected_offer:
+                return False
+
+    return index_matches_db(database, es_store, mode, args.offers)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--offers', type=int, default=3000)
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--es-batches', type=int, default=2, help='Сколько пачек загрузить в индекс до сбоя')
+    parser.add_argument('--crashes', type=int, default=2, help='Сколько раз подряд загрузка падает')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, benchmark_database() as database:
+        if database is None:
+            print('->PostgreSQL недоступен: задайте BENCH_POSTGRES_HOST или BENCH_PG_BIN, проверка пропущена <-')
+            return
+
+        feed_path = generate_feed(os.path.join(tmp_dir, 'feed.xml'), args.offers, 100, 3, 4, 20)
+        init_schema(database)
+        es_server, es_store = start_fake_es()
+        configure_environment(database, es_server.server_address[1])
+        os.environ['BATCH_ADAPTIVE'] = '0'
+
+        sys.path.insert(0, REPO_DIR)
+        main_module = importlib.import_module('main')
+        try:
+            results = [check_mode(main_module, database, es_store, feed_path, args, delta) for delta in (False, True)]
+            results.append(check_rejected(main_module, database, es_store, feed_path, args))
+        finally:
+            es_server.shutdown()
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
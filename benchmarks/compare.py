@@ -0,0 +1,64 @@
+"""
+Сравнение двух файлов результатов бенчмарков, например до и после коммита.
+
+Запуск из корня проекта:
+python -m benchmarks.compare base.json new.json --threshold 0.1 --fail
+"""
+import argparse
+import sys
+
+from .results import load_results
+
+
+def compare_results(base: dict, new: dict, threshold: float = 0.1) -> list:
+    """
+    Сравнивает время бенчмарков, присутствующих в обоих файлах.
+
+    :param base: Базовые результаты.
+    :param new: Новые результаты.
+    :param threshold: Доля замедления, начиная с которой бенчмарк считается регрессией.
+    :return: Список (имя, время base, время new, отношение new / base, регрессия ли).
+    """
+    rows = []
+    for name, base_result in base['results'].items():
+        new_result = new['results'].get(name)
+        if new_result is None or not base_result['seconds']:
+            continue
+        ratio = new_result['seconds'] / base_result['seconds']
+        rows.append((name, base_result['seconds'], new_result['seconds'], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Допустимое замедление, доля')
+    parser.add_argument('--fail', action='store_true', help='Код возврата 1 при регрессии')
+    args = parser.parse_args()
+
+    base, new = load_results(args.base), load_results(args.new)
+    for label, results in (('base', base), ('new', new)):
+        dirty = ' (есть незакоммиченные изменения)' if results.get('dirty') else ''
+        print(f'{label}: {results.get("commit")}{dirty} {results.get("created_at")}')
+    if base.get('params') != new.get('params'):
+        print('->Параметры запусков различаются, сравнение может быть некорректным <-')
+
+    rows = compare_results(base, new, args.threshold)
+    for name, base_seconds, new_seconds, ratio, regression in rows:
+        mark = ' РЕГРЕССИЯ' if regression else ''
+        print(f'{name:<40} {base_seconds:10.4f} s {new_seconds:10.4f} s x{ratio:6.2f}{mark}')
+
+    only_base = sorted(set(base['results']) - set(new['results']))
+    only_new = sorted(set(new['results']) - set(base['results']))
+    if only_base:
+        print(f'Только в base: {", ".join(only_base)}')
+    if only_new:
+        print(f'Только в new: {", ".join(only_new)}')
+
+    if args.fail and any(row[4] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Локальная замена Elasticsearch для бенчмарков: HTTP сервер с подмножеством API, которое использует
+SimilarProductsESUpdater (индексы, маппинг, настройки, _bulk, _search и _msearch с more_like_this
+и фильтрами term, _mget).
+
+more_like_this упрощен: берутся max_query_terms самых редких слов товара, вес совпадения - idf слова.
+Релевантность не повторяет Elasticsearch, сервер нужен для замера накладных расходов клиента и сети.
+"""
+import heapq
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+TOKEN_RE = re.compile(r'\w+')
+TEXT_FIELDS = ('title', 'description')
+
+
+class FakeIndex:
+    """Документы индекса и обратный индекс слов для more_like_this."""
+
+    def __init__(self, settings: dict = None, mappings: dict = None):
+        self.settings = dict(settings or {})
+        self.mappings = mappings or {}
+        self.docs = {}
+        self.tokens = {}
+        self.postings = defaultdict(set)
+
+    def index(self, doc_id: str, source: dict) -> None:
+        self.delete(doc_id)
+        tokens = set(TOKEN_RE.findall(' '.join(str(source.get(field) or '') for field in TEXT_FIELDS).lower()))
+        self.docs[doc_id] = source
+        self.tokens[doc_id] = tokens
+        for token in tokens:
+            self.postings[token].add(doc_id)
+
+    def delete(self, doc_id: str) -> bool:
+        if doc_id not in self.docs:
+            return False
+        for token in self.tokens.pop(doc_id):
+            self.postings[token].discard(doc_id)
+        del self.docs[doc_id]
+        return True
+
+    def matches(self, source: dict, filters: list) -> bool:
+        for condition in filters:
+            (field, value), = condition['term'].items()
+            if isinstance(value, dict):
+                value = value['value']
+            if source.get(field) != value:
+                return False
+        return True
+
+    def search(self, body: dict) -> dict:
+        size = body.get('size', 10)
+        query = body.get('query', {})
+        filters = []
+        if 'bool' in query:
+            filters = query['bool'].get('filter', [])
+            if isinstance(filters, dict):
+                filters = [filters]
+            must = query['bool'].get('must', {})
+            query = must[0] if isinstance(must, list) else must
+
+        mlt = query.get('more_like_this')
+        if mlt is None:
+            hits = [doc_id for doc_id, source in self.docs.items() if self.matches(source, filters)][:size]
+            return self._response(hits, {})
+
+        like_id = mlt['like'][0]['_id']
+        if like_id not in self.tokens:
+            return self._response([], {})
+
+        total = len(self.docs)
+        terms = sorted(self.tokens[like_id], key=lambda token: (len(self.postings[token]), token))
+        scores = Counter()
+        for token in terms[:mlt.get('max_query_terms', 25)]:
+            idf = math.log(1 + total / len(self.postings[token]))
+            for doc_id in self.postings[token]:
+                scores[doc_id] += idf
+        scores.pop(like_id, None)
+
+        candidates = ((-score, doc_id) for doc_id, score in scores.items()
+                      if not filters or self.matches(self.docs[doc_id], filters))
+        hits = [doc_id for score, doc_id in heapq.nsmallest(size, candidates)]
+        return self._response(hits, scores)
+
+    def _response(self, hits: list, scores: dict) -> dict:
+        return {'took': 1, 'timed_out': False,
+                'hits': {'total': {'value': len(hits), 'relation': 'eq'},
+                         'hits': [{'_id': doc_id, '_score': scores.get(doc_id, 1.0), '_source': self.docs[doc_id]}
+                                  for doc_id in hits]}}
+
+
+class FakeStore:
+    """
+    Состояние сервера: индексы, журнал запросов, кол-во _bulk запросов, на которые вернуть 429,
+    и кол-во следующих документов _bulk, которые отклонить с ошибкой 400 в ответе на документ.
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self.lock = threading.Lock()
+        self.requests = []
+        self.fail_bulk = 0
+        self.reject_documents = 0
+
+    def get_index(self, name: str) -> FakeIndex:
+        index = self.indices.get(name)
+        if index is None:
+            index = self.indices[name] = FakeIndex()
+        return index
+
+
+class FakeESHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    store: FakeStore = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        name = urlparse(self.path).path.strip('/')
+        self._send(200 if name in self.store.indices else 404)
+
+    def do_GET(self) -> None:
+        self._route()
+
+    def do_PUT(self) -> None:
+        self._route()
+
+    def do_POST(self) -> None:
+        self._route()
+
+    def do_DELETE(self) -> None:
+        self._route()
+
+    def _send(self, status: int, body: dict = None) -> None:
+        data = b'' if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _route(self) -> None:
+        path = urlparse(self.path).path
+        parts = [part for part in path.split('/') if part]
+        raw = self._read_body()
+        store = self.store
+        endpoint = parts[-1] if parts else ''
+
+        with store.lock:
+            store.requests.append((self.command, path, len(raw)))
+
+            if endpoint == '_bulk':
+                if store.fail_bulk > 0:
+                    store.fail_bulk -= 1
+                    return self._send(429, {'error': {'type': 'es_rejected_execution_exception'}, 'status': 429})
+                return self._send(200, self._bulk(parts, raw))
+
+            if endpoint == '_msearch':
+                lines = [json.loads(line) for line in raw.splitlines() if line.strip()]
+                responses = [store.get_index(header.get('index') or parts[0]).search(body)
+                             for header, body in zip(lines[::2], lines[1::2])]
+                return self._send(200, {'took': 1, 'responses': responses})
+
+            if endpoint == '_search' and len(parts) == 2:
+                return self._send(200, store.get_index(parts[0]).search(json.loads(raw or b'{}')))
+
+            if endpoint == '_mget' and len(parts) == 2:
+                docs = store.get_index(parts[0]).docs
+                body = json.loads(raw)
+                ids = body.get('ids') or [doc['_id'] for doc in body.get('docs', [])]
+                return self._send(200, {'docs': [
+                    {'_index': parts[0], '_id': doc_id, 'found': doc_id in docs, '_source': docs.get(doc_id)}
+                    for doc_id in ids
+                ]})
+
+            if endpoint == '_mapping' and len(parts) == 2:
+                index = store.get_index(parts[0])
+                if self.command == 'PUT':
+                    body = json.loads(raw)
+                    index.mappings.setdefault('properties', {}).update(body.get('properties', {}))
+                    if '_meta' in body:
+                        index.mappings['_meta'] = body['_meta']
+                    return self._send(200, {'acknowledged': True})
+                return self._send(200, {parts[0]: {'mappings': index.mappings}})
+
+            if endpoint == '_settings' and len(parts) == 2:
+                index = store.get_index(parts[0])
+                if self.command == 'PUT':
+                    body = json.loads(raw)
+                    index.settings.update(body.get('index', body))
+                    return self._send(200, {'acknowledged': True})
+                return self._send(200, {parts[0]: {'settings': {'index': index.settings}}})
+
+            if endpoint in ('_refresh', '_forcemerge') and len(parts) == 2:
+                return self._send(200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}})
+
+            if len(parts) == 1 and self.command == 'PUT':
+                body = json.loads(raw or b'{}')
+                store.indices[parts[0]] = FakeIndex(body.get('settings', {}).get('index', body.get('settings')),
+                                                    body.get('mappings'))
+                return self._send(200, {'acknowledged': True, 'index': parts[0]})
+
+            if len(parts) == 1 and self.command == 'DELETE':
+                store.indices.pop(parts[0], None)
+                return self._send(200, {'acknowledged': True})
+
+            if len(parts) == 3 and parts[1] == '_doc' and self.command == 'DELETE':
+                found = parts[0] in store.indices and store.indices[parts[0]].delete(parts[2])
+                return self._send(200 if found else 404, {'result': 'deleted' if found else 'not_found'})
+
+            if not parts:
+                return self._send(200, {'version': {'number': '8.15.2'}, 'tagline': 'You Know, for Search'})
+
+        return self._send(404, {'error': f'unsupported {self.command} {path}'})
+
+    def _bulk(self, parts: list, raw: bytes) -> dict:
+        lines = [json.loads(line) for line in raw.splitlines() if line.strip()]
+        items = []
+        errors = False
+        position = 0
+        while position < len(lines):
+            (operation, meta), = lines[position].items()
+            index_name = meta.get('_index') or parts[0]
+            index = self.store.get_index(index_name)
+            item = {'_index': index_name, '_id': meta['_id'], 'status': 200}
+            if operation == 'delete':
+                index.delete(meta['_id'])
+                position += 1
+            elif self.store.reject_documents > 0:
+                self.store.reject_documents -= 1
+                errors = True
+                item.update(status=400, error={'type': 'mapper_parsing_exception', 'reason': 'rejected by fake_es'})
+                position += 2
+            else:
+                index.index(meta['_id'], lines[position + 1])
+                position += 2
+            items.append({operation: item})
+        return {'took': 1, 'errors': errors, 'items': items}
+
+
+def start_fake_es(port: int = 0) -> tuple:
+    """
+    Запускает сервер в фоновом потоке.
+
+    :param port: Порт, 0 - любой свободный.
+    :return: (сервер, состояние), порт - server.server_address[1], остановка - server.shutdown().
+    """
+    store = FakeStore()
+    handler = type('BoundFakeESHandler', (FakeESHandler, ), {'store': store})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-es', daemon=True).start()
+    return server, store
@@ -0,0 +1,132 @@
+"""
+Генератор синтетических YML фидов для бенчмарков.
+
+Запуск из корня проекта:
+python -m benchmarks.feed_generator feed.xml --offers 100000 --category-depth 5 --params 10 --text-words 40
+"""
+import argparse
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+SYLLABLES = ('ка', 'ро', 'ми', 'те', 'ло', 'на', 'ви', 'се', 'пу', 'да', 'ру', 'бо', 'ле', 'зи', 'то', 'мо')
+PRODUCT_WORDS = ('телефон', 'чехол', 'кабель', 'зарядка', 'ноутбук', 'мышь', 'клавиатура', 'экран', 'стекло',
+                 'наушники', 'колонка', 'пульт', 'аккумулятор', 'планшет', 'часы', 'камера')
+
+
+def build_vocabulary(size: int, rnd: random.Random) -> list:
+    """Строит словарь псевдослов из слогов, чтобы тексты товаров были разнообразны, но пересекались."""
+    words = set(PRODUCT_WORDS)
+    while len(words) < size:
+        words.add(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+
+def build_categories(categories: int, depth: int, rnd: random.Random) -> list:
+    """
+    Строит дерево категорий заданной глубины.
+
+    :return: Список (id, parent_id или None, имя).
+    """
+    by_level = {level: [] for level in range(1, depth + 1)}
+    result = []
+    for category_id in range(1, categories + 1):
+        level = 1 + (category_id - 1) % depth
+        parents = by_level.get(level - 1)
+        parent_id = rnd.choice(parents) if parents else None
+        if parent_id is None:
+            level = 1
+        by_level[level].append(category_id)
+        result.append((category_id, parent_id, f'Категория {level} уровня {category_id}'))
+    return result
+
+
+def generate_feed(path: str,
+                  offers: int = 10000,
+                  categories: int = 500,
+                  category_depth: int = 4,
+                  params: int = 8,
+                  text_words: int = 30,
+                  families: int = None,
+                  vocabulary_size: int = 5000,
+                  seed: int = 1,
+                  encoding: str = 'utf-8') -> str:
+    """
+    Пишет синтетический YML фид.
+
+    Товары объединены в семейства с общей основой названия, поэтому у каждого товара есть похожие.
+
+    :param path: Путь к файлу.
+    :param offers: Кол-во товаров.
+    :param categories: Кол-во категорий.
+    :param category_depth: Глубина дерева категорий.
+    :param params: Кол-во <param> у товара.
+    :param text_words: Кол-во слов в описании товара.
+    :param families: Кол-во семейств похожих товаров, по умолчанию offers // 10.
+    :param vocabulary_size: Размер словаря псевдослов.
+    :param seed: Зерно генератора, одинаковые параметры дают одинаковый фид.
+    :param encoding: Кодировка файла.
+    :return: Путь к файлу.
+    """
+    rnd = random.Random(seed)
+    vocabulary = build_vocabulary(vocabulary_size, rnd)
+    category_tree = build_categories(categories, category_depth, rnd)
+    families = families or max(1, offers // 10)
+    family_words = [rnd.sample(vocabulary, 4) for _ in range(families)]
+
+    with open(path, 'w', encoding=encoding, newline='\n') as feed:
+        feed.write(f'<?xml version="1.0" encoding="{encoding}"?>\n')
+        feed.write('<yml_catalog date="2024-09-24 09:16"><shop><name>Бенчмарк</name><categories>\n')
+        for category_id, parent_id, name in category_tree:
+            parent = f' parentId="{parent_id}"' if parent_id else ''
+            feed.write(f'<category id="{category_id}"{parent}>{escape(name)}</category>\n')
+        feed.write('</categories>\n<offers>\n')
+
+        for offer_id in range(1, offers + 1):
+            family = rnd.randrange(families)
+            title = ' '.join(family_words[family] + rnd.sample(vocabulary, 2))
+            description = ' '.join(rnd.choice(family_words[family]) if rnd.random() < 0.3 else rnd.choice(vocabulary)
+                                   for _ in range(text_words))
+            old_price = rnd.choice((0, rnd.randint(1000, 5000)))
+            parts = [
+                f'<offer id="{offer_id}" available="true">',
+                f'<name>{escape(title)}</name>',
+                f'<description><![CDATA[{description}]]></description>',
+                f'<price>{rnd.randint(100, 999)}</price>',
+                f'<oldprice>{old_price}</oldprice>' if old_price else '',
+                f'<categoryId>{rnd.randint(1, categories)}</categoryId>',
+                f'<vendor>Бренд {family % 50}</vendor>',
+                f'<group_id>{rnd.randint(1, 3)}</group_id>',
+                f'<seller_id>{rnd.randint(1, 1000)}</seller_id><seller_name>Продавец</seller_name>',
+                f'<picture>https://img.example/{offer_id}.jpg</picture>',
+                '<currencyId>RUR</currencyId>',
+                f'<barcode>{rnd.randint(1, 10 ** 13)}</barcode>',
+                f'<rating_count>{rnd.randint(0, 500)}</rating_count><rating_value>{rnd.randint(10, 50) / 10}</rating_value>',
+                f'<bonuses>{rnd.randint(0, 100)}</bonuses><sales>{rnd.randint(0, 1000)}</sales>',
+            ]
+            parts.extend(f'<param name={quoteattr(f"Параметр {param_no}")}>{rnd.choice(vocabulary)}</param>'
+                         for param_no in range(params))
+            parts.append('</offer>\n')
+            feed.write(''.join(parts))
+
+        feed.write('</offers></shop></yml_catalog>\n')
+    return path
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path')
+    parser.add_argument('--offers', type=int, default=10000)
+    parser.add_argument('--categories', type=int, default=500)
+    parser.add_argument('--category-depth', type=int, default=4)
+    parser.add_argument('--params', type=int, default=8)
+    parser.add_argument('--text-words', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--encoding', default='utf-8')
+    args = parser.parse_args()
+
+    generate_feed(args.path, args.offers, args.categories, args.category_depth, args.params, args.text_words,
+                  seed=args.seed, encoding=args.encoding)
+
+
+if __name__ == '__main__':
+    main()
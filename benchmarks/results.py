@@ -0,0 +1,90 @@
+"""
+Формат результатов бенчмарков, сравнимый между коммитами.
+
+Файл - JSON объект:
+{"suite": ..., "commit": ..., "dirty": ..., "created_at": ..., "python": ..., "platform": ..., "params": {...},
+ "results": {"<имя>": {"seconds": ..., "items": ..., "items_per_s": ...}}}
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime, timezone
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def git_revision() -> tuple:
+    """Возвращает (хэш HEAD или None, есть ли незакоммиченные изменения в отслеживаемых файлах)."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def best_of(function, repeat: int = 3) -> float:
+    """Возвращает лучшее время вызова function() из repeat прогонов, сек."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+class BenchmarkResults:
+    """Накопитель результатов одного запуска бенчмарков."""
+
+    def __init__(self, suite: str, params: dict):
+        self.suite = suite
+        self.params = params
+        self.results = {}
+
+    def add(self, name: str, seconds: float, items: int = None, **extra) -> None:
+        """
+        Добавляет результат и выводит его строкой.
+
+        :param name: Имя бенчмарка, ключ для сравнения между коммитами.
+        :param seconds: Время, сек.
+        :param items: Кол-во обработанных записей, по нему считается items_per_s.
+        :param extra: Дополнительные значения, сохраняются как есть.
+        """
+        result = {'seconds': round(seconds, 6)}
+        if items is not None:
+            result['items'] = items
+            result['items_per_s'] = round(items / seconds, 1) if seconds else None
+        result.update(extra)
+        self.results[name] = result
+
+        rate = f'{result["items_per_s"]:14.0f} items/s' if items is not None and seconds else ''
+        print(f'{name:<40} {seconds:10.4f} s {rate}')
+
+    def to_dict(self) -> dict:
+        commit, dirty = git_revision()
+        return {
+            'suite': self.suite,
+            'commit': commit,
+            'dirty': dirty,
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': self.params,
+            'results': self.results,
+        }
+
+    def save(self, path: str) -> None:
+        """Сохраняет результаты в JSON файл."""
+        with open(path, 'w', encoding='utf-8') as output:
+            json.dump(self.to_dict(), output, ensure_ascii=False, indent=2)
+        print(f'->Результаты сохранены в {path} <-')
+
+
+def load_results(path: str) -> dict:
+    """Загружает результаты из JSON файла."""
+    with open(path, encoding='utf-8') as results_file:
+        return json.load(results_file)
@@ -6,15 +6,57 @@ from dotenv import load_dotenv
 ELASTIC_HOST = os.environ.get('ELASTIC_HOST')
 ELASTIC_PORT = os.environ.get('ES_PORT')
 ELASTIC_PASSWORD = os.environ.get('ELASTIC_PASSWORD')
+# Параметры bulk загрузки в Elasticsearch, ELASTIC_BULK_THREADS - максимум одновременных bulk запросов
+ELASTIC_BULK_THREADS = int(os.environ.get('ELASTIC_BULK_THREADS', 4))
+ELASTIC_BULK_CHUNK_SIZE = int(os.environ.get('ELASTIC_BULK_CHUNK_SIZE', 500))
+ELASTIC_BULK_MAX_CHUNK_BYTES = int(os.environ.get('ELASTIC_BULK_MAX_CHUNK_BYTES', 10 << 20))
+ELASTIC_BULK_MAX_RETRIES = int(os.environ.get('ELASTIC_BULK_MAX_RETRIES', 5))
+# Желаемая длительность одного bulk запроса при подстройке размера, сек.
+ELASTIC_BULK_TARGET_SECONDS = float(os.environ.get('ELASTIC_BULK_TARGET_SECONDS', 1))
+# Максимум одновременных _msearch запросов поиска похожих товаров
+ELASTIC_SEARCH_CONCURRENCY = int(os.environ.get('ELASTIC_SEARCH_CONCURRENCY', 4))
+# Поиск похожих товаров в пределах категории товара: при нехватке результатов область расширяется
+# от category_id до category_lvl_3..1 и всего каталога, ELASTIC_CATEGORY_MIN_HITS - сколько похожих товаров
+# достаточно на уровне (0 - запрошенное кол-во). Индекс без полей категорий сначала перезагружается из бд целиком
+ELASTIC_CATEGORY_SCOPE = os.environ.get('ELASTIC_CATEGORY_SCOPE', '0').lower() in ('1', 'true', 'yes')
+ELASTIC_CATEGORY_MIN_HITS = int(os.environ.get('ELASTIC_CATEGORY_MIN_HITS', 0))
 
 DB_TABLE = os.environ.get('DB_TABLE')
 DB_SCHEMA = os.environ.get('DB_SCHEMA')
+# copy - загрузка через COPY FROM STDIN, to_sql - через DataFrame.to_sql
+DB_LOAD_METHOD = os.environ.get('DB_LOAD_METHOD', 'copy')
+# Кол-во процессов для парсинга XML фида, 1 - без пула процессов
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 1))
+# Размер блока чтения фида в байтах и чтение несжатого фида через mmap
+FEED_BUFFER_SIZE = int(os.environ.get('FEED_BUFFER_SIZE', 4 << 20))
+FEED_USE_MMAP = os.environ.get('FEED_USE_MMAP', '0').lower() in ('1', 'true', 'yes')
+# Подстройка размеров пачек загрузки, bulk запросов и чанков пересчета похожих товаров по длительности пачек,
+# отказам 429 и памяти процесса: желаемая длительность пачки, сек., и потолок RSS в МБ (0 - без потолка)
+BATCH_ADAPTIVE = os.environ.get('BATCH_ADAPTIVE', '1').lower() in ('1', 'true', 'yes')
+BATCH_TARGET_SECONDS = float(os.environ.get('BATCH_TARGET_SECONDS', 5))
+BATCH_MEMORY_LIMIT_MB = int(os.environ.get('BATCH_MEMORY_LIMIT_MB', 0))
+# Поиск похожих товаров: elastic - more_like_this в Elasticsearch, tfidf - локальный TF-IDF без Elasticsearch
+SIMILARITY_BACKEND = os.environ.get('SIMILARITY_BACKEND', 'elastic')
+# Кол-во процессов полного пересчета похожих товаров, больше 1 - пересчет по диапазонам uuid с прогрессом в бд
+SIMILARITY_WORKERS = int(os.environ.get('SIMILARITY_WORKERS', 1))
+# Метрики: период JSON строки в логе, textfile для Prometheus node_exporter,
+# стадии через запятую для cProfile (файлы <стадия>.prof в METRICS_PROFILE_DIR) и замера пика памяти tracemalloc
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 30))
+METRICS_TEXTFILE = os.environ.get('METRICS_TEXTFILE') or None
+METRICS_PROFILE = os.environ.get('METRICS_PROFILE', '')
+METRICS_TRACEMALLOC = os.environ.get('METRICS_TRACEMALLOC', '')
+METRICS_PROFILE_DIR = os.environ.get('METRICS_PROFILE_DIR', '.')
 config = {
     'psql_login': os.environ.get('POSTGRES_USER'),
     'psql_password': os.environ.get('POSTGRES_PASSWORD'),
     'psql_hostname': os.environ.get('POSTGRES_HOST'),
     'psql_port': os.environ.get('POSTGRES_PORT'),
     'psql_name_bd': os.environ.get('POSTGRES_DB'),
-    'psql_conn_type': 'postgres'
+    'psql_conn_type': 'postgres',
+    'psql_pool_size': os.environ.get('POSTGRES_POOL_SIZE'),
+    'psql_max_overflow': os.environ.get('POSTGRES_MAX_OVERFLOW'),
+    'psql_pool_pre_ping': os.environ.get('POSTGRES_POOL_PRE_PING'),
+    'psql_pool_recycle': os.environ.get('POSTGRES_POOL_RECYCLE'),
+    'psql_prepared_statements': os.environ.get('POSTGRES_PREPARED_STATEMENTS'),
 }
 base_dir = os.path.dirname(os.path.abspath(__file__))
\ No newline at end of file
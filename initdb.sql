@@ -26,7 +26,8 @@ create table public.sku
     updated_at             timestamp default now(),
     currency               text,
     barcode                bigint,
-    similar_sku            uuid[]
+    similar_sku            uuid[],
+    content_hash           text
 );
 
 comment on column public.sku.uuid is 'id товара в нашей бд';
@@ -55,6 +56,8 @@ comment on column public.sku.rating_value is 'Рейтинг товара (0-5)'
 
 comment on column public.sku.barcode is 'Штрихкод';
 
+comment on column public.sku.content_hash is 'Хэш содержимого товара для дельта-загрузки';
+
 create index sku_brand_index
     on public.sku (brand);
 
@@ -62,4 +65,91 @@ create unique index sku_marketplace_id_sku_id_uindex
     on public.sku (marketplace_id, product_id);
 
 create unique index sku_uuid_uindex
-    on public.sku (uuid);
\ No newline at end of file
+    on public.sku (uuid);
+
+CREATE TABLE IF NOT EXISTS public.sku_similarity_queue
+(
+    uuid        uuid PRIMARY KEY,
+    change_type text      NOT NULL,
+    changed_at  timestamp NOT NULL DEFAULT clock_timestamp()
+);
+
+ALTER TABLE public.sku_similarity_queue ADD COLUMN IF NOT EXISTS processing_id text;
+
+CREATE OR REPLACE FUNCTION public.sku_similarity_enqueue() RETURNS trigger AS
+$fn$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO public.sku_similarity_queue (uuid, change_type)
+        SELECT uuid, 'inserted' FROM new_rows WHERE uuid IS NOT NULL
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO public.sku_similarity_queue (uuid, change_type)
+        SELECT new_rows.uuid, 'changed'
+        FROM new_rows
+        JOIN old_rows ON old_rows.uuid = new_rows.uuid
+        WHERE old_rows.title IS DISTINCT FROM new_rows.title
+           OR old_rows.description IS DISTINCT FROM new_rows.description
+           OR old_rows.category_id IS DISTINCT FROM new_rows.category_id
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    ELSE
+        INSERT INTO public.sku_similarity_queue (uuid, change_type)
+        SELECT uuid, 'deleted' FROM old_rows WHERE uuid IS NOT NULL
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    END IF;
+    RETURN NULL;
+END
+$fn$ LANGUAGE plpgsql;
+
+DO
+$$
+BEGIN
+    IF to_regclass('public.sku_similar_sku_index') IS NULL THEN
+        CREATE INDEX sku_similar_sku_index ON public.sku USING gin (similar_sku);
+    END IF;
+
+    IF NOT EXISTS (SELECT 1
+                   FROM pg_trigger
+                   WHERE tgrelid = 'public.sku'::regclass AND tgname = 'sku_similarity_enqueue_insert') THEN
+        CREATE TRIGGER sku_similarity_enqueue_insert
+            AFTER INSERT ON public.sku
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION public.sku_similarity_enqueue();
+        CREATE TRIGGER sku_similarity_enqueue_update
+            AFTER UPDATE ON public.sku
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION public.sku_similarity_enqueue();
+        CREATE TRIGGER sku_similarity_enqueue_delete
+            AFTER DELETE ON public.sku
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION public.sku_similarity_enqueue();
+    END IF;
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS public.sku_similarity_progress
+(
+    job_id     text      NOT NULL,
+    shard_no   integer   NOT NULL,
+    lower_uuid uuid      NOT NULL,
+    upper_uuid uuid,
+    created_at timestamp NOT NULL DEFAULT clock_timestamp(),
+    claimed_by text,
+    claimed_at timestamp,
+    done_at    timestamp,
+    PRIMARY KEY (job_id, shard_no)
+);
+
+CREATE TABLE IF NOT EXISTS public.sku_ingest_checkpoint
+(
+    feed_id      text PRIMARY KEY,
+    feed_path    text      NOT NULL,
+    feed_size    bigint    NOT NULL,
+    feed_mtime   timestamp NOT NULL,
+    offers_done  bigint    NOT NULL DEFAULT 0,
+    completed_at timestamp,
+    updated_at   timestamp NOT NULL DEFAULT clock_timestamp()
+);
\ No newline at end of file
@@ -1,100 +1,478 @@
+import argparse
+import contextlib
+import functools
 import os
+import sys
+import time
+from typing import BinaryIO
+from uuid import uuid4
 
 import pandas as pd
-from lxml import etree
 
-from config_file import config, base_dir, ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD, DB_TABLE, DB_SCHEMA
-from utils.db_utils import batch_df_in_db, load_data_from_bd_chunk_function, update_solo_data_in_db, load_data_from_bd
+from config_file import config, base_dir, ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD, DB_TABLE, DB_SCHEMA, \
+    DB_LOAD_METHOD, PARSE_WORKERS, SIMILARITY_BACKEND, ELASTIC_BULK_THREADS, ELASTIC_BULK_CHUNK_SIZE, \
+    ELASTIC_BULK_MAX_CHUNK_BYTES, ELASTIC_BULK_MAX_RETRIES, SIMILARITY_WORKERS, METRICS_INTERVAL, METRICS_TEXTFILE, \
+    METRICS_PROFILE, METRICS_TRACEMALLOC, METRICS_PROFILE_DIR, FEED_BUFFER_SIZE, FEED_USE_MMAP, BATCH_ADAPTIVE, \
+    BATCH_TARGET_SECONDS, BATCH_MEMORY_LIMIT_MB, ELASTIC_BULK_TARGET_SECONDS, ELASTIC_SEARCH_CONCURRENCY, \
+    ELASTIC_CATEGORY_SCOPE, ELASTIC_CATEGORY_MIN_HITS
+from utils.batch_sizing import AdaptiveBatchSizer
+from utils.db_utils import batch_df_in_db, load_data_from_bd_chunk_function, update_similar_sku_bulk, \
+    execute_sql_file, select_changed_offers, split_changed_offers, upsert_offers_in_db
 from utils.elastic_utils import SimilarProductsESUpdater
-from utils.additional_utils import process_offer, parse_categories
+from utils.metrics import metrics
+from utils.feed_io import open_feed
+from utils.feed_utils import feed_identity, iter_feed_offer_batches, iter_offer_batches_parallel
+from utils.pipeline import IngestPipeline, SinkBatches
+from utils.similarity_jobs import run_similarity_job
+from utils.similarity_utils import TfidfSimilarityEngine
 
 
-def update_product_with_similar_db(chunk_df: pd.DataFrame, updater: SimilarProductsESUpdater) -> bool:
+def update_product_with_similar_db(chunk: dict | pd.DataFrame,
+                                   updater: SimilarProductsESUpdater | TfidfSimilarityEngine) -> bool:
     """
         Обновляет документы товара в базе данных, добавляя информацию о похожих товарах.
 
-        :param chunk_df: DataFrame.
-        :param updater: SimilarProductsESUpdater.
+        :param chunk: Словарь столбец -> список значений или DataFrame со столбцом uuid.
+        :param updater: SimilarProductsESUpdater или TfidfSimilarityEngine.
 
         :return: True, если обработка завершена успешно.
     """
 
+    similar_by_uuid = updater.find_similar_products_batch(list(chunk['uuid']))
+
+    for product_uuid, similar_uuids in similar_by_uuid.items():
+        if not similar_uuids:
+            print(f"Product with ID {product_uuid} not found for update.")
+
+    update_similar_sku_bulk(similar_by_uuid, config, os.path.join(base_dir, 'utils'), DB_SCHEMA, DB_TABLE)
+    return True
+
+
+def create_batch_sizer(name: str, initial: int, target_seconds: float = BATCH_TARGET_SECONDS,
+                       **kwargs) -> int | AdaptiveBatchSizer:
+    """
+        Создает AdaptiveBatchSizer с потолком памяти из конфига.
+
+        :param name: Имя пачек в логе и метриках.
+        :param initial: Начальный размер пачки.
+        :param target_seconds: Желаемая длительность пачки, сек.
+        :param kwargs: Остальные параметры AdaptiveBatchSizer.
+        :return: AdaptiveBatchSizer или initial, если подстройка выключена (BATCH_ADAPTIVE).
+    """
+    if not BATCH_ADAPTIVE:
+        return initial
+    return AdaptiveBatchSizer(name, initial, target_seconds=target_seconds,
+                              memory_limit=(BATCH_MEMORY_LIMIT_MB << 20) or None, **kwargs)
+
+
+def update_similar_in_chunks(product_uuids: list, updater: SimilarProductsESUpdater | TfidfSimilarityEngine,
+                             chunk_size: int | AdaptiveBatchSizer = 30000) -> None:
+    """
+        Пересчитывает похожие товары для списка uuid чанками.
+
+        :param product_uuids: Список uuid товаров.
+        :param updater: SimilarProductsESUpdater или TfidfSimilarityEngine.
+        :param chunk_size: Размер чанка или AdaptiveBatchSizer, размер читается перед каждым чанком.
+    """
+    start = 0
+    while start < len(product_uuids):
+        chunk = product_uuids[start:start + int(chunk_size)]
+        started = time.perf_counter()
+        update_product_with_similar_db({'uuid': chunk}, updater)
+        if isinstance(chunk_size, AdaptiveBatchSizer):
+            chunk_size.record(len(chunk), time.perf_counter() - started)
+        start += len(chunk)
+
+
+def load_offers(file_path: str | BinaryIO, elastic_updater: SimilarProductsESUpdater | None,
+                batch_size: int | AdaptiveBatchSizer = 10000, workers: int = 1, queue_size: int = 2,
+                delta: bool = False, resume: bool = False) -> None:
+    """
+        Парсит товары из XML файла пачками и параллельно загружает их в Elasticsearch и бд.
+
+        После каждой пачки, загруженной в оба хранилища, в sku_ingest_checkpoint сохраняется
+        кол-во прочитанных товаров фида.
+
+        :param file_path: Путь к XML файлу, содержащему информацию о товарах, или бинарный поток.
+            Фид может быть сжат gzip, zstd или bz2, см. open_feed. Поток без пути к файлу (stdin)
+            или который нельзя перечитать (pipe) загружается без сохранения точек продолжения.
+        :param elastic_updater: SimilarProductsESUpdater, None - загрузка только в бд.
+        :param batch_size: Размер чанков или AdaptiveBatchSizer, которому передается время загрузки
+            каждой пачки самым медленным хранилищем.
+        :param workers: Кол-во процессов для парсинга, 1 - парсинг в текущем процессе.
+        :param queue_size: Максимум пачек, ожидающих загрузки в каждое хранилище.
+        :param delta: Дельта-загрузка: стабильные uuid, upsert и пропуск товаров с неизменным content_hash.
+        :param resume: Продолжить прерванную загрузку этого фида с последней сохраненной точки.
+    """
+
     base_dir_utils = os.path.join(base_dir, 'utils')
+    names = {'schema': DB_SCHEMA, 'table': DB_TABLE}
+    feed = feed_identity(file_path)
+    execute_sql_file(config, 'create_ingest_checkpoint.sql', base_dir_utils, DB_SCHEMA, DB_TABLE, params_names=names)
 
-    for _, row in chunk_df.iterrows():
-        similar_uuids = updater.find_similar_products(row.uuid)
+    skip_offers = 0
+    resumed = False
+    if feed is None and resume:
+        print('->Фид из потока без пути к файлу нельзя продолжить, загружается целиком без точек продолжения <-')
+    elif resume:
+        checkpoint = execute_sql_file(config, 'select_ingest_checkpoint.sql', base_dir_utils, DB_SCHEMA, DB_TABLE,
+                                      params_names=names, params_values={'feed_id': feed['feed_id']},
+                                      expanding=False)
+        if checkpoint and checkpoint[0].completed_at is not None:
+            print(f'->Фид {feed["feed_path"]} уже загружен {checkpoint[0].completed_at} <-')
+            return
+        skip_offers = checkpoint[0].offers_done if checkpoint else 0
+        # Точка сохраняется в начале каждой загрузки, поэтому прерванная до первой пачки загрузка тоже продолжается
+        resumed = bool(checkpoint)
+        print(f'->Продолжаем загрузку фида {feed["feed_path"]} после {skip_offers} товаров <-')
 
-        if not similar_uuids:
-            print(f"Product with ID {row.uuid} not found for update.")
-            continue
+    def save_checkpoint(offers_done: int, completed: bool = False) -> None:
+        if feed is None:
+            return
+        execute_sql_file(config, 'upsert_ingest_checkpoint.sql', base_dir_utils, DB_SCHEMA, DB_TABLE,
+                         params_names=names,
+                         params_values={**feed, 'offers_done': offers_done, 'completed': completed},
+                         expanding=False)
 
-        update_solo_data_in_db(
-            config,
-            'update_similar_sku.sql',
-            base_dir_utils,
-            DB_SCHEMA,
-            DB_TABLE,
-            params_values={
-                'uuid': row.uuid,
-                "similar_sku": similar_uuids
-            },
-            expanding=False
-        )
+    save_checkpoint(skip_offers)
+
+    # Пачки после сохраненной точки могли успеть попасть только в одно из хранилищ, поэтому продолжение
+    # загружается через upsert: товары, уже записанные в бд, сохраняют свой uuid и не нарушают уникальность
+    upsert = delta or resumed
+    # Бд могла обогнать индекс на queue_size пачек, такие товары в бд уже с актуальным content_hash.
+    # Поэтому при продолжении в индекс идут все товары после точки, а в бд - только изменившиеся
+    index_all_offers = resumed and elastic_updater is not None
+
+    offers_read = skip_offers
+    # Кол-во прочитанных товаров фида на момент каждой переданной в конвейер пачки и размер пачки до отбора
+    batch_ends = []
+    batch_sizes = []
+
+    def tracked_batches():
+        nonlocal offers_read
+        for batch_data in batches:
+            # Позиция в фиде учитывает и отброшенные при разборе товары
+            parsed_size = batch_data.parsed
+            offers_read += parsed_size
+            if index_all_offers:
+                offers, changed = split_changed_offers(batch_data, config, base_dir_utils, DB_SCHEMA, DB_TABLE)
+                print(f'->Изменилось {len(changed)} из {len(batch_data)} товаров пачки <-')
+                batch_data = SinkBatches(elastic=offers, postgres=changed)
+            elif upsert:
+                changed = select_changed_offers(batch_data, config, base_dir_utils, DB_SCHEMA, DB_TABLE)
+                print(f'->Изменилось {len(changed)} из {len(batch_data)} товаров пачки <-')
+                if not changed:
+                    continue
+                batch_data = changed
+            batch_ends.append(offers_read)
+            batch_sizes.append(parsed_size)
+            yield batch_data
+
+    sinks = {'elastic': elastic_updater.load_data_to_elasticsearch} if elastic_updater is not None else {}
+
+    if upsert:
+        execute_sql_file(config, 'add_content_hash.sql', base_dir_utils, DB_SCHEMA, DB_TABLE, params_names=names)
+        sinks['postgres'] = lambda batch_data: upsert_offers_in_db(batch_data, config, base_dir_utils, DB_SCHEMA,
+                                                                   DB_TABLE)
+    else:
+        # Пачка общая для обоих получателей, batch_df_in_db ее не меняет
+        sinks['postgres'] = lambda batch_data: batch_df_in_db(batch_data, config, DB_SCHEMA, DB_TABLE,
+                                                              method=DB_LOAD_METHOD)
+
+    # Полная загрузка идет в режиме массовой загрузки индекса, дельта обычно мала и его не включает
+    bulk_ingest = contextlib.nullcontext()
+    if elastic_updater is not None and not delta:
+        bulk_ingest = elastic_updater.bulk_ingest()
+
+    def batch_done(batch_no: int, seconds: float) -> None:
+        save_checkpoint(batch_ends[batch_no])
+        if isinstance(batch_size, AdaptiveBatchSizer):
+            batch_size.record(batch_sizes[batch_no], seconds)
+
+    pipeline = IngestPipeline(sinks, queue_size=queue_size, on_batch_done=batch_done)
+    with open_feed(file_path, FEED_BUFFER_SIZE, FEED_USE_MMAP) as feed_stream, bulk_ingest:
+        if workers > 1:
+            batches = iter_offer_batches_parallel(feed_stream, batch_size, workers, delta=upsert,
+                                                  skip_offers=skip_offers)
+        else:
+            batches = iter_feed_offer_batches(feed_stream, batch_size, delta=upsert, skip_offers=skip_offers)
+        pipeline.run(tracked_batches())
+    save_checkpoint(offers_read, completed=True)
+
+
+def create_elastic_updater() -> SimilarProductsESUpdater:
+    """Создает SimilarProductsESUpdater индекса товаров с настройками из конфига."""
+    bulk_chunk_size = create_batch_sizer('es_bulk', ELASTIC_BULK_CHUNK_SIZE, ELASTIC_BULK_TARGET_SECONDS,
+                                         max_batch_bytes=ELASTIC_BULK_MAX_CHUNK_BYTES)
+    return SimilarProductsESUpdater('offer_index', ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD,
+                                    bulk_threads=ELASTIC_BULK_THREADS,
+                                    bulk_chunk_size=bulk_chunk_size,
+                                    bulk_max_chunk_bytes=ELASTIC_BULK_MAX_CHUNK_BYTES,
+                                    bulk_max_retries=ELASTIC_BULK_MAX_RETRIES,
+                                    search_concurrency=ELASTIC_SEARCH_CONCURRENCY,
+                                    category_scope=ELASTIC_CATEGORY_SCOPE,
+                                    category_min_hits=ELASTIC_CATEGORY_MIN_HITS)
+
+
+def reindex_elastic_from_db(elastic_updater: SimilarProductsESUpdater, chunk_size: int = 30000) -> None:
+    """
+        Перезагружает в индекс все товары из бд и отмечает индекс перезагруженным.
+        Нужна после добавления полей в маппинг существующего индекса: дельта-загрузка отправляет
+        только изменившиеся товары, и остальные документы так и остались бы без новых полей.
+
+        :param elastic_updater: SimilarProductsESUpdater.
+        :param chunk_size: Размер чанков при чтении товаров.
+    """
+
+    print('->Перезагружаем все товары из бд в индекс Elasticsearch <-')
+    names = {'schema': DB_SCHEMA, 'table': DB_TABLE}
+    with elastic_updater.bulk_ingest():
+        load_data_from_bd_chunk_function(config, 'select_sku_index_fields.sql', os.path.join(base_dir, 'utils'),
+                                         DB_SCHEMA, DB_TABLE, elastic_updater.load_index_columns,
+                                         chunk_size=chunk_size, params_names=names)
+    elastic_updater.mark_reindexed()
+
+
+def build_tfidf_engine(chunk_size: int = 30000) -> TfidfSimilarityEngine:
+    """
+        Строит локальный TF-IDF индекс по всем товарам из бд.
+
+        :param chunk_size: Размер чанков при чтении товаров.
+        :return: TfidfSimilarityEngine.
+    """
+
+    engine = TfidfSimilarityEngine()
+    load_data_from_bd_chunk_function(config, 'select_from_sku.sql', os.path.join(base_dir, 'utils'), DB_SCHEMA,
+                                     DB_TABLE, engine.add_documents, chunk_size=chunk_size)
+    return engine.build()
+
+
+def mark_similarity_queue(processing_id: str) -> None:
+    """
+        Помечает записи очереди sku_similarity_queue, которые покроет пересчет похожих товаров.
+
+        Триггер снимает пометку, если товар снова изменился, поэтому такие записи не удалятся по окончании
+        пересчета. Изменения, не зафиксированные к моменту пометки, тоже остаются в очереди.
+
+        :param processing_id: ID пересчета.
+    """
+
+    execute_sql_file(config, 'mark_similarity_queue.sql', os.path.join(base_dir, 'utils'), DB_SCHEMA, DB_TABLE,
+                     params_names={'schema': DB_SCHEMA, 'table': DB_TABLE},
+                     params_values={'processing_id': processing_id}, expanding=False)
+
+
+def delete_similarity_queue(processing_id: str) -> None:
+    """
+        Удаляет из очереди sku_similarity_queue записи, помеченные завершенным пересчетом.
+
+        :param processing_id: ID пересчета.
+    """
+
+    execute_sql_file(config, 'delete_similarity_queue.sql', os.path.join(base_dir, 'utils'), DB_SCHEMA, DB_TABLE,
+                     params_names={'schema': DB_SCHEMA, 'table': DB_TABLE},
+                     params_values={'processing_id': processing_id}, expanding=False)
+
+
+def update_similar_incremental(elastic_updater: SimilarProductsESUpdater | TfidfSimilarityEngine,
+                               chunk_size: int | AdaptiveBatchSizer = 30000) -> None:
+    """
+        Пересчитывает похожие товары только для товаров из очереди изменений sku_similarity_queue
+        и для товаров, в чьих similar_sku они встречаются. Удаленные товары убираются из индекса.
+
+        Очередь заполняют триггеры на таблице товаров. Пересчет помечает записи очереди своим processing_id
+        и в конце удаляет только их: изменения, записанные или зафиксированные позже, остаются в очереди.
+
+        :param elastic_updater: SimilarProductsESUpdater или TfidfSimilarityEngine.
+        :param chunk_size: Размер чанков при поиске похожих товаров.
+    """
+
+    base_dir_utils = os.path.join(base_dir, 'utils')
+    names = {'schema': DB_SCHEMA, 'table': DB_TABLE}
+
+    processing_id = uuid4().hex
+    mark_similarity_queue(processing_id)
+    queue_rows = execute_sql_file(config, 'select_similarity_queue.sql', base_dir_utils, DB_SCHEMA, DB_TABLE,
+                                  params_names=names, params_values={'processing_id': processing_id},
+                                  expanding=False)
+    if not queue_rows:
+        print('->Изменений для пересчета похожих товаров нет <-')
+        return
+
+    deleted_uuids = [str(row.uuid) for row in queue_rows if row.change_type == 'deleted']
+    changed_uuids = [str(row.uuid) for row in queue_rows if row.change_type != 'deleted']
+
+    if deleted_uuids:
+        elastic_updater.delete_documents(deleted_uuids)
+    elastic_updater.refresh_index()
+
+    referencing_rows = execute_sql_file(config, 'select_sku_referencing.sql', base_dir_utils, DB_SCHEMA, DB_TABLE,
+                                        params_names=names, params_values={'uuids': changed_uuids + deleted_uuids},
+                                        expanding=False)
+    affected_uuids = list(dict.fromkeys(changed_uuids + [str(row.uuid) for row in referencing_rows]))
+    print(f'->Пересчет похожих товаров: изменено {len(changed_uuids)}, удалено {len(deleted_uuids)}, '
+          f'всего к пересчету {len(affected_uuids)} <-')
+
+    update_similar_in_chunks(affected_uuids, elastic_updater, chunk_size)
+
+    delete_similarity_queue(processing_id)
+
+
+def update_similar_sharded(updater_factory: callable, job_id: str = None, workers: int = 1, shards: int = 64,
+                           chunk_size: int | AdaptiveBatchSizer = 30000) -> bool:
+    """
+        Полный пересчет похожих товаров по диапазонам uuid в нескольких процессах с сохранением прогресса.
+
+        Прерванное задание продолжается повторным запуском с тем же job_id, в том числе с других хостов.
+
+        :param updater_factory: Создает поисковик похожих товаров в каждом процессе.
+        :param job_id: ID задания, None - новое задание.
+        :param workers: Кол-во процессов.
+        :param shards: Кол-во диапазонов uuid нового задания.
+        :param chunk_size: Размер чанков при поиске похожих товаров или AdaptiveBatchSizer,
+            каждый процесс подстраивает свою копию.
+
+        :return: True, если все диапазоны задания пересчитаны.
+    """
+
+    base_dir_utils = os.path.join(base_dir, 'utils')
+    if job_id is None:
+        job_id = uuid4().hex
+        # Новое задание покрывает изменения очереди, зафиксированные до его начала
+        mark_similarity_queue(job_id)
+    print(f'->Пересчет похожих товаров, задание {job_id}. Продолжить после сбоя: --similarity-job {job_id} <-')
+
+    job = run_similarity_job(config, base_dir_utils, DB_SCHEMA, DB_TABLE, job_id, update_product_with_similar_db,
+                             updater_factory, shards=shards, workers=workers, chunk_size=chunk_size)
+    if job.remaining:
+        print(f'->Задание {job_id} не завершено, осталось {job.remaining} из {job.shards} диапазонов <-')
+        return False
+
+    delete_similarity_queue(job_id)
     return True
 
 
-def match_elastic_offer(file_path: str, batch_size: int = 10000):
+def match_elastic_offer(file_path: str | BinaryIO, batch_size: int = 10000, workers: int = 1, load_feed: bool = True,
+                        delta: bool = False, incremental: bool = False, chunk_size: int = 30000,
+                        similarity_backend: str = SIMILARITY_BACKEND, similarity_workers: int = SIMILARITY_WORKERS,
+                        similarity_job: str = None, similarity_shards: int = 64, resume: bool = False):
     """
         Обрабатывает XML файл чанками и загружает данные о товарах сначала в бд, далее простраивает
         индекс для Elasticsearch, ищет похожие товары друг между другом и обновляет информацию о них в бд.
 
-        :param file_path: Путь к XML файлу, содержащему информацию о товарах.
-        :param batch_size: Размер чанков.
+        :param file_path: Путь к XML файлу, содержащему информацию о товарах, или бинарный поток, см. load_offers.
+        :param batch_size: Начальный размер чанков, подстраивается при BATCH_ADAPTIVE.
+        :param workers: Кол-во процессов для парсинга XML.
+        :param load_feed: Загружать ли товары из XML файла, False - только пересчет похожих товаров.
+        :param delta: Дельта-загрузка, включает инкрементальный пересчет похожих товаров.
+        :param incremental: Пересчитывать похожие товары только для изменившихся товаров и их соседей.
+        :param chunk_size: Начальный размер чанков при поиске похожих товаров, подстраивается при BATCH_ADAPTIVE.
+        :param similarity_backend: elastic - more_like_this в Elasticsearch,
+            tfidf - локальный TF-IDF индекс по бд, Elasticsearch не используется.
+        :param similarity_workers: Кол-во процессов полного пересчета похожих товаров.
+        :param similarity_job: ID задания полного пересчета для продолжения после сбоя.
+            Задание или similarity_workers > 1 включают пересчет по диапазонам uuid с сохранением прогресса.
+        :param similarity_shards: Кол-во диапазонов uuid нового задания.
+        :param resume: Продолжить прерванную загрузку фида с последней сохраненной точки.
 
         :return: True, если обработка завершена успешно.
     """
 
-    elastic_updater = SimilarProductsESUpdater('offer_index', ELASTIC_HOST, ELASTIC_PORT, ELASTIC_PASSWORD)
-    elastic_updater.create_index()
-
-    # categories_by_level = parse_categories(file_path)
-    # category_map = {data['categoryId']: data for level_data in categories_by_level.values() for data in level_data}
-    #
-    # batch_data = []
-    # context = etree.iterparse(file_path, tag='offer', events=('end',))
-    # for event, offer in context:
-    #     offer_data = process_offer(offer, category_map)
-    #     batch_data.append(offer_data)
-    #
-    #     if len(batch_data) >= batch_size:
-    #         elastic_updater.load_data_to_elasticsearch(batch_data)
-    #         batch_df_in_db(batch_data, config, DB_SCHEMA, DB_TABLE)
-    #         batch_data.clear()
-    #
-    #     offer.clear()
-    #     while offer.getprevious() is not None:
-    #         del offer.getparent()[0]
-    #
-    # # Загружаем оставшиеся данные, если они есть
-    # if batch_data:
-    #     elastic_updater.load_data_to_elasticsearch(batch_data)
-    #     batch_df_in_db(batch_data, config, DB_SCHEMA, DB_TABLE)
-    #     batch_data.clear()
+    if similarity_backend not in ('elastic', 'tfidf'):
+        raise ValueError(f'Неизвестный способ поиска похожих товаров: {similarity_backend}')
 
     base_dir_utils = os.path.join(base_dir, 'utils')
-    load_data_from_bd_chunk_function(
-        config,
-        'select_from_sku.sql',
-        base_dir_utils,
-        DB_SCHEMA,
-        DB_TABLE,
-        update_product_with_similar_db,
-        updater=elastic_updater
-    )
+    names = {'schema': DB_SCHEMA, 'table': DB_TABLE}
+
+    elastic_updater = None
+    if similarity_backend == 'elastic':
+        elastic_updater = create_elastic_updater()
+        elastic_updater.create_index()
+        # Фильтры по категориям исключили бы из поиска документы без полей категорий
+        if elastic_updater.reindex_required and ELASTIC_CATEGORY_SCOPE:
+            reindex_elastic_from_db(elastic_updater, chunk_size)
+    execute_sql_file(config, 'create_similarity_queue.sql', base_dir_utils, DB_SCHEMA, DB_TABLE, params_names=names)
+
+    if load_feed:
+        load_offers(file_path, elastic_updater, create_batch_sizer('ingest', batch_size), workers, delta=delta,
+                    resume=resume)
+
+    similarity_chunks = create_batch_sizer('similarity', chunk_size)
+
+    if not (delta or incremental) and (similarity_job is not None or similarity_workers > 1):
+        if elastic_updater is not None:
+            elastic_updater.refresh_index()
+            updater_factory = create_elastic_updater
+        else:
+            # Каждый процесс строит свой индекс TF-IDF
+            updater_factory = functools.partial(build_tfidf_engine, chunk_size)
+        return update_similar_sharded(updater_factory, similarity_job, similarity_workers, similarity_shards,
+                                      similarity_chunks)
+
+    # Индекс TF-IDF строится по бд после загрузки и уже содержит все изменения очереди
+    similar_updater = elastic_updater or build_tfidf_engine(chunk_size)
+
+    if delta or incremental:
+        update_similar_incremental(similar_updater, similarity_chunks)
+        return True
+
+    processing_id = uuid4().hex
+    mark_similarity_queue(processing_id)
+    similar_updater.refresh_index()
+
+    if isinstance(similar_updater, TfidfSimilarityEngine):
+        # Все uuid уже в индексе, повторно читать таблицу не нужно
+        update_similar_in_chunks(similar_updater.uuids, similar_updater, similarity_chunks)
+    else:
+        load_data_from_bd_chunk_function(
+            config,
+            'select_from_sku.sql',
+            base_dir_utils,
+            DB_SCHEMA,
+            DB_TABLE,
+            update_product_with_similar_db,
+            chunk_size=similarity_chunks,
+            updater=similar_updater
+        )
+
+    # Полный пересчет покрыл изменения, помеченные до его начала
+    delete_similarity_queue(processing_id)
 
     return True
 
 
 if __name__ == '__main__':
-    path = os.path.join('test', 'elektronika_products_20240924_091654.xml')
-    match_elastic_offer(path)
+    parser = argparse.ArgumentParser(description='Загрузка товаров из XML фида и поиск похожих товаров.')
+    parser.add_argument('file_path', nargs='?',
+                        default=os.path.join('test', 'elektronika_products_20240924_091654.xml'),
+                        help='XML фид, возможно сжатый gzip, zstd или bz2; - читать из stdin')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--skip-load', action='store_true', help='Не загружать фид, только пересчитать похожие товары')
+    parser.add_argument('--delta', action='store_true',
+                        help='Дельта-загрузка: пропускать товары с неизменным содержимым')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Пересчитать похожие товары только для изменившихся товаров и их соседей')
+    parser.add_argument('--similarity-backend', choices=('elastic', 'tfidf'), default=SIMILARITY_BACKEND,
+                        help='Поиск похожих товаров: more_like_this в Elasticsearch или локальный TF-IDF')
+    parser.add_argument('--resume', action='store_true',
+                        help='Продолжить прерванную загрузку фида с последней сохраненной точки')
+    parser.add_argument('--similarity-workers', type=int, default=SIMILARITY_WORKERS,
+                        help='Кол-во процессов полного пересчета похожих товаров')
+    parser.add_argument('--similarity-job', help='ID задания полного пересчета, продолжает прерванное задание')
+    parser.add_argument('--similarity-shards', type=int, default=64, help='Кол-во диапазонов uuid нового задания')
+    args = parser.parse_args()
+    if args.resume and args.file_path == '-':
+        parser.error('--resume не работает с фидом из stdin: точка продолжения сохраняется только для файла')
+
+    metrics.configure(METRICS_PROFILE, METRICS_TRACEMALLOC, METRICS_PROFILE_DIR)
+    metrics.start_reporter(METRICS_INTERVAL, METRICS_TEXTFILE)
+    try:
+        file_path = sys.stdin.buffer if args.file_path == '-' else args.file_path
+        match_elastic_offer(file_path, args.batch_size, args.workers, load_feed=not args.skip_load,
+                            delta=args.delta, incremental=args.incremental,
+                            similarity_backend=args.similarity_backend, similarity_workers=args.similarity_workers,
+                            similarity_job=args.similarity_job, similarity_shards=args.similarity_shards,
+                            resume=args.resume)
+    finally:
+        metrics.stop_reporter(METRICS_TEXTFILE)
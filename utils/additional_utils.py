@@ -1,14 +1,36 @@
+import hashlib
 import json
-from typing import Any
+from typing import Any, BinaryIO
 from collections import defaultdict
-from uuid import uuid4
+from uuid import UUID, uuid4, uuid5
 
 import pandas as pd
 from lxml import etree
 
+from .feed_io import open_feed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 max_value = 2**63 - 1
 min_value = -2**63
 
+# Пространство имен для детерминированных uuid товаров: uuid5 от (marketplace_id, product_id)
+SKU_UUID_NAMESPACE = UUID('6f1d3c2a-8b4e-5f7a-9c0d-2e3f4a5b6c7d')
+# Поля, не входящие в хэш содержимого товара
+CONTENT_HASH_EXCLUDED_FIELDS = frozenset(('uuid', 'similar_sku', 'content_hash'))
+
+CATEGORY_LEVEL_FIELDS = ('category_lvl_1', 'category_lvl_2', 'category_lvl_3', 'category_remaining')
+EMPTY_CATEGORY_LEVELS = (None, None, None, None)
+
+# Теги товара, значения которых читаются как текст первого вхождения (аналог findtext)
+OFFER_TEXT_TAGS = frozenset((
+    'oldprice', 'price', 'categoryId', 'group_id', 'name', 'description', 'vendor', 'seller_id', 'seller_name',
+    'picture', 'rating_count', 'rating_value', 'bonuses', 'sales', 'currencyId', 'barcode',
+))
+
 
 def post_processing_offer_df(offer_df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -25,24 +47,66 @@ def post_processing_offer_df(offer_df: pd.DataFrame) -> pd.DataFrame:
     return offer_df
 
 
+def offer_in_bigint_range(offer_data: dict) -> bool:
+    """
+        Проверяет, что product_id и barcode товара помещаются в bigint, построчный аналог post_processing_offer_df.
+
+        :param offer_data: Словарь товара.
+        :return: True, если товар можно загружать.
+    """
+    return min_value <= offer_data['product_id'] <= max_value and min_value <= offer_data['barcode'] <= max_value
+
+
 def assign_levels(category_map: dict) -> None:
     """
     Присваивает уровни категориям на основе их родительских ID.
 
+    Уровни считаются итеративно с запоминанием: каждая категория проходится один раз.
+    Отсутствующий родитель считается корнем, цикл в дереве разрывается на категории, замкнувшей его.
+
     :param category_map: Словарь с категориями.
     """
+    levels = {}
     for cat_id in category_map:
-        level = 1  # Начинаем с уровня 1 для корневой категории
-        current_id = category_map[cat_id]['parentId']
+        path = []
+        on_path = set()
+        current_id = cat_id
+
+        # Поднимаемся по дереву категорий до категории с известным уровнем, корня или цикла
+        while current_id and current_id in category_map and current_id not in levels and current_id not in on_path:
+            path.append(current_id)
+            on_path.add(current_id)
+            current_id = category_map[current_id]['parentId']
 
-        # Поднимаемся по дереву категорий
-        while current_id and current_id in category_map:
+        level = levels.get(current_id, 0)
+        for path_id in reversed(path):
             level += 1
-            current_id = category_map[current_id]['parentId']
+            levels[path_id] = level
 
+    for cat_id, level in levels.items():
         category_map[cat_id]['level'] = level
 
 
+def build_category_index(category_map: dict) -> None:
+    """
+    Сохраняет в каждой категории готовый кортеж (category_lvl_1, category_lvl_2, category_lvl_3, category_remaining)
+    под ключом 'levels', чтобы товар получал уровни одним обращением к словарю.
+
+    Значения совпадают с fill_category_levels, подъем по дереву ограничен четырьмя шагами.
+
+    :param category_map: Словарь с категориями.
+    """
+    for cat_id, data in category_map.items():
+        names = []
+        current_id = cat_id
+        while current_id and len(names) < 4 and current_id in category_map:
+            names.append(category_map[current_id]['name'])
+            current_id = category_map[current_id]['parentId']
+
+        names.extend([None] * (4 - len(names)))
+        data['levels'] = tuple(reversed(names))
+
+
 def group_categories_by_level(category_map: dict) -> dict:
     """
     Группирует категории по их уровням.
@@ -58,32 +122,44 @@ def group_categories_by_level(category_map: dict) -> dict:
     return dict(levels)
 
 
-def parse_categories(file_path: str) -> dict:
+def add_category(category_map: dict, elem: Any) -> None:
+    """
+    Добавляет категорию из XML-элемента в словарь категорий.
+
+    :param category_map: Словарь с категориями.
+    :param elem: XML-элемент категории.
+    """
+    cat_id = elem.get('id')
+    parent_id = elem.get('parentId')
+    name = elem.text.strip()
+
+    category_map[cat_id] = {
+        'name': name,
+        'parentId': parent_id,
+        'level': None,
+        'categoryId': cat_id
+    }
+
+
+def parse_categories(file_path: str | BinaryIO) -> dict:
     """
     Парсит категории из XML файла.
 
-    :param file_path: Путь к XML файлу с категориями и товарами.
+    :param file_path: Путь к XML файлу с категориями и товарами или бинарный поток, сжатие определяется по
+        первым байтам, см. open_feed.
     :return: Словарь с категориями по уровням.
     """
 
     category_map = {}
-    context = etree.iterparse(file_path, tag='category', events=('start', ))
-    for event, elem in context:
-        cat_id = elem.get('id')
-        parent_id = elem.get('parentId')
-        name = elem.text.strip()
-
-        category_map[cat_id] = {
-            'name': name,
-            'parentId': parent_id,
-            'level': None,
-            'categoryId': cat_id
-        }
-
-        elem.clear()
-
-    # Определяем уровень каждой категории
+    with open_feed(file_path) as feed:
+        context = etree.iterparse(feed, tag='category', events=('start', ))
+        for event, elem in context:
+            add_category(category_map, elem)
+            elem.clear()
+
+    # Определяем уровень каждой категории и готовые уровни для товаров
     assign_levels(category_map)
+    build_category_index(category_map)
 
     # Формируем итоговый словарь с уровнями
     return group_categories_by_level(category_map)
@@ -117,6 +193,22 @@ def fill_category_levels(category_id: str, category_map: dict) -> dict:
     return result
 
 
+def category_levels(category_id: str, category_map: dict) -> dict:
+    """
+    Возвращает уровни категории из индекса build_category_index, без индекса - через fill_category_levels.
+
+    :param category_id: ID категории.
+    :param category_map: Словарь с категориями.
+    :return: Словарь с заполненными уровнями.
+    """
+    category = category_map.get(category_id)
+    if category is None:
+        return dict(zip(CATEGORY_LEVEL_FIELDS, EMPTY_CATEGORY_LEVELS))
+    if 'levels' not in category:
+        return fill_category_levels(category_id, category_map)
+    return dict(zip(CATEGORY_LEVEL_FIELDS, category['levels']))
+
+
 def process_offer(offer: Any, category_map: dict) -> dict:
     """
         Функция парсит товар.
@@ -129,7 +221,7 @@ def process_offer(offer: Any, category_map: dict) -> dict:
     new_price = float(offer.findtext('price', 0.0))
     discount = round((old_price - new_price) / old_price * 100, 2) if old_price != 0 else 0
 
-    categories_levels = fill_category_levels(str(offer.findtext('categoryId', 0)), category_map)
+    categories_levels = category_levels(str(offer.findtext('categoryId', 0)), category_map)
     params = {param.get('name'): param.text for param in offer.findall('param')}
 
     offer_data = {
@@ -158,3 +250,114 @@ def process_offer(offer: Any, category_map: dict) -> dict:
     offer_data.update(categories_levels)
 
     return offer_data
+
+
+def fast_json_dumps(obj: Any) -> str:
+    """
+    Сериализует объект в JSON через orjson, если он установлен, иначе через json.dumps.
+
+    Результат orjson компактнее (без пробелов и без экранирования не-ASCII символов), поэтому совпадает
+    с json.dumps по значению, но не побайтно.
+
+    :param obj: Объект.
+    :return: JSON строка.
+    """
+    if orjson is None:
+        return json.dumps(obj)
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+def fast_json_bytes(obj: Any) -> bytes:
+    """
+    Сериализует объект в JSON байты UTF-8 через orjson, если он установлен, иначе через json.dumps.
+
+    :param obj: Объект.
+    :return: JSON в байтах.
+    """
+    if orjson is None:
+        return json.dumps(obj, ensure_ascii=False).encode()
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def stable_offer_uuid(marketplace_id: int, product_id: int) -> UUID:
+    """
+    Возвращает детерминированный uuid товара, одинаковый при каждой загрузке фида.
+
+    :param marketplace_id: ID маркетплейса.
+    :param product_id: ID товара в маркетплейсе.
+    :return: UUID.
+    """
+    return uuid5(SKU_UUID_NAMESPACE, f'{marketplace_id}:{product_id}')
+
+
+def offer_content_hash(offer_data: dict) -> str:
+    """
+    Считает хэш содержимого товара по всем полям, кроме uuid, similar_sku и самого хэша.
+
+    :param offer_data: Словарь товара.
+    :return: Хэш в hex.
+    """
+    values = [[key, offer_data[key]] for key in sorted(offer_data) if key not in CONTENT_HASH_EXCLUDED_FIELDS]
+    payload = json.dumps(values, ensure_ascii=False, default=str).encode()
+    return hashlib.md5(payload, usedforsecurity=False).hexdigest()
+
+
+def process_offer_fast(offer: Any, category_map: dict, json_dumps: Any = json.dumps, delta: bool = False) -> dict:
+    """
+        Функция парсит товар за один проход по дочерним элементам, результат совпадает с process_offer,
+        кроме uuid: он детерминирован по (marketplace_id, product_id), поэтому повторная загрузка товара
+        после сбоя перезаписывает тот же документ.
+
+        :param offer: XML-элемент товара.
+        :param category_map: Словарь с информацией о категориях.
+        :param json_dumps: Функция сериализации характеристик, например fast_json_dumps.
+        :param delta: Режим дельта-загрузки: поле content_hash.
+        :return: Словарь.
+    """
+    texts = {}
+    params = {}
+    for child in offer:
+        tag = child.tag
+        if tag == 'param':
+            params[child.get('name')] = child.text
+        elif tag in OFFER_TEXT_TAGS and tag not in texts:
+            texts[tag] = child.text or ''
+
+    get = texts.get
+    old_price = float(get('oldprice', 0.0))
+    new_price = float(get('price', 0.0))
+    discount = round((old_price - new_price) / old_price * 100, 2) if old_price != 0 else 0
+    category_id = get('categoryId', 0)
+
+    marketplace_id = int(get('group_id', 0))
+    product_id = int(offer.get('id', 0))
+
+    offer_data = {
+        'uuid': stable_offer_uuid(marketplace_id, product_id),
+        'marketplace_id': marketplace_id,
+        'product_id': product_id,
+        'title': get('name'),
+        'description': get('description'),
+        'brand': get('vendor'),
+        'seller_id': int(get('seller_id', 0)),
+        'seller_name': get('seller_name'),
+        'first_image_url': get('picture'),
+        'category_id': int(category_id),
+        'features': json_dumps(params),
+        'rating_count': int(get('rating_count', 0)),
+        'rating_value': float(get('rating_value', 0.0)),
+        'price_before_discounts': old_price,
+        'discount': discount,
+        'price_after_discounts': new_price,
+        'bonuses': int(get('bonuses', 0)),
+        'sales': int(get('sales', 0)),
+        'currency': get('currencyId'),
+        'barcode': int(get('barcode', 0)),
+        'similar_sku': [],
+    }
+    offer_data.update(category_levels(str(category_id), category_map))
+
+    if delta:
+        offer_data['content_hash'] = offer_content_hash(offer_data)
+
+    return offer_data
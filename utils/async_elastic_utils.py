@@ -0,0 +1,391 @@
+import asyncio
+import threading
+import time
+from itertools import islice
+from typing import Any, Coroutine, Iterable, Iterator
+
+from elasticsearch import AsyncElasticsearch, NotFoundError, ApiError, helpers
+
+from .additional_utils import fast_json_bytes, CATEGORY_LEVEL_FIELDS
+from .batch_sizing import AdaptiveBatchSizer
+from .metrics import metrics
+from .offer_batch import OfferBatch, as_offer_batch
+
+# Поля документа индекса: тексты для more_like_this и поля фильтров
+INDEX_FIELDS = ('uuid', 'title', 'description', 'brand', 'price_after_discounts', 'category_id') + \
+    CATEGORY_LEVEL_FIELDS[:3]
+# Поля фильтра поиска в пределах категории, от узкой области к широкой
+CATEGORY_SCOPE_FIELDS = ('category_id', 'category_lvl_3', 'category_lvl_2', 'category_lvl_1')
+
+
+class EventLoopThread:
+    """
+    Постоянный цикл событий в фоновом потоке: синхронный код выполняет в нем корутины через run.
+    Цикл живет все время работы, поэтому пул соединений асинхронного клиента не пересоздается между вызовами.
+    """
+
+    def __init__(self, name: str = 'es-event-loop'):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def run(self, coroutine: Coroutine) -> Any:
+        """Выполняет корутину в цикле и ждет результат в вызывающем потоке."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncSimilarProductsESUpdater:
+    """
+    Асинхронный поиск похожих товаров и загрузка индекса на AsyncElasticsearch.
+
+    Кол-во одновременных bulk и поисковых запросов ограничено семафорами, общими для всех вызовов,
+    поэтому загрузка и поиск могут идти одновременно из нескольких корутин без перегрузки кластера.
+    Все методы выполняются в одном цикле событий, клиент создается при первом запросе в этом цикле.
+
+    С category_scope похожие товары ищутся в пределах категории товара: more_like_this оборачивается в bool запрос
+    с фильтром по полю из CATEGORY_SCOPE_FIELDS. Если найдено меньше category_min_hits товаров, область
+    расширяется до следующего уровня категории и в конце до всего каталога, найденные ранее товары остаются первыми.
+    """
+
+    def __init__(self, index_name: str, elastic_host: str, elastic_port: str, elastic_pass: str,
+                 bulk_concurrency: int = 4, search_concurrency: int = 4,
+                 bulk_chunk_size: int | AdaptiveBatchSizer = 500, bulk_max_chunk_bytes: int = 10 << 20,
+                 bulk_max_retries: int = 5, bulk_initial_backoff: float = 2,
+                 category_scope: bool = False, category_min_hits: int = 0):
+        """
+        :param bulk_concurrency: Максимум одновременных bulk запросов.
+        :param search_concurrency: Максимум одновременных поисковых запросов.
+        :param bulk_chunk_size: Максимум документов в одном bulk запросе или AdaptiveBatchSizer.
+        :param bulk_max_chunk_bytes: Максимальный размер bulk запроса в байтах.
+        :param bulk_max_retries: Кол-во повторов чанка при ответе 429.
+        :param bulk_initial_backoff: Задержка перед первым повтором, сек., дальше удваивается.
+        :param category_scope: Искать похожие товары в пределах категории товара.
+        :param category_min_hits: Сколько похожих товаров достаточно, чтобы не расширять область поиска,
+            0 - запрошенное кол-во.
+        """
+        self.hosts = [f"http://{elastic_host}:{elastic_port}"]
+        self.basic_auth = ('elastic', elastic_pass)
+        self.index_name = index_name
+
+        self.bulk_concurrency = bulk_concurrency
+        self.search_concurrency = search_concurrency
+        self.bulk_chunk_size = bulk_chunk_size
+        self.bulk_max_chunk_bytes = bulk_max_chunk_bytes
+        self.bulk_max_retries = bulk_max_retries
+        self.bulk_initial_backoff = bulk_initial_backoff
+        self.category_scope = category_scope
+        self.category_min_hits = category_min_hits
+
+        self._es = None
+        self._bulk_es = None
+        self._bulk_limit = asyncio.Semaphore(bulk_concurrency)
+        self._search_limit = asyncio.Semaphore(search_concurrency)
+
+    @property
+    def es(self) -> AsyncElasticsearch:
+        if self._es is None:
+            self._es = AsyncElasticsearch(self.hosts, basic_auth=self.basic_auth,
+                                          connections_per_node=self.bulk_concurrency + self.search_concurrency)
+        return self._es
+
+    @property
+    def bulk_es(self) -> AsyncElasticsearch:
+        if self._bulk_es is None:
+            # Транспорт сам повторяет ответы 429 без задержки, для bulk повторы с задержкой выполняет _send_chunk
+            self._bulk_es = self.es.options(retry_on_status=(502, 503, 504))
+        return self._bulk_es
+
+    async def close(self) -> None:
+        """Закрывает соединения клиента."""
+        if self._es is not None:
+            await self._es.close()
+            self._es = self._bulk_es = None
+
+    async def __aenter__(self) -> 'AsyncSimilarProductsESUpdater':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def bulk(self, actions: Iterable) -> list:
+        """
+        Отправляет действия чанками, одновременно не больше bulk_concurrency запросов.
+        Размер чанка читается из bulk_chunk_size перед каждым чанком, для AdaptiveBatchSizer ему передаются
+        длительность, объем и кол-во отказов 429 каждого чанка.
+
+        :param actions: Итерируемый объект bulk действий.
+        :return: Список ошибок по документам.
+        """
+        actions = iter(actions)
+        errors = []
+        tasks = []
+        sent_docs = sent_bytes = 0
+
+        stage = metrics.start_stage('es_bulk')
+        try:
+            while True:
+                # Следующий чанк формируется, когда освобождается место для запроса
+                await self._bulk_limit.acquire()
+                chunk = list(islice(actions, int(self.bulk_chunk_size)))
+                if not chunk:
+                    self._bulk_limit.release()
+                    break
+                nbytes = sum(len(action['_source']) for action in chunk if isinstance(action.get('_source'), bytes))
+                sent_docs += len(chunk)
+                sent_bytes += nbytes
+                tasks.append(asyncio.create_task(self._send_limited_chunk(chunk, nbytes, errors)))
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        metrics.stop_stage(stage, items=sent_docs, nbytes=sent_bytes)
+        metrics.inc('es_bulk_errors', len(errors))
+
+        return errors
+
+    async def _send_limited_chunk(self, chunk: list, nbytes: int, errors: list) -> None:
+        """Отправляет чанк, занявший место в _bulk_limit, и освобождает его."""
+        try:
+            started = time.perf_counter()
+            rejected = await self._send_chunk(chunk, errors)
+            if isinstance(self.bulk_chunk_size, AdaptiveBatchSizer):
+                self.bulk_chunk_size.record(len(chunk), time.perf_counter() - started, nbytes, rejected)
+        finally:
+            self._bulk_limit.release()
+
+    async def _send_chunk(self, chunk: list, errors: list) -> int:
+        """
+        Отправляет чанк действий. Чанк целиком при ответе 429 и документы с ответом 429 повторяются
+        с экспоненциальной задержкой до bulk_max_retries раз.
+
+        :param chunk: Список bulk действий с _id.
+        :param errors: Список, в который добавляются ошибки по документам.
+        :return: Кол-во отказов 429: отклоненных запросов и документов.
+        """
+        rejected = 0
+        for attempt in range(self.bulk_max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.bulk_initial_backoff * 2 ** (attempt - 1))
+            last_attempt = attempt == self.bulk_max_retries
+            retry_ids = []
+            attempt_errors = []
+            try:
+                async for ok, item in helpers.async_streaming_bulk(
+                        self.bulk_es,
+                        chunk,
+                        chunk_size=len(chunk),
+                        max_chunk_bytes=self.bulk_max_chunk_bytes,
+                        max_retries=0,
+                        raise_on_error=False,
+                        yield_ok=False,
+                ):
+                    info = next(iter(item.values()))
+                    if info.get('status') == 429 and not last_attempt:
+                        retry_ids.append(info['_id'])
+                    else:
+                        attempt_errors.append(item)
+            except ApiError as e:
+                if e.status_code != 429 or last_attempt:
+                    raise
+                rejected += 1
+                metrics.inc('es_bulk_rejected')
+                continue
+
+            errors.extend(attempt_errors)
+            if not retry_ids:
+                break
+            rejected += len(retry_ids)
+            metrics.inc('es_bulk_rejected', len(retry_ids))
+            retry_ids = set(retry_ids)
+            chunk = [action for action in chunk if action['_id'] in retry_ids]
+        return rejected
+
+    def iter_index_actions(self, load_data: OfferBatch | Iterable[dict]) -> Iterator[dict]:
+        """
+        Формирует bulk действия прямо из столбцов пачки товаров, словари товаров сначала собираются в OfferBatch.
+        Документ сразу сериализуется в JSON байты, это быстрее сериализатора клиента и дает объем загрузки.
+        """
+        return self._index_actions(as_offer_batch(load_data).iter_rows(INDEX_FIELDS))
+
+    def _index_actions(self, rows: Iterable[tuple]) -> Iterator[dict]:
+        """Формирует bulk действия из кортежей значений полей INDEX_FIELDS."""
+        for row in rows:
+            yield {
+                "_index": self.index_name,
+                "_id": row[0],
+                "_source": fast_json_bytes(dict(zip(INDEX_FIELDS, row)))
+            }
+
+    async def load_data_to_elasticsearch(self, load_data: OfferBatch | list) -> None:
+        """Загружает товары в Elasticsearch, действия формируются по мере отправки."""
+        await self._load_actions(self.iter_index_actions(load_data))
+
+    async def load_index_columns(self, columns: dict) -> None:
+        """
+        Загружает документы из словаря столбец -> список значений со столбцами INDEX_FIELDS, например пачку из бд.
+        uuid должен быть строкой.
+        """
+        await self._load_actions(self._index_actions(zip(*(columns[field] for field in INDEX_FIELDS))))
+
+    async def _load_actions(self, actions: Iterable) -> None:
+        """
+        Отправляет действия индексации. Если Elasticsearch отклонил документы, вызывает helpers.BulkIndexError,
+        чтобы вызывающий код не считал их загруженными (не сохранял точку продолжения, не помечал индекс).
+        """
+        errors = await self.bulk(actions)
+        if errors:
+            print(f"Ошибки в документах: {errors[:10]}")
+            raise helpers.BulkIndexError(f"Ошибка при загрузке данных в индекс: {len(errors)} документов не загружено.",
+                                         errors)
+
+    def _more_like_this_body(self, product_uuid: str, size: int, scope: dict = None) -> dict:
+        """
+        Формирует тело more_like_this запроса для товара.
+
+        :param scope: Поле -> значение фильтра области поиска, None - весь каталог.
+        """
+        query = {
+            "more_like_this": {
+                "fields": ["title", "description"],
+                "like": [
+                    {
+                        "_index": self.index_name,
+                        "_id": product_uuid
+                    }
+                ],
+                "min_term_freq": 1,
+                "max_query_terms": 12,
+            }
+        }
+        if scope is not None:
+            # Фильтр не влияет на оценку и кешируется Elasticsearch между запросами
+            query = {"bool": {"must": query, "filter": [{"term": scope}]}}
+        return {"query": query, "size": size}
+
+    async def find_similar_products(self, product_uuid: str, size: int = 5) -> list:
+        """Находит похожие товары по ID товара, одновременно выполняется не больше search_concurrency запросов."""
+        if self.category_scope:
+            return (await self._find_similar_group([str(product_uuid)], size))[str(product_uuid)]
+        try:
+            async with self._search_limit:
+                with metrics.timer('es_mlt', items=1):
+                    response = await self.es.search(index=self.index_name,
+                                                    body=self._more_like_this_body(product_uuid, size))
+            similar_uuids = [hit['_source']['uuid'] for hit in response['hits']['hits']]
+            return similar_uuids
+
+        except NotFoundError:
+            print(f"Товар с UID {product_uuid} не найден.")
+            return []
+        except ApiError as e:
+            print(f"Ошибка во время поиска похожего товара: {e}")
+            return []
+
+    async def find_similar_products_batch(self, product_uuids: list, size: int = 5, batch_size: int = 500) -> dict:
+        """
+            Находит похожие товары для списка товаров, отправляя more_like_this запросы группами через _msearch.
+            Группы выполняются одновременно, не больше search_concurrency запросов.
+
+            :param product_uuids: Список ID товаров.
+            :param size: Кол-во похожих товаров для каждого товара.
+            :param batch_size: Кол-во запросов в одном _msearch.
+            :return: Словарь uuid -> список uuid похожих товаров в порядке product_uuids.
+                Товары с ошибкой получают пустой список.
+        """
+        groups = [[str(product_uuid) for product_uuid in product_uuids[start:start + batch_size]]
+                  for start in range(0, len(product_uuids), batch_size)]
+        similar = {}
+        for group_similar in await asyncio.gather(*(self._find_similar_group(group, size) for group in groups)):
+            similar.update(group_similar)
+        return similar
+
+    async def _find_similar_group(self, group: list, size: int) -> dict:
+        """
+        Находит похожие товары группы. Без category_scope - одним _msearch по всему каталогу.
+        С category_scope каждый шаг расширения области - один _msearch по товарам, которым не хватило результатов.
+        """
+        if not self.category_scope:
+            found = await self._msearch_similar([(product_uuid, None) for product_uuid in group], size)
+            return {product_uuid: hits or [] for product_uuid, hits in found.items()}
+
+        scopes = await self._category_scopes(group)
+        min_hits = min(self.category_min_hits or size, size)
+        similar = {product_uuid: [] for product_uuid in group}
+        pending = list(group)
+        step = 0
+        while pending:
+            found = await self._msearch_similar([(product_uuid, scopes[product_uuid][step])
+                                                 for product_uuid in pending], size)
+            widen = []
+            for product_uuid in pending:
+                hits = found[product_uuid]
+                if hits is None:
+                    continue
+                product_similar = similar[product_uuid]
+                product_similar.extend(hit for hit in hits
+                                       if hit not in product_similar and len(product_similar) < size)
+                if len(product_similar) < min_hits and step + 1 < len(scopes[product_uuid]):
+                    widen.append(product_uuid)
+            pending = widen
+            step += 1
+        return similar
+
+    async def _category_scopes(self, group: list) -> dict:
+        """
+        Читает категории товаров группы одним _mget.
+
+        :return: Словарь uuid -> список фильтров области поиска от узкой к широкой, последний None - весь каталог.
+        """
+        scopes = {product_uuid: [None] for product_uuid in group}
+        try:
+            async with self._search_limit:
+                response = await self.es.mget(index=self.index_name, ids=group,
+                                              source_includes=list(CATEGORY_SCOPE_FIELDS))
+        except ApiError as e:
+            print(f"Ошибка при чтении категорий товаров, поиск по всему каталогу: {e}")
+            return scopes
+
+        for doc in response['docs']:
+            if not doc.get('found'):
+                continue
+            source = doc.get('_source') or {}
+            # Пустые уровни и категория 0 (categoryId нет в фиде) не сужают поиск
+            scopes[doc['_id']] = [{field: source[field]} for field in CATEGORY_SCOPE_FIELDS
+                                  if source.get(field)] + [None]
+        return scopes
+
+    async def _msearch_similar(self, searches: list, size: int) -> dict:
+        """
+        Выполняет more_like_this запросы одним _msearch.
+
+        :param searches: Список пар (uuid товара, фильтр области поиска или None).
+        :return: Словарь uuid -> список uuid похожих товаров. Товары с ошибкой получают None
+            при ошибке всего запроса и пустой список при ошибке своего запроса.
+        """
+        body = []
+        for product_uuid, scope in searches:
+            body.append({"index": self.index_name})
+            body.append(self._more_like_this_body(product_uuid, size, scope))
+
+        try:
+            async with self._search_limit:
+                with metrics.timer('es_mlt', items=len(searches)):
+                    responses = (await self.es.msearch(searches=body))['responses']
+        except ApiError as e:
+            print(f"Ошибка во время группового поиска похожих товаров: {e}")
+            return {product_uuid: None for product_uuid, scope in searches}
+
+        similar = {}
+        for (product_uuid, scope), response in zip(searches, responses):
+            if 'error' in response:
+                print(f"Ошибка во время поиска похожего товара {product_uuid}: {response['error']}")
+                similar[product_uuid] = []
+                continue
+            similar[product_uuid] = [hit['_source']['uuid'] for hit in response['hits']['hits']]
+        return similar
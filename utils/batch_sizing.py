@@ -0,0 +1,132 @@
+import os
+import threading
+
+from .metrics import metrics
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def process_rss_bytes() -> int | None:
+    """Возвращает резидентную память процесса из /proc/self/statm, None - если /proc недоступен."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class AdaptiveBatchSizer:
+    """
+    Размер пачки, подстраиваемый по наблюдаемой длительности пачек (AIMD).
+
+    Пока полные пачки обрабатываются быстрее target_seconds, размер растет на increase_step: крупные пачки
+    дешевле по накладным расходам на запрос. Если пачка дольше target_seconds * tolerance, размер уменьшается
+    пропорционально превышению, при ответах 429 и RSS выше memory_limit - в decrease_factor раз.
+    При известном объеме пачки размер ограничивается max_batch_bytes.
+
+    Объект подставляется вместо целого размера пачки: int(sizer) - текущий размер.
+    Изменения размера выводятся в лог и в метрику <name>_batch_size.
+    """
+
+    def __init__(self, name: str, initial: int, min_size: int = None, max_size: int = None,
+                 target_seconds: float = 2.0, memory_limit: int = None, max_batch_bytes: int = None,
+                 increase_step: int = None, decrease_factor: float = 0.5, tolerance: float = 1.5):
+        """
+        :param name: Имя пачек в логе и метриках.
+        :param initial: Начальный размер.
+        :param min_size: Минимальный размер, по умолчанию initial // 20.
+        :param max_size: Максимальный размер, по умолчанию initial * 10.
+        :param target_seconds: Желаемая длительность обработки пачки, сек.
+        :param memory_limit: Потолок RSS процесса в байтах, None - не учитывать память.
+        :param max_batch_bytes: Максимальный объем пачки в байтах, None - без ограничения.
+        :param increase_step: Шаг увеличения, по умолчанию initial // 4.
+        :param decrease_factor: Во сколько раз уменьшать размер при 429 и нехватке памяти.
+        :param tolerance: Во сколько раз длительность пачки может превысить target_seconds без уменьшения.
+        """
+        self.name = name
+        self.min_size = max(1, min_size or initial // 20)
+        self.max_size = max(self.min_size, max_size or initial * 10)
+        self.size = min(max(initial, self.min_size), self.max_size)
+        self.target_seconds = target_seconds
+        self.memory_limit = memory_limit
+        self.max_batch_bytes = max_batch_bytes
+        self.increase_step = max(1, increase_step or initial // 4)
+        self.decrease_factor = decrease_factor
+        self.tolerance = tolerance
+
+        self._logged_size = self.size
+        self._lock = threading.Lock()
+        metrics.set_gauge(f'{self.name}_batch_size', self.size)
+
+    def __int__(self) -> int:
+        return self.size
+
+    __index__ = __int__
+
+    def __repr__(self) -> str:
+        return f'AdaptiveBatchSizer({self.name!r}, size={self.size})'
+
+    def __getstate__(self) -> dict:
+        # Блокировка не передается в процессы пула, каждый процесс подстраивает свою копию
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def record(self, items: int, seconds: float, nbytes: int = None, rejected: int = 0) -> int:
+        """
+        Учитывает обработанную пачку и пересчитывает размер.
+
+        :param items: Кол-во записей в пачке.
+        :param seconds: Длительность обработки пачки, сек.
+        :param nbytes: Объем пачки в байтах.
+        :param rejected: Кол-во отказов 429 при обработке пачки.
+        :return: Новый размер.
+        """
+        if items <= 0:
+            return self.size
+        rss = process_rss_bytes() if self.memory_limit else None
+        if rss is not None:
+            metrics.set_gauge('process_rss_bytes', rss)
+
+        with self._lock:
+            size = self.size
+            reason = None
+            # Размер уменьшается от размера обработанной пачки: пачки, начатые до прошлого уменьшения,
+            # не уменьшают его повторно
+            if rejected:
+                size = min(size, int(items * self.decrease_factor))
+                reason = f'{rejected} отказов 429'
+            elif rss is not None and rss > self.memory_limit:
+                size = int(size * self.decrease_factor)
+                reason = f'RSS {rss >> 20} МБ выше {self.memory_limit >> 20} МБ'
+            elif seconds > self.target_seconds * self.tolerance:
+                size = min(size, int(items * self.target_seconds / seconds))
+                reason = f'пачка {items} за {seconds:.2f} с'
+            elif seconds < self.target_seconds and items >= size * 0.9 and \
+                    (rss is None or rss < self.memory_limit * 0.9):
+                size += self.increase_step
+
+            if nbytes and self.max_batch_bytes:
+                bytes_limit = int(self.max_batch_bytes * items / nbytes)
+                if bytes_limit < size:
+                    size = bytes_limit
+                    reason = reason or f'{nbytes >> 10} КБ на {items} записей'
+            size = min(max(size, self.min_size), self.max_size)
+
+            if size != self.size:
+                self._set_size(size, reason)
+            return self.size
+
+    def _set_size(self, size: int, reason: str | None) -> None:
+        self.size = size
+        metrics.set_gauge(f'{self.name}_batch_size', size)
+        # Уменьшения выводятся всегда, рост - при изменении в полтора раза с прошлого вывода
+        if reason is not None or size >= self._logged_size * 1.5:
+            print(f'->Размер пачки {self.name}: {self._logged_size} -> {size}'
+                  f'{f" ({reason})" if reason else ""} <-')
+            self._logged_size = size
+
@@ -1,4 +1,6 @@
 import logging
+import os
+import time
 
 import pandas as pd
 import sqlalchemy as sa
@@ -6,11 +8,56 @@ from sqlalchemy.exc import ResourceClosedError
 from sqlalchemy import text
 
 from .sql_processor import SQLProcessor
-from .additional_utils import post_processing_offer_df
+from .batch_sizing import AdaptiveBatchSizer
+from .metrics import metrics
+from .offer_batch import OfferBatch, as_offer_batch
 
 sql_processor = SQLProcessor()
 logger = logging.getLogger()
 
+POOL_SETTINGS_KEYS = {
+    'psql_pool_size': ('pool_size', int),
+    'psql_max_overflow': ('max_overflow', int),
+    'psql_pool_pre_ping': ('pool_pre_ping', lambda value: str(value).lower() in ('1', 'true', 'yes')),
+    'psql_pool_recycle': ('pool_recycle', int),
+}
+
+
+def get_db_url(config: dict) -> str:
+    """Собирает url соединения с бд из конфига."""
+    return (
+        f'{config["psql_conn_type"]}ql+psycopg2://'
+        f'{config["psql_login"]}:{config["psql_password"]}'
+        f'@{config["psql_hostname"]}:{config["psql_port"]}'
+        f'/{config["psql_name_bd"]}'
+    )
+
+
+def get_pool_settings(config: dict) -> dict:
+    """Возвращает заданные в конфиге настройки пула соединений для sa.create_engine."""
+    pool_settings = {}
+    for config_key, (engine_key, cast) in POOL_SETTINGS_KEYS.items():
+        if config.get(config_key) not in (None, ''):
+            pool_settings[engine_key] = cast(config[config_key])
+    return pool_settings
+
+
+def use_prepared_statements(config: dict) -> bool:
+    """Выполнять ли параметризованные запросы серверными prepared statements, по умолчанию да.
+    Выключается для пулеров в режиме транзакций (pgbouncer), где соединение сервера меняется между запросами."""
+    value = config.get('psql_prepared_statements')
+    return value in (None, '') or str(value).lower() in ('1', 'true', 'yes')
+
+
+def db_connect(config: dict):
+    """Контекстный менеджер соединения из общего пула процесса."""
+    return sql_processor.connect(get_db_url(config), **get_pool_settings(config))
+
+
+def db_begin(config: dict):
+    """Контекстный менеджер соединения с транзакцией из общего пула процесса."""
+    return sql_processor.begin(get_db_url(config), **get_pool_settings(config))
+
 
 def load_data_from_bd(config: dict,
                       name_sql_file: str,
@@ -23,12 +70,6 @@ def load_data_from_bd(config: dict,
                       expanding: bool = True) -> bool | pd.DataFrame:
     try:
         print(f'->Выполняем подключение к бд и выгрузку из таблицы - {schema}.{table_name} <-')
-        sql_processor.extract_settings_url = (
-            f'{config["psql_conn_type"]}ql+psycopg2://'
-            f'{config["psql_login"]}:{config["psql_password"]}'
-            f'@{config["psql_hostname"]}:{config["psql_port"]}'
-            f'/{config["psql_name_bd"]}'
-        )
 
         extract_query = sql_processor.get_query_from_sql_file(
             name_sql_file,
@@ -39,8 +80,7 @@ def load_data_from_bd(config: dict,
             expanding=expanding,
         )
 
-        sql_processor.create_extract_engine()
-        with sql_processor.extract_settings_connect() as connection:
+        with db_connect(config) as connection:
             try:
                 data = sql_processor.extract_data_sql(
                     extract_query,
@@ -60,25 +100,32 @@ def load_data_from_bd(config: dict,
         raise e
 
 
-def load_data_in_db(df: pd.DataFrame,
+def load_data_in_db(df: pd.DataFrame | OfferBatch,
                     config: dict,
                     schema: str,
                     name_table_in_db: str,
                     exists='append',
                     index=False,
+                    method: str = 'to_sql',
                     ):
     try:
         print(f'->Вставляем записи в таблицу - {schema}.{name_table_in_db}  <-')
 
-        sql_processor.load_settings_url = (
-            f'{config["psql_conn_type"]}ql+psycopg2://'
-            f'{config["psql_login"]}:{config["psql_password"]}'
-            f'@{config["psql_hostname"]}:{config["psql_port"]}'
-            f'/{config["psql_name_bd"]}'
-        )
+        if method == 'copy' and not index and exists == 'append':
+            with metrics.timer('pg_load', items=len(df)), db_begin(config) as connection:
+                if isinstance(df, OfferBatch):
+                    # COPY читает строки прямо из столбцов пачки
+                    sql_processor.copy_rows_sql(df.iter_rows(), list(df.column_names), name_table_in_db,
+                                                schema=schema, connection=connection)
+                else:
+                    sql_processor.load_data_copy(df, name_table_in_db, schema=schema, connection=connection)
+                print(f'->Записи в таблице - {schema}.{name_table_in_db} созданы через COPY <-')
+            return
+
+        if isinstance(df, OfferBatch):
+            df = df.to_frame()
 
-        sql_processor.create_load_engine()
-        with sql_processor.load_settings_connect() as connection:
+        with metrics.timer('pg_load', items=len(df)), db_connect(config) as connection:
             sql_processor.load_data_sql(df, name_table_in_db, exists, connection=connection, index=index, schema=schema)
             print(f'->Записи в таблице - {schema}.{name_table_in_db} созданы <-')
 
@@ -99,13 +146,6 @@ def update_solo_data_in_db(config: dict,
     try:
         print(f'->Обновляем записи в таблицу - {schema}.{table_name}  <-')
 
-        sql_processor.extract_settings_url  = (
-            f'{config["psql_conn_type"]}ql+psycopg2://'
-            f'{config["psql_login"]}:{config["psql_password"]}'
-            f'@{config["psql_hostname"]}:{config["psql_port"]}'
-            f'/{config["psql_name_bd"]}'
-        )
-
         update_query = sql_processor.get_query_from_sql_file(
             name_sql_file,
             base_dir,
@@ -115,8 +155,7 @@ def update_solo_data_in_db(config: dict,
             expanding=expanding,
         )
 
-        sql_processor.create_extract_engine()
-        with sql_processor.extract_settings_connect() as connection:
+        with db_connect(config) as connection:
             try:
                 sql_processor.extract_data_sql(
                     update_query,
@@ -134,15 +173,254 @@ def update_solo_data_in_db(config: dict,
         raise e
 
 
-def batch_df_in_db(batch_data: list,
+def update_similar_sku_bulk(similar_by_uuid: dict,
+                            config: dict,
+                            base_dir: str,
+                            schema: str,
+                            table_name: str,
+                            name_sql_file: str = 'update_similar_sku_bulk.sql',
+                            name_sql_dir: str = 'sql_query_files',
+                            page_size: int = 1000) -> int:
+    """
+        Записывает похожие товары для целого чанка одной транзакцией, запрос обновляет страницу
+        из page_size товаров, переданную массивами uuid и литералов массивов похожих uuid.
+
+        :param similar_by_uuid: Словарь uuid -> список uuid похожих товаров.
+        :return: Кол-во переданных на обновление товаров.
+    """
+    rows = [(str(product_uuid), sql_processor.prepared_value([str(similar) for similar in similar_uuids]))
+            for product_uuid, similar_uuids in similar_by_uuid.items() if similar_uuids]
+    if not rows:
+        return 0
+
+    try:
+        print(f'->Обновляем {len(rows)} записей в таблице - {schema}.{table_name}  <-')
+
+        with metrics.timer('similar_update', items=len(rows)), db_begin(config) as connection:
+            for start in range(0, len(rows), page_size):
+                uuids, similar_skus = zip(*rows[start:start + page_size])
+                execute_query(connection, config, name_sql_file, base_dir, params_names=(schema, table_name),
+                              params_values={'uuids': list(uuids), 'similar_skus': list(similar_skus)},
+                              name_sql_dir=name_sql_dir)
+            print(f'->Обновление таблицы - {schema}.{table_name} - успешно <-')
+        return len(rows)
+
+    except Exception as e:
+        logger.error(f'->Ошибка {e} при обновлении данных в таблице - {schema}.{table_name} <-')
+        raise e
+
+
+def batch_df_in_db(batch_data: OfferBatch | list,
                    config: dict,
                    schema: str,
                    name_table_in_db: str,
                    exists='append',
-                   index=False) -> None:
-    df = post_processing_offer_df(pd.DataFrame(batch_data))
-    load_data_in_db(df, config, schema, name_table_in_db, exists, index)
-    batch_data.clear()
+                   index=False,
+                   method: str = 'to_sql') -> None:
+    """
+        Загружает пачку товаров в бд. Пачка не меняется, поэтому ее можно одновременно передать другим получателям.
+
+        :param batch_data: OfferBatch или список словарей товаров, который сначала собирается в OfferBatch.
+    """
+    load_data_in_db(as_offer_batch(batch_data), config, schema, name_table_in_db, exists, index, method)
+
+
+def execute_query(connection: sa.engine.Connection,
+                  config: dict,
+                  name_sql_file: str,
+                  base_dir: str,
+                  params_names: object = None,
+                  params_values: dict = None,
+                  name_sql_dir: str = 'sql_query_files',
+                  expanding: bool = False) -> list:
+    """
+        Выполняет запрос из SQL-файла в переданном соединении.
+
+        Запрос с параметрами без expanding выполняется серверным prepared statement соединения,
+        если они не выключены в конфиге (psql_prepared_statements).
+
+        :return: Строки результата, если запрос их возвращает, иначе пустой список.
+    """
+    registry = sql_processor.query_registry(os.path.join(base_dir, name_sql_dir))
+    if params_values and not expanding and use_prepared_statements(config):
+        cursor = sql_processor.execute_prepared(connection, registry.prepared(name_sql_file, params_names),
+                                                params_values)
+        return cursor.fetchall() if cursor.description is not None else []
+
+    query = registry.get(name_sql_file, params_names, params_values, expanding)
+    if isinstance(query, str):
+        query = text(query)
+    result = connection.execute(query, params_values or {})
+    return result.fetchall() if result.returns_rows else []
+
+
+def execute_sql_file(config: dict,
+                     name_sql_file: str,
+                     base_dir: str,
+                     schema: str,
+                     table_name: str,
+                     params_names: object = None,
+                     params_values: object = None,
+                     name_sql_dir: str = 'sql_query_files',
+                     expanding: bool = True) -> list:
+    """
+        Выполняет запрос из SQL-файла в отдельной транзакции, см. execute_query.
+
+        :return: Строки результата, если запрос их возвращает, иначе пустой список.
+    """
+    try:
+        with db_begin(config) as connection:
+            return execute_query(connection, config, name_sql_file, base_dir, params_names, params_values,
+                                 name_sql_dir, expanding)
+
+    except Exception as e:
+        logger.error(f'->Ошибка {e} при выполнении {name_sql_file} для таблицы - {schema}.{table_name} <-')
+        raise e
+
+
+def _match_stored_offers(batch: OfferBatch,
+                         config: dict,
+                         base_dir: str,
+                         schema: str,
+                         table_name: str,
+                         name_sql_dir: str) -> tuple:
+    """
+        Сопоставляет товары пачки с товарами в бд по (marketplace_id, product_id).
+
+        :return: Кортеж (номера товаров без дублей - последние вхождения, номера новых и изменившихся товаров,
+            номер товара -> uuid существующего в бд товара).
+    """
+    offers = {}
+    for index, key in enumerate(batch.iter_rows(('marketplace_id', 'product_id'))):
+        offers[key] = index
+    if not offers:
+        return [], [], {}
+
+    marketplace_ids, product_ids = zip(*offers)
+    with metrics.timer('delta_lookup', items=len(offers)):
+        rows = execute_sql_file(
+            config,
+            'select_sku_content_hash.sql',
+            base_dir,
+            schema,
+            table_name,
+            params_names=(schema, table_name),
+            params_values={'marketplace_ids': list(marketplace_ids), 'product_ids': list(product_ids)},
+            name_sql_dir=name_sql_dir,
+            expanding=False,
+        )
+
+    stored = {(row.marketplace_id, row.product_id): row for row in rows}
+    content_hashes = batch['content_hash']
+    changed = []
+    stored_uuids = {}
+    for key, index in offers.items():
+        row = stored.get(key)
+        if row is None:
+            changed.append(index)
+            continue
+        stored_uuids[index] = str(row.uuid)
+        if row.content_hash != content_hashes[index]:
+            changed.append(index)
+    return list(offers.values()), changed, stored_uuids
+
+
+def _take_offers(batch: OfferBatch, indices: list, stored_uuids: dict) -> OfferBatch:
+    """Возвращает новую пачку из товаров с номерами indices, существующим в бд товарам - их uuid из бд."""
+    offers = batch.take(indices)
+    uuids = offers['uuid']
+    for position, index in enumerate(indices):
+        if index in stored_uuids:
+            uuids[position] = stored_uuids[index]
+    return offers
+
+
+def select_changed_offers(batch_data: OfferBatch | list,
+                          config: dict,
+                          base_dir: str,
+                          schema: str,
+                          table_name: str,
+                          name_sql_dir: str = 'sql_query_files') -> OfferBatch:
+    """
+        Отбирает из пачки новые товары и товары с изменившимся content_hash.
+
+        Дубли по (marketplace_id, product_id) схлопываются до последнего вхождения.
+        Уже существующим в бд товарам возвращается их текущий uuid.
+
+        :param batch_data: Пачка товаров в режиме дельта-загрузки.
+        :return: Новая пачка товаров, которые нужно записать.
+    """
+    batch = as_offer_batch(batch_data)
+    offers, changed, stored_uuids = _match_stored_offers(batch, config, base_dir, schema, table_name, name_sql_dir)
+    return _take_offers(batch, changed, stored_uuids)
+
+
+def split_changed_offers(batch_data: OfferBatch | list,
+                         config: dict,
+                         base_dir: str,
+                         schema: str,
+                         table_name: str,
+                         name_sql_dir: str = 'sql_query_files') -> tuple:
+    """
+        Как select_changed_offers, но возвращает и все товары пачки без дублей с uuid из бд у существующих товаров.
+
+        :param batch_data: Пачка товаров в режиме дельта-загрузки.
+        :return: Кортеж (все товары, новые и изменившиеся товары).
+    """
+    batch = as_offer_batch(batch_data)
+    offers, changed, stored_uuids = _match_stored_offers(batch, config, base_dir, schema, table_name, name_sql_dir)
+    return _take_offers(batch, offers, stored_uuids), _take_offers(batch, changed, stored_uuids)
+
+
+def upsert_offers_in_db(batch_data: OfferBatch | list,
+                        config: dict,
+                        base_dir: str,
+                        schema: str,
+                        table_name: str,
+                        name_sql_dir: str = 'sql_query_files') -> int:
+    """
+        Записывает товары через COPY во временную таблицу и INSERT ... ON CONFLICT DO UPDATE.
+
+        Существующие строки обновляются только при изменившемся content_hash, uuid и similar_sku не меняются.
+
+        :param batch_data: Пачка товаров в режиме дельта-загрузки.
+        :return: Кол-во переданных товаров.
+    """
+    batch_data = as_offer_batch(batch_data)
+    if not batch_data:
+        return 0
+
+    try:
+        print(f'->Дельта-загрузка {len(batch_data)} записей в таблицу - {schema}.{table_name}  <-')
+
+        columns = list(batch_data.column_names)
+        update_columns = ', '.join(f'{column} = EXCLUDED.{column}' for column in columns
+                                   if column not in ('uuid', 'similar_sku', 'marketplace_id', 'product_id'))
+        params_names = {'schema': schema, 'table': table_name, 'columns': ', '.join(columns),
+                        'update_columns': update_columns}
+
+        create_query = sql_processor.get_query_from_sql_file(
+            'create_sku_delta.sql', base_dir, query_dir=name_sql_dir, params_names=params_names,
+        )
+        upsert_query = sql_processor.get_query_from_sql_file(
+            'upsert_sku_delta.sql', base_dir, query_dir=name_sql_dir, params_names=params_names,
+        )
+
+        with metrics.timer('pg_upsert', items=len(batch_data)), db_begin(config) as connection:
+            connection.execute(text(create_query))
+            sql_processor.copy_rows_sql(
+                batch_data.iter_rows(columns),
+                columns,
+                'sku_delta',
+                connection=connection,
+            )
+            connection.execute(text(upsert_query))
+            print(f'->Дельта-загрузка в таблицу - {schema}.{table_name} - успешна <-')
+        return len(batch_data)
+
+    except Exception as e:
+        logger.error(f'->Ошибка {e} при дельта-загрузке данных в таблицу - {schema}.{table_name} <-')
+        raise e
 
 
 def load_data_from_bd_chunk_function(config: dict,
@@ -151,22 +429,26 @@ def load_data_from_bd_chunk_function(config: dict,
                                      schema: str,
                                      table_name: str,
                                      process_function: callable,
-                                     chunk_size: int = 30000,
+                                     chunk_size: int | AdaptiveBatchSizer = 30000,
                                      params_names: object = None,
                                      params_values: object = None,
                                      name_sql_dir: str = 'sql_query_files',
                                      expanding: bool = True,
+                                     as_frame: bool = False,
                                      *args, **kwargs) -> None:
+    """
+    Читает результат запроса серверным курсором и передает пачки в process_function.
+
+    Память клиента ограничена одной пачкой независимо от размера таблицы.
+
+    :param process_function: Функция, принимающая пачку, и *args, **kwargs.
+    :param chunk_size: Кол-во строк в пачке или AdaptiveBatchSizer, которому передается длительность
+        process_function для каждой пачки.
+    :param as_frame: Передавать пачки DataFrame, по умолчанию словарь столбец -> список значений.
+    """
     try:
         print(f'->Выполняем подключение к бд и выгрузку из таблицы - {schema}.{table_name} <-')
 
-        sql_processor.extract_settings_url = (
-            f'{config["psql_conn_type"]}ql+psycopg2://'
-            f'{config["psql_login"]}:{config["psql_password"]}'
-            f'@{config["psql_hostname"]}:{config["psql_port"]}'
-            f'/{config["psql_name_bd"]}'
-        )
-
         extract_data_sql_query = sql_processor.get_query_from_sql_file(
             name_sql_file,
             base_dir,
@@ -176,13 +458,17 @@ def load_data_from_bd_chunk_function(config: dict,
             expanding=expanding,
         )
 
-        sql_processor.create_extract_engine()
-        with sql_processor.extract_settings_connect() as connection:
-            for chunk_df in sql_processor.extract_data_sql(extract_data_sql_query,
-                                                           params=params_values,
-                                                           connection=connection,
-                                                           chunksize=chunk_size):
-                process_function(chunk_df, *args, **kwargs)
+        with db_connect(config) as connection:
+            for chunk in sql_processor.stream_data_sql(extract_data_sql_query,
+                                                       params=params_values,
+                                                       connection=connection,
+                                                       chunksize=chunk_size,
+                                                       as_frame=as_frame):
+                started = time.perf_counter()
+                process_function(chunk, *args, **kwargs)
+                if isinstance(chunk_size, AdaptiveBatchSizer):
+                    rows = len(chunk) if as_frame else len(next(iter(chunk.values()), ()))
+                    chunk_size.record(rows, time.perf_counter() - started)
 
     except Exception as e:
         print(f'->Ошибка {e} при выгрузке данных из таблицы - {schema}.{table_name} <-')
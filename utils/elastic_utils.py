@@ -1,84 +1,175 @@
-import pandas as pd
-from elasticsearch import Elasticsearch, NotFoundError, ApiError, helpers
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Any, Coroutine, Iterator
 
-from .additional_utils import post_processing_offer_df
+from elasticsearch import Elasticsearch, ApiError, helpers
+
+from .async_elastic_utils import AsyncSimilarProductsESUpdater, EventLoopThread, INDEX_FIELDS
+from .batch_sizing import AdaptiveBatchSizer
+from .offer_batch import OfferBatch
 
 
 class SimilarProductsESUpdater:
-    def __init__(self, index_name: str, elastic_host: str, elastic_port: str, elastic_pass: str):
+    """
+    Синхронный интерфейс поиска похожих товаров и загрузки индекса.
+
+    Поиск и загрузка выполняются AsyncSimilarProductsESUpdater (атрибут async_updater) в постоянном цикле событий
+    фонового потока, управление индексом - синхронным клиентом es.
+    """
+
+    def __init__(self, index_name: str, elastic_host: str, elastic_port: str, elastic_pass: str,
+                 bulk_threads: int = 4, bulk_chunk_size: int | AdaptiveBatchSizer = 500,
+                 bulk_max_chunk_bytes: int = 10 << 20, bulk_max_retries: int = 5, bulk_initial_backoff: float = 2,
+                 search_concurrency: int = 4, category_scope: bool = False, category_min_hits: int = 0):
+        """
+        :param bulk_threads: Максимум одновременных bulk запросов.
+        :param bulk_chunk_size: Максимум документов в одном bulk запросе или AdaptiveBatchSizer.
+        :param bulk_max_chunk_bytes: Максимальный размер bulk запроса в байтах.
+        :param bulk_max_retries: Кол-во повторов чанка при ответе 429.
+        :param bulk_initial_backoff: Задержка перед первым повтором, сек., дальше удваивается.
+        :param search_concurrency: Максимум одновременных _msearch запросов поиска похожих товаров.
+        :param category_scope: Искать похожие товары в пределах категории товара с расширением области
+            при нехватке результатов, см. AsyncSimilarProductsESUpdater.
+        :param category_min_hits: Сколько похожих товаров достаточно, чтобы не расширять область поиска,
+            0 - запрошенное кол-во.
+        """
         self.es = Elasticsearch(
             [f"http://{elastic_host}:{elastic_port}"],
             basic_auth=('elastic', elastic_pass),
         )
         self.index_name = index_name
+        self.async_updater = AsyncSimilarProductsESUpdater(index_name, elastic_host, elastic_port, elastic_pass,
+                                                           bulk_concurrency=bulk_threads,
+                                                           search_concurrency=search_concurrency,
+                                                           bulk_chunk_size=bulk_chunk_size,
+                                                           bulk_max_chunk_bytes=bulk_max_chunk_bytes,
+                                                           bulk_max_retries=bulk_max_retries,
+                                                           bulk_initial_backoff=bulk_initial_backoff,
+                                                           category_scope=category_scope,
+                                                           category_min_hits=category_min_hits)
+        # В маппинг существующего индекса добавлены поля, которых нет в загруженных раньше документах
+        self.reindex_required = False
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        self._close_loop = None
+
+    def _run(self, coroutine: Coroutine) -> Any:
+        """Выполняет корутину async_updater в цикле событий, цикл запускается при первом вызове."""
+        with self._loop_lock:
+            if self._loop_thread is None:
+                self._loop_thread = EventLoopThread()
+                # Соединения закрываются и при выходе из программы без вызова close
+                self._close_loop = weakref.finalize(self, _close_async_updater, self._loop_thread,
+                                                    self.async_updater)
+        return self._loop_thread.run(coroutine)
+
+    def close(self) -> None:
+        """Закрывает соединения асинхронного клиента и останавливает цикл событий."""
+        with self._loop_lock:
+            if self._close_loop is not None:
+                self._close_loop()
+                self._loop_thread = self._close_loop = None
 
     def create_index(self) -> None:
-        """Создает индекс с заданным маппингом."""
-        mapping = {
-            "mappings": {
-                "properties": {
-                    "uuid": {"type": "keyword"},
-                    "title": {"type": "text"},
-                    "description": {"type": "text"},
-                }
-            }
+        """
+        Создает индекс с заданным маппингом, тексты товаров анализируются русским анализатором.
+        Категории и бренд индексируются как keyword, цена - числом, по ним фильтруется поиск похожих товаров.
+
+        Поля, которые есть во всех документах, записываются в _meta.index_fields маппинга. В существующий индекс
+        без части полей INDEX_FIELDS они добавляются, а reindex_required становится True: старые документы
+        получат поля только после перезагрузки всех товаров, см. mark_reindexed.
+        """
+        properties = {
+            "uuid": {"type": "keyword"},
+            "title": {"type": "text", "analyzer": "russian"},
+            "description": {"type": "text", "analyzer": "russian"},
+            "brand": {"type": "keyword"},
+            "price_after_discounts": {"type": "scaled_float", "scaling_factor": 100},
+            "category_id": {"type": "keyword"},
+            "category_lvl_1": {"type": "keyword"},
+            "category_lvl_2": {"type": "keyword"},
+            "category_lvl_3": {"type": "keyword"},
         }
 
         if not self.es.indices.exists(index=self.index_name):
-            self.es.indices.create(index=self.index_name, body=mapping)
+            self.es.indices.create(index=self.index_name, body={
+                "mappings": {"_meta": {"index_fields": list(INDEX_FIELDS)}, "properties": properties}
+            })
             print(f"Индекс '{self.index_name}' создан.")
-        else:
-            print(f"Индекс '{self.index_name}' уже существует.")
-
-    def load_data_to_elasticsearch(self, load_data: list) -> None:
-        """Загружает данные из DataFrame в Elasticsearch."""
-        # Подготовка данных для загрузки
-        load_data_df = post_processing_offer_df(pd.DataFrame(load_data))
-
-        actions = []
-        for _, product in load_data_df.iterrows():
-            action = {
-                "_index": self.index_name,
-                "_id": product.uuid,
-                "_source": {
-                    'title': product.title,
-                    'description': product.description,
-                    'uuid': product.uuid
-                }
-            }
-            actions.append(action)
+            return
+
+        print(f"Индекс '{self.index_name}' уже существует.")
+        mapping = self.es.indices.get_mapping(index=self.index_name)[self.index_name]['mappings']
+        # Индекс без отметки создан до полей фильтров, его документы содержат только тексты
+        indexed_fields = mapping.get('_meta', {}).get('index_fields', ('uuid', 'title', 'description'))
+        self.reindex_required = not set(INDEX_FIELDS) <= set(indexed_fields)
+        if self.reindex_required:
+            self.es.indices.put_mapping(index=self.index_name, properties=properties)
+            missing = ', '.join(field for field in INDEX_FIELDS if field not in indexed_fields)
+            print(f"В индекс '{self.index_name}' добавлены поля {missing}, документы без них нужно перезагрузить.")
+
+    def mark_reindexed(self) -> None:
+        """Отмечает в маппинге, что все документы индекса перезагружены и содержат поля INDEX_FIELDS."""
+        self.es.indices.put_mapping(index=self.index_name, meta={"index_fields": list(INDEX_FIELDS)})
+        self.reindex_required = False
 
+    @contextmanager
+    def bulk_ingest(self, max_num_segments: int = 1) -> Iterator[None]:
+        """
+        Режим массовой загрузки: на время загрузки отключает refresh и реплики индекса.
+        После загрузки восстанавливает настройки, обновляет индекс и запускает слияние сегментов.
+
+        :param max_num_segments: До скольких сегментов сливать индекс.
+        """
+        index_settings = self.es.indices.get_settings(index=self.index_name)[self.index_name]['settings']['index']
+        # Отсутствующие значения восстанавливаются как None, то есть сбрасываются к значениям по умолчанию
+        saved_settings = {
+            'refresh_interval': index_settings.get('refresh_interval'),
+            'number_of_replicas': index_settings.get('number_of_replicas'),
+        }
+        self.es.indices.put_settings(index=self.index_name,
+                                     settings={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
         try:
-            helpers.bulk(self.es, actions, raise_on_error=True)
-        except helpers.BulkIndexError as e:
-            print(f"Ошибка при загрузке данных в индекс: {e}")
-            print(f"Ошибки в документах: {e.errors}")
+            yield
+        finally:
+            self.es.indices.put_settings(index=self.index_name, settings={'index': saved_settings})
+
+        self.refresh_index()
+        # Слияние может идти долго, поиск по обновленному индексу доступен и во время него
+        self.es.indices.forcemerge(index=self.index_name, max_num_segments=max_num_segments,
+                                   wait_for_completion=False)
+
+    def load_data_to_elasticsearch(self, load_data: OfferBatch | list) -> None:
+        """Загружает товары в Elasticsearch, действия формируются по мере отправки."""
+        self._run(self.async_updater.load_data_to_elasticsearch(load_data))
+
+    def load_index_columns(self, columns: dict) -> None:
+        """Загружает документы из словаря столбец -> список значений, см. AsyncSimilarProductsESUpdater."""
+        self._run(self.async_updater.load_index_columns(columns))
+
+    def refresh_index(self) -> None:
+        """Делает последние изменения индекса видимыми для поиска."""
+        self.es.indices.refresh(index=self.index_name)
+
+    def delete_documents(self, product_uuids: list) -> None:
+        """Удаляет документы товаров из индекса, отсутствующие документы пропускаются."""
+        actions = ({"_op_type": "delete", "_index": self.index_name, "_id": str(product_uuid)}
+                   for product_uuid in product_uuids)
+        try:
+            helpers.bulk(self.es, actions, raise_on_error=False)
+        except ApiError as e:
+            print(f"Ошибка при удалении документов из индекса: {e}")
 
     def find_similar_products(self, product_uuid: str, size: int = 5) -> list:
         """Находит похожие товары по ID товара."""
-        try:
-            response = self.es.search(index=self.index_name, body={
-                "query": {
-                    "more_like_this": {
-                        "fields": ["title", "description"],
-                        "like": [
-                            {
-                                "_index": self.index_name,
-                                "_id": product_uuid
-                            }
-                        ],
-                        "min_term_freq": 1,
-                        "max_query_terms": 12,
-                    }
-                },
-                "size": size
-            })
-            similar_uuids = [hit['_source']['uuid'] for hit in response['hits']['hits']]
-            return similar_uuids
+        return self._run(self.async_updater.find_similar_products(product_uuid, size))
 
-        except NotFoundError:
-            print(f"Товар с UID {product_uuid} не найден.")
-            return []
-        except ApiError as e:
-            print(f"Ошибка во время поиска похожего товара: {e}")
-            return []
+    def find_similar_products_batch(self, product_uuids: list, size: int = 5, batch_size: int = 500) -> dict:
+        """Находит похожие товары для списка товаров, см. AsyncSimilarProductsESUpdater.find_similar_products_batch."""
+        return self._run(self.async_updater.find_similar_products_batch(product_uuids, size, batch_size))
+
+
+def _close_async_updater(loop_thread: EventLoopThread, async_updater: AsyncSimilarProductsESUpdater) -> None:
+    loop_thread.run(async_updater.close())
+    loop_thread.close()
@@ -0,0 +1,232 @@
+import bz2
+import io
+import mmap
+import os
+import queue
+import threading
+import zlib
+from contextlib import contextmanager, ExitStack
+from typing import Any, BinaryIO, Iterator
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BZIP2_MAGIC = b'BZh'
+# Размер блока чтения сжатого фида и буфера распакованных данных
+FEED_BUFFER_SIZE = 4 << 20
+# Сколько распакованных блоков может ждать парсер
+READ_AHEAD_BLOCKS = 4
+
+
+def detect_compression(head: bytes) -> str | None:
+    """
+    Определяет сжатие по первым байтам.
+
+    :param head: Первые 4 байта потока.
+    :return: 'gzip', 'zstd', 'bz2' или None для несжатых данных.
+    """
+    if head.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    if head.startswith(BZIP2_MAGIC):
+        return 'bz2'
+    return None
+
+
+def _iter_raw_blocks(stream: BinaryIO, head: bytes, read_size: int) -> Iterator[bytes]:
+    """Отдает уже прочитанное начало потока, затем блоки по read_size байт."""
+    if head:
+        yield head
+    yield from iter(lambda: stream.read(read_size), b'')
+
+
+def _iter_multistream(blocks: Iterator[bytes], new_decompressor: Any, magic: bytes) -> Iterator[bytes]:
+    """
+    Распаковывает поток из нескольких склеенных gzip или bz2 частей (как у cat a.gz b.gz).
+    Данные после последней части, не начинающиеся с magic, игнорируются, как в модуле gzip.
+    """
+    decompressor = new_decompressor()
+    for block in blocks:
+        while block:
+            data = decompressor.decompress(block)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            block = decompressor.unused_data
+            if not block.startswith(magic):
+                return
+            decompressor = new_decompressor()
+
+
+def _iter_zstd(blocks: Iterator[bytes], read_size: int) -> Iterator[bytes]:
+    if zstandard is None:
+        raise RuntimeError('Для фидов .zst нужен пакет zstandard')
+    reader = zstandard.ZstdDecompressor().stream_reader(_BlockReader(blocks), read_size=read_size,
+                                                        read_across_frames=True, closefd=False)
+    yield from iter(lambda: reader.read(read_size), b'')
+
+
+def iter_decompressed_blocks(blocks: Iterator[bytes], compression: str, read_size: int) -> Iterator[bytes]:
+    """
+    Распаковывает поток блоков.
+
+    :param blocks: Итератор блоков сжатых данных.
+    :param compression: 'gzip', 'zstd' или 'bz2'.
+    :param read_size: Размер блока чтения.
+    :return: Итератор блоков распакованных данных.
+    """
+    if compression == 'gzip':
+        return _iter_multistream(blocks, lambda: zlib.decompressobj(16 + zlib.MAX_WBITS), GZIP_MAGIC)
+    if compression == 'bz2':
+        return _iter_multistream(blocks, bz2.BZ2Decompressor, BZIP2_MAGIC)
+    if compression == 'zstd':
+        return _iter_zstd(blocks, read_size)
+    raise ValueError(f'Неизвестное сжатие: {compression}')
+
+
+class _BlockReader(io.RawIOBase):
+    """Бинарный поток поверх итератора блоков байт."""
+
+    def __init__(self, blocks: Iterator[bytes]):
+        super().__init__()
+        self._blocks = blocks
+        self._block = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._block:
+            block = next(self._blocks, None)
+            if block is None:
+                return 0
+            self._block = memoryview(block)
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+
+class ReadAhead:
+    """
+    Выполняет итератор блоков в фоновом потоке на READ_AHEAD_BLOCKS блоков вперед.
+
+    zlib, bz2 и zstandard отпускают GIL при распаковке, поэтому распаковка идет параллельно с разбором XML
+    и сжатый фид читается почти с той же скоростью, что и несжатый.
+    """
+    _END = object()
+
+    def __init__(self, blocks: Iterator[bytes], depth: int = READ_AHEAD_BLOCKS):
+        self._blocks = blocks
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='feed-read-ahead', daemon=True)
+        self._thread.start()
+
+    def _put(self, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self) -> None:
+        try:
+            for block in self._blocks:
+                if not self._put(block):
+                    return
+            self._put(self._END)
+        except BaseException as exc:
+            self._put(exc)
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _feed_head(stream: BinaryIO) -> tuple:
+    """
+    Читает первые байты потока для определения сжатия.
+
+    :return: Кортеж (первые байты, прочитаны ли они из потока безвозвратно).
+    """
+    if isinstance(stream, io.BufferedReader):
+        return stream.peek(4)[:4], False
+    seekable = getattr(stream, 'seekable', None)
+    if isinstance(stream, mmap.mmap) or (seekable is not None and seekable()):
+        position = stream.tell()
+        head = stream.read(4)
+        stream.seek(position)
+        return head, False
+    return stream.read(4), True
+
+
+@contextmanager
+def open_feed(source: str | os.PathLike | BinaryIO,
+              buffer_size: int = FEED_BUFFER_SIZE,
+              use_mmap: bool = False,
+              read_ahead: bool = True) -> Iterator[BinaryIO]:
+    """
+    Открывает фид для чтения без распаковки на диск: сжатие gzip, zstd и bz2 определяется по первым байтам.
+
+    Переданный поток не закрывается, открытый по пути файл закрывается при выходе.
+
+    :param source: Путь к файлу или бинарный поток (например, sys.stdin.buffer или ответ HTTP).
+    :param buffer_size: Размер блока чтения и буфера, байт.
+    :param use_mmap: Читать несжатый файл по пути через mmap.
+    :param read_ahead: Распаковывать в фоновом потоке параллельно с разбором.
+    :return: Бинарный поток несжатого XML.
+    """
+    with ExitStack() as stack:
+        if isinstance(source, (str, os.PathLike)):
+            stream = stack.enter_context(open(source, 'rb', buffering=buffer_size))
+        else:
+            stream = source
+
+        head, consumed = _feed_head(stream)
+        compression = detect_compression(head)
+
+        if compression is None:
+            if use_mmap and stream is not source and os.fstat(stream.fileno()).st_size:
+                mapped = stack.enter_context(mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ))
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                yield mapped
+            elif consumed:
+                yield io.BufferedReader(_BlockReader(_iter_raw_blocks(stream, head, buffer_size)), buffer_size)
+            else:
+                yield stream
+            return
+
+        blocks = iter_decompressed_blocks(_iter_raw_blocks(stream, head if consumed else b'', buffer_size),
+                                          compression, buffer_size)
+        if read_ahead:
+            blocks = stack.enter_context(_closing_read_ahead(blocks))
+        yield io.BufferedReader(_BlockReader(iter(blocks)), buffer_size)
+
+
+@contextmanager
+def _closing_read_ahead(blocks: Iterator[bytes]) -> Iterator[ReadAhead]:
+    reader = ReadAhead(blocks)
+    try:
+        yield reader
+    finally:
+        reader.close()
+
@@ -0,0 +1,431 @@
+import hashlib
+import io
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, BinaryIO, Iterator
+
+from lxml import etree
+
+from .additional_utils import process_offer_fast, add_category, assign_levels, build_category_index
+from .batch_sizing import AdaptiveBatchSizer
+from .feed_io import open_feed
+from .metrics import metrics
+from .offer_batch import OfferBatch
+
+XML_DECLARATION_RE = re.compile(rb'<\?xml[^>]*\?>')
+OFFERS_START_RE = re.compile(rb'<offers(?:\s[^>]*)?>')
+# Разметка, внутри которой текст '</offer>' не является концом товара, открывающий и закрывающие теги товара
+# и закрывающий тег секции
+FEED_MARKUP_RE = re.compile(rb'<!\[CDATA\[|<!--|<\?|<offer(?=[\s/>])|</offers?\s*>')
+# Открывающий тег товара целиком, '/' перед '>' - товар без содержимого <offer .../>.
+# Значения атрибутов могут содержать '>', но не '<'
+OFFER_START_TAG_RE = re.compile(rb'<offer(?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*(/?)>')
+MARKUP_ENDS = {b'<![CDATA[': b']]>', b'<!--': b'-->', b'<?': b'?>'}
+# Самая длинная разметка из FEED_MARKUP_RE без пробелов перед '>', ее начало в конце буфера ждет следующего блока
+MARKUP_MAX_START = len(b'<![CDATA[')
+
+# Словарь категорий и режим дельта-загрузки процесса-обработчика, передаются один раз через initializer пула
+_worker_category_map = None
+_worker_delta = False
+
+
+def clear_parsed_element(elem: Any) -> None:
+    """
+    Освобождает память разобранного элемента и его предыдущих соседей.
+
+    :param elem: XML-элемент.
+    """
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def iter_offer_batches(file_path: str | BinaryIO, category_map: dict, batch_size: int | AdaptiveBatchSizer,
+                       delta: bool = False) -> Iterator[OfferBatch]:
+    """
+    Последовательно парсит товары из XML файла и отдает их пачками.
+
+    :param file_path: Путь к XML файлу или бинарный поток, см. open_feed.
+    :param category_map: Словарь с информацией о категориях.
+    :param batch_size: Размер пачки.
+    :param delta: Режим дельта-загрузки, см. process_offer_fast.
+    :return: Итератор пачек товаров.
+    """
+    batch_data = OfferBatch(delta)
+    with open_feed(file_path) as feed:
+        context = etree.iterparse(feed, tag='offer', events=('end',))
+        for event, offer in context:
+            batch_data.append(process_offer_fast(offer, category_map, delta=delta))
+
+            if len(batch_data) >= int(batch_size):
+                yield batch_data
+                batch_data = OfferBatch(delta)
+
+            clear_parsed_element(offer)
+
+    if batch_data.parsed:
+        yield batch_data
+
+
+def feed_identity(file_path: str | BinaryIO, sample_size: int = 1 << 20) -> dict | None:
+    """
+    Определяет фид по размеру и хэшу его начала и конца, путь и время изменения сохраняются для справки.
+    Сжатый фид определяется по сжатым байтам.
+
+    :param file_path: Путь к XML файлу или бинарный поток файла. Позиция потока не меняется.
+    :param sample_size: Размер хэшируемых начала и конца файла в байтах.
+    :return: Словарь feed_id, feed_path, feed_size, feed_mtime или None для потока, который нельзя
+        перечитать (pipe, сокет) или у которого нет пути к файлу (stdin, в том числе перенаправленный из файла).
+    """
+    if isinstance(file_path, (str, os.PathLike)):
+        with open(file_path, 'rb') as feed:
+            return feed_identity(feed, sample_size)
+
+    feed = file_path
+    try:
+        stat = os.fstat(feed.fileno())
+        seekable = feed.seekable()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+    if not seekable:
+        return None
+    # Путь и время изменения фида должны быть настоящими, иначе точку продолжения нельзя сопоставить с файлом
+    name = getattr(feed, 'name', None)
+    try:
+        if not isinstance(name, str) or not os.path.samestat(os.stat(name), stat):
+            return None
+    except OSError:
+        return None
+
+    position = feed.tell()
+    digest = hashlib.sha1(str(stat.st_size).encode())
+    try:
+        feed.seek(0)
+        digest.update(feed.read(sample_size))
+        if stat.st_size > sample_size:
+            feed.seek(max(sample_size, stat.st_size - sample_size))
+            digest.update(feed.read(sample_size))
+    finally:
+        feed.seek(position)
+
+    return {
+        'feed_id': digest.hexdigest(),
+        'feed_path': os.path.abspath(name),
+        'feed_size': stat.st_size,
+        'feed_mtime': stat.st_mtime,
+    }
+
+
+def record_parsed_offers(offers: int, process_seconds: float) -> None:
+    """Учитывает в метриках разобранные товары и суммарное время process_offer_fast по ним."""
+    metrics.inc('process_offer_items', offers)
+    metrics.inc('process_offer_seconds', process_seconds)
+
+
+def iter_feed_offer_batches(file_path: str | BinaryIO, batch_size: int | AdaptiveBatchSizer, delta: bool = False,
+                            skip_offers: int = 0) -> Iterator[OfferBatch]:
+    """
+    Читает фид за один проход: собирает категории, при открытии <offers> строит индекс уровней
+    и дальше отдает товары пачками.
+
+    :param file_path: Путь к XML файлу или бинарный поток, сжатие определяется по первым байтам, см. open_feed.
+    :param batch_size: Размер пачки или AdaptiveBatchSizer, размер читается перед каждой пачкой.
+    :param delta: Режим дельта-загрузки, см. process_offer_fast.
+    :param skip_offers: Сколько первых товаров пропустить без обработки (продолжение загрузки).
+    :return: Итератор пачек товаров, parsed пачки учитывает и отброшенные товары.
+    """
+    category_map = {}
+    categories_ready = False
+    batch_data = OfferBatch(delta)
+    batch_limit = int(batch_size)
+    # Стадия xml_parse замеряется от начала пачки до ее отдачи, без времени потребителя
+    stage = metrics.start_stage('xml_parse')
+    process_seconds = 0.0
+
+    with open_feed(file_path) as feed:
+        context = etree.iterparse(feed, events=('start', 'end'), tag=('category', 'offers', 'offer'))
+        for event, elem in context:
+            tag = elem.tag
+            if event == 'start':
+                if tag != 'category' and not categories_ready:
+                    assign_levels(category_map)
+                    build_category_index(category_map)
+                    categories_ready = True
+                continue
+
+            if tag == 'offer':
+                if skip_offers:
+                    skip_offers -= 1
+                    clear_parsed_element(elem)
+                    continue
+                offer_started = time.perf_counter()
+                batch_data.append(process_offer_fast(elem, category_map, delta=delta))
+                process_seconds += time.perf_counter() - offer_started
+
+                if len(batch_data) >= batch_limit:
+                    metrics.stop_stage(stage, items=batch_data.parsed)
+                    record_parsed_offers(batch_data.parsed, process_seconds)
+                    yield batch_data
+                    batch_data = OfferBatch(delta)
+                    batch_limit = int(batch_size)
+                    stage = metrics.start_stage('xml_parse')
+                    process_seconds = 0.0
+            elif tag == 'category':
+                add_category(category_map, elem)
+            else:
+                continue
+
+            clear_parsed_element(elem)
+
+    metrics.stop_stage(stage, items=batch_data.parsed)
+    if batch_data.parsed:
+        record_parsed_offers(batch_data.parsed, process_seconds)
+        yield batch_data
+
+
+def read_feed_header(feed: BinaryIO, read_size: int = 1 << 20) -> tuple:
+    """
+    Читает начало фида до открывающего тега <offers> и разбирает категории из него.
+
+    :param feed: Бинарный поток фида.
+    :param read_size: Размер блока чтения.
+    :return: Кортеж (XML декларация, словарь категорий, байты после тега <offers>).
+    """
+    header = b''
+    while True:
+        match = OFFERS_START_RE.search(header)
+        if match:
+            break
+        chunk = feed.read(read_size)
+        if not chunk:
+            raise ValueError('В фиде не найден тег <offers>')
+        header += chunk
+
+    declaration_match = XML_DECLARATION_RE.match(header.lstrip(b'\xef\xbb\xbf \t\r\n'))
+    declaration = declaration_match.group(0) if declaration_match else b''
+
+    category_map = {}
+    parser = etree.XMLPullParser(events=('end',), tag='category')
+    parser.feed(header[:match.start()])
+    for event, elem in parser.read_events():
+        add_category(category_map, elem)
+        elem.clear()
+    assign_levels(category_map)
+    build_category_index(category_map)
+
+    return declaration, category_map, header[match.end():]
+
+
+class OfferBoundaryScanner:
+    """
+    Находит в секции <offers> концы товаров: закрывающие теги </offer> и теги <offer .../> без содержимого.
+    CDATA, комментарии и инструкции обработки пропускаются.
+
+    Буфер дописывается блоками, сканирование продолжается с места остановки. Разметка, начало которой
+    попало в конец буфера, досматривается после следующего блока.
+    """
+
+    def __init__(self):
+        # Позиция, с которой продолжается сканирование, и позиции сразу после найденных концов товаров
+        self.position = 0
+        self.offer_ends = []
+        # Позиция тега </offers> или None
+        self.offers_end = None
+
+    def scan(self, buffer: bytes, final: bool = False) -> None:
+        """
+        Сканирует буфер с места остановки.
+
+        :param buffer: Секция <offers> с начала текущего фрагмента.
+        :param final: Буфер дочитан до конца фида, незакрытая разметка досматривается до конца буфера.
+        """
+        position = self.position
+        while self.offers_end is None:
+            match = FEED_MARKUP_RE.search(buffer, position)
+            if match is None:
+                position = max(position, len(buffer) - MARKUP_MAX_START)
+                break
+            if not final and match.start() > len(buffer) - MARKUP_MAX_START:
+                position = match.start()
+                break
+
+            token = match.group(0)
+            markup_end = MARKUP_ENDS.get(token)
+            if markup_end is not None:
+                end = buffer.find(markup_end, match.end())
+                if end == -1:
+                    position = len(buffer) if final else match.start()
+                    break
+                position = end + len(markup_end)
+            elif token == b'<offer':
+                start_tag = OFFER_START_TAG_RE.match(buffer, match.start())
+                if start_tag is None:
+                    # Тег заканчивается до следующего '<': без него тег еще не дочитан, с ним - поврежден
+                    if not final and buffer.find(b'<', match.end()) == -1:
+                        position = match.start()
+                        break
+                    position = match.end()
+                    continue
+                position = start_tag.end()
+                if start_tag.group(1):
+                    self.offer_ends.append(position)
+            elif token.startswith(b'</offers'):
+                self.offers_end = match.start()
+            else:
+                position = match.end()
+                self.offer_ends.append(position)
+        self.position = position
+
+    def cut(self, position: int) -> int:
+        """
+        Отрезает начало буфера до position, которое должно быть концом товара.
+
+        :return: Кол-во товаров в отрезанной части.
+        """
+        offers = self.offer_ends.index(position) + 1
+        self.offer_ends = [end - position for end in self.offer_ends[offers:]]
+        self.position -= position
+        if self.offers_end is not None:
+            self.offers_end -= position
+        return offers
+
+
+def iter_offer_fragments(feed: BinaryIO, remainder: bytes, fragment_size: int) -> Iterator[tuple]:
+    """
+    Нарезает секцию <offers> на фрагменты, каждый из которых заканчивается на </offer>.
+
+    Концы товаров ищет OfferBoundaryScanner, поэтому '</offer>' внутри CDATA описания или комментария
+    не режет товар и не учитывается в кол-ве товаров фрагмента.
+
+    :param feed: Бинарный поток фида, позиционированный после тега <offers>.
+    :param remainder: Уже прочитанные байты после тега <offers>.
+    :param fragment_size: Примерный размер фрагмента в байтах.
+    :return: Итератор кортежей (смещение фрагмента от начала секции <offers>, фрагмент, кол-во товаров в нем).
+    """
+    scanner = OfferBoundaryScanner()
+    buffer = remainder
+    offset = 0
+    final = False
+    while True:
+        scanner.scan(buffer, final)
+        if scanner.offers_end is not None:
+            fragment = buffer[:scanner.offers_end]
+            if fragment.strip():
+                yield offset, fragment, len(scanner.offer_ends)
+            return
+
+        if len(buffer) >= fragment_size and scanner.offer_ends:
+            cut = scanner.offer_ends[-1]
+            yield offset, buffer[:cut], scanner.cut(cut)
+            buffer = buffer[cut:]
+            offset += cut
+
+        if final:
+            if buffer.strip():
+                yield offset, buffer, len(scanner.offer_ends)
+            return
+        chunk = feed.read(fragment_size)
+        if chunk:
+            buffer += chunk
+        else:
+            final = True
+
+
+def _init_parse_worker(category_map: dict, delta: bool) -> None:
+    global _worker_category_map, _worker_delta
+    _worker_category_map = category_map
+    _worker_delta = delta
+
+
+def _parse_offers_fragment(declaration: bytes, fragment: bytes, skip_offers: int = 0, offset: int = 0) -> tuple:
+    """
+    Парсит фрагмент секции <offers> в процессе-обработчике, пропуская skip_offers первых товаров.
+
+    Ошибка XML передается в главный процесс как ValueError: исключения lxml не сериализуются pickle.
+
+    :param offset: Смещение фрагмента от начала секции <offers>, для сообщения об ошибке.
+    :return: Кортеж (пачка товаров, время разбора фрагмента, время process_offer_fast), сек.
+    """
+    started = time.perf_counter()
+    process_seconds = 0.0
+    data = declaration + b'<offers>' + fragment + b'</offers>'
+    offers = OfferBatch(_worker_delta)
+    context = etree.iterparse(io.BytesIO(data), tag='offer', events=('end',))
+    try:
+        for event, offer in context:
+            if skip_offers:
+                skip_offers -= 1
+            else:
+                offer_started = time.perf_counter()
+                offers.append(process_offer_fast(offer, _worker_category_map, delta=_worker_delta))
+                process_seconds += time.perf_counter() - offer_started
+            clear_parsed_element(offer)
+    except etree.LxmlError as e:
+        raise ValueError(f'Ошибка разбора фрагмента фида: байты {offset}-{offset + len(fragment)} '
+                         f'секции <offers>: {e}') from None
+    return offers, time.perf_counter() - started, process_seconds
+
+
+def iter_offer_batches_parallel(file_path: str | BinaryIO,
+                                batch_size: int | AdaptiveBatchSizer,
+                                workers: int,
+                                fragment_size: int = 8 << 20,
+                                max_pending: int = None,
+                                delta: bool = False,
+                                skip_offers: int = 0) -> Iterator[OfferBatch]:
+    """
+    Парсит товары из XML файла в пуле процессов и отдает их пачками в исходном порядке.
+
+    Главный процесс только режет секцию <offers> на фрагменты по концам товаров, см. OfferBoundaryScanner,
+    разбор XML и process_offer_fast выполняются в процессах-обработчиках.
+
+    :param file_path: Путь к XML файлу или бинарный поток, см. open_feed.
+    :param batch_size: Размер пачки или AdaptiveBatchSizer, размер читается перед каждой пачкой.
+    :param workers: Кол-во процессов.
+    :param fragment_size: Примерный размер фрагмента в байтах.
+    :param max_pending: Максимум фрагментов в обработке, по умолчанию 2 * workers.
+    :param delta: Режим дельта-загрузки, см. process_offer_fast.
+    :param skip_offers: Сколько первых товаров пропустить без обработки (продолжение загрузки).
+        Фрагменты, целиком состоящие из пропускаемых товаров, не разбираются.
+    :return: Итератор пачек товаров.
+    """
+    max_pending = max_pending or 2 * workers
+
+    with open_feed(file_path) as feed:
+        declaration, category_map, remainder = read_feed_header(feed)
+
+        with ProcessPoolExecutor(workers, initializer=_init_parse_worker,
+                                 initargs=(category_map, delta)) as executor:
+            pending = deque()
+            batch_data = OfferBatch(delta)
+
+            def collect_ready(limit: int) -> Iterator[OfferBatch]:
+                nonlocal batch_data
+                while len(pending) > limit:
+                    offers, parse_seconds, process_seconds = pending.popleft().result()
+                    # Метрики процессов-обработчиков учитываются в главном процессе по результату фрагмента
+                    metrics.observe('xml_parse_seconds', parse_seconds)
+                    metrics.inc('xml_parse_items', offers.parsed)
+                    record_parsed_offers(offers.parsed, process_seconds)
+                    batch_data.extend(offers)
+                    while len(batch_data) >= int(batch_size):
+                        head, batch_data = batch_data.split(int(batch_size))
+                        yield head
+
+            for offset, fragment, fragment_offers in iter_offer_fragments(feed, remainder, fragment_size):
+                fragment_skip = 0
+                if skip_offers:
+                    if fragment_offers <= skip_offers:
+                        skip_offers -= fragment_offers
+                        continue
+                    fragment_skip, skip_offers = skip_offers, 0
+                pending.append(executor.submit(_parse_offers_fragment, declaration, fragment, fragment_skip,
+                                               offset))
+                yield from collect_ready(max_pending - 1)
+
+            yield from collect_ready(0)
+            if batch_data.parsed:
+                yield batch_data
@@ -0,0 +1,279 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Iterator
+
+# Границы корзин гистограмм длительности, сек.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+METRIC_PREFIX = 'sku_ingest'
+
+
+class Histogram:
+    """Гистограмма длительностей с накопительными корзинами в формате Prometheus."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def cumulative(self) -> list:
+        """Возвращает пары (граница корзины, кол-во наблюдений не больше нее), последняя граница +Inf."""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    Счетчики и гистограммы длительности стадий загрузки и пересчета похожих товаров.
+
+    Метрики накапливаются в процессе и периодически выводятся JSON строкой и пишутся в textfile
+    для node_exporter. Для стадий из profile_stages собирается cProfile, для стадий из tracemalloc_stages -
+    пик выделенной памяти. Оба режима заметно замедляют стадию и включаются только для поиска проблем.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+        self.profile_stages = frozenset()
+        self.tracemalloc_stages = frozenset()
+        self.profile_dir = '.'
+        self._profiles = {}
+        self._profile_lock = threading.Lock()
+
+        self._reporter = None
+        self._reporter_stop = threading.Event()
+        self._last_report = (time.monotonic(), {})
+
+    def configure(self, profile_stages: str = '', tracemalloc_stages: str = '', profile_dir: str = '.') -> None:
+        """
+        Включает профилирование стадий.
+
+        :param profile_stages: Имена стадий через запятую для cProfile.
+        :param tracemalloc_stages: Имена стадий через запятую для замера пика памяти tracemalloc.
+        :param profile_dir: Директория для файлов <стадия>.prof.
+        """
+        self.profile_stages = frozenset(stage.strip() for stage in profile_stages.split(',') if stage.strip())
+        self.tracemalloc_stages = frozenset(stage.strip() for stage in tracemalloc_stages.split(',') if stage.strip())
+        self.profile_dir = profile_dir
+        if self.tracemalloc_stages and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def reset(self) -> None:
+        """
+        Сбрасывает накопленные метрики, настройки профилирования сохраняются.
+        Блокировки создаются заново, поэтому метод безопасен в процессе, созданном fork во время вывода метрик.
+        """
+        profile_stages, tracemalloc_stages, profile_dir = self.profile_stages, self.tracemalloc_stages, self.profile_dir
+        self.__init__()
+        self.profile_stages, self.tracemalloc_stages, self.profile_dir = profile_stages, tracemalloc_stages, profile_dir
+
+    def inc(self, name: str, value: float = 1) -> None:
+        """Увеличивает счетчик."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """Устанавливает текущее значение показателя."""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Добавляет длительность в гистограмму."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def start_stage(self, stage: str) -> tuple:
+        """
+        Начинает замер стадии, для замеров, которые нельзя обернуть в timer (например, между yield генератора).
+
+        :param stage: Имя стадии.
+        :return: Токен для stop_stage.
+        """
+        profile = self._start_profile(stage) if stage in self.profile_stages else None
+        memory_before = None
+        if stage in self.tracemalloc_stages:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        return stage, time.perf_counter(), profile, memory_before
+
+    def stop_stage(self, token: tuple, items: int = None, nbytes: int = None) -> float:
+        """
+        Завершает замер стадии: длительность в гистограмму <stage>_seconds, записи в счетчик <stage>_items,
+        байты в счетчик <stage>_bytes.
+
+        :param token: Токен из start_stage.
+        :param items: Кол-во обработанных записей.
+        :param nbytes: Кол-во обработанных байт.
+        :return: Длительность, сек.
+        """
+        stage, started, profile, memory_before = token
+        elapsed = time.perf_counter() - started
+        if profile is not None:
+            self._stop_profile(profile)
+
+        self.observe(f'{stage}_seconds', elapsed)
+        if items is not None:
+            self.inc(f'{stage}_items', items)
+        if nbytes is not None:
+            self.inc(f'{stage}_bytes', nbytes)
+        if memory_before is not None:
+            # Пик общий для всех потоков, поэтому при параллельных стадиях значение приблизительное
+            peak = tracemalloc.get_traced_memory()[1] - memory_before
+            with self._lock:
+                self.gauges[f'{stage}_peak_bytes'] = max(self.gauges.get(f'{stage}_peak_bytes', 0), peak)
+        return elapsed
+
+    @contextmanager
+    def timer(self, stage: str, items: int = None, nbytes: int = None) -> Iterator[None]:
+        """
+        Замеряет длительность стадии, см. stop_stage.
+
+        :param stage: Имя стадии.
+        :param items: Кол-во обработанных записей.
+        :param nbytes: Кол-во обработанных байт.
+        """
+        token = self.start_stage(stage)
+        try:
+            yield
+        finally:
+            self.stop_stage(token, items, nbytes)
+
+    def _start_profile(self, stage: str) -> cProfile.Profile | None:
+        # Одновременно может работать только один профилировщик, пересекающиеся замеры пропускаются
+        if not self._profile_lock.acquire(blocking=False):
+            return None
+        profile = self._profiles.get(stage)
+        if profile is None:
+            profile = self._profiles[stage] = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _stop_profile(self, profile: cProfile.Profile) -> None:
+        profile.disable()
+        self._profile_lock.release()
+
+    def dump_profiles(self) -> None:
+        """Сохраняет собранные cProfile статистики в profile_dir/<стадия>.prof."""
+        with self._profile_lock:
+            for stage, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(self.profile_dir, f'{stage}.prof'))
+
+    def snapshot(self) -> dict:
+        """Возвращает копию всех метрик."""
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {
+                    name: {'count': histogram.count, 'sum': histogram.sum, 'max': histogram.max,
+                           'buckets': histogram.cumulative()}
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def log_json(self) -> None:
+        """Выводит метрики одной JSON строкой, для счетчиков добавляется скорость за период с прошлого вывода."""
+        snapshot = self.snapshot()
+        now = time.monotonic()
+        last_time, last_counters = self._last_report
+        elapsed = max(now - last_time, 1e-9)
+        self._last_report = (now, snapshot['counters'])
+
+        line = {
+            'metrics': METRIC_PREFIX,
+            'pid': os.getpid(),
+            'counters': snapshot['counters'],
+            'rates': {name: round((value - last_counters.get(name, 0)) / elapsed, 3)
+                      for name, value in snapshot['counters'].items()},
+            'gauges': snapshot['gauges'],
+            'latency': {name: {'count': histogram['count'],
+                               'avg': round(histogram['sum'] / histogram['count'], 6) if histogram['count'] else 0,
+                               'max': round(histogram['max'], 6)}
+                        for name, histogram in snapshot['histograms'].items()},
+        }
+        print(json.dumps(line, ensure_ascii=False))
+
+    def write_prometheus(self, path: str) -> None:
+        """Атомарно записывает метрики в textfile формата Prometheus."""
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name}_total counter')
+            lines.append(f'{METRIC_PREFIX}_{name}_total {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} gauge')
+            lines.append(f'{METRIC_PREFIX}_{name} {value}')
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append(f'# TYPE {METRIC_PREFIX}_{name} histogram')
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{METRIC_PREFIX}_{name}_bucket{{le="{le}"}} {count}')
+            lines.append(f'{METRIC_PREFIX}_{name}_sum {histogram["sum"]}')
+            lines.append(f'{METRIC_PREFIX}_{name}_count {histogram["count"]}')
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, path)
+
+    def report(self, textfile_path: str = None) -> None:
+        """Выводит JSON строку и, если задан путь, обновляет textfile."""
+        self.log_json()
+        if textfile_path:
+            self.write_prometheus(textfile_path)
+
+    def start_reporter(self, interval: float = 30, textfile_path: str = None) -> None:
+        """
+        Запускает фоновый поток периодического вывода метрик.
+
+        :param interval: Период вывода, сек.
+        :param textfile_path: Путь textfile для Prometheus node_exporter, None - не писать.
+        """
+        if self._reporter is not None:
+            return
+        self._reporter_stop.clear()
+
+        def loop() -> None:
+            while not self._reporter_stop.wait(interval):
+                self.report(textfile_path)
+
+        self._reporter = threading.Thread(target=loop, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+
+    def stop_reporter(self, textfile_path: str = None) -> None:
+        """Останавливает фоновый вывод, выводит итоговые метрики и сохраняет профили."""
+        if self._reporter is not None:
+            self._reporter_stop.set()
+            self._reporter.join()
+            self._reporter = None
+        self.report(textfile_path)
+        if self._profiles:
+            self.dump_profiles()
+
+
+metrics = Metrics()
@@ -0,0 +1,154 @@
+from array import array
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+from .additional_utils import CATEGORY_LEVEL_FIELDS, max_value, min_value
+
+# Столбцы товара в порядке полей process_offer_fast
+OFFER_COLUMNS = (
+    'uuid', 'marketplace_id', 'product_id', 'title', 'description', 'brand', 'seller_id', 'seller_name',
+    'first_image_url', 'category_id', 'features', 'rating_count', 'rating_value', 'price_before_discounts',
+    'discount', 'price_after_discounts', 'bonuses', 'sales', 'currency', 'barcode', 'similar_sku',
+) + CATEGORY_LEVEL_FIELDS
+# Целые столбцы хранятся в array('q') и должны помещаться в bigint, дробные - в array('d')
+INT_COLUMNS = ('marketplace_id', 'product_id', 'seller_id', 'category_id', 'rating_count', 'bonuses', 'sales',
+               'barcode')
+FLOAT_COLUMNS = ('rating_value', 'price_before_discounts', 'discount', 'price_after_discounts')
+# При загрузке фида похожих товаров еще нет, столбец хранит ссылки на один пустой кортеж
+EMPTY_SIMILAR_SKU = ()
+
+
+class OfferBatch:
+    """
+    Пачка товаров по столбцам: целые и дробные поля в типизированных array, строки в списках.
+
+    В пачку попадают только товары, все целые поля которых помещаются в bigint, поэтому получатели
+    не фильтруют ее повторно. Пачка не хранит словарь на каждый товар и передается между процессами
+    компактнее списка словарей. Получатели читают столбцы без копирования: COPY - строками из столбцов,
+    to_sql - через to_frame, числовые столбцы которого ссылаются на буферы array.
+    """
+    __slots__ = ('columns', 'parsed')
+
+    def __init__(self, delta: bool = False):
+        """
+        :param delta: Режим дельта-загрузки: столбец content_hash.
+        """
+        names = OFFER_COLUMNS + (('content_hash',) if delta else ())
+        self.columns = {name: array('q') if name in INT_COLUMNS else array('d') if name in FLOAT_COLUMNS else []
+                        for name in names}
+        # Кол-во переданных в append товаров, включая отброшенные
+        self.parsed = 0
+
+    @classmethod
+    def from_dicts(cls, offers: Iterable[dict], delta: bool = None) -> 'OfferBatch':
+        """
+        Собирает пачку из словарей товаров.
+
+        :param offers: Словари товаров, см. process_offer_fast.
+        :param delta: Режим дельта-загрузки, по умолчанию - если у первого товара есть content_hash.
+        :return: OfferBatch.
+        """
+        offers = iter(offers)
+        first = next(offers, None)
+        batch = cls(delta if delta is not None else first is not None and 'content_hash' in first)
+        if first is not None:
+            batch.append(first)
+            for offer_data in offers:
+                batch.append(offer_data)
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.columns['uuid'])
+
+    def __getitem__(self, name: str) -> array | list:
+        return self.columns[name]
+
+    def __repr__(self) -> str:
+        return f'OfferBatch({len(self)} товаров, разобрано {self.parsed})'
+
+    @property
+    def column_names(self) -> tuple:
+        return tuple(self.columns)
+
+    def append(self, offer_data: dict) -> bool:
+        """
+        Добавляет товар, если все его целые поля помещаются в bigint.
+
+        :param offer_data: Словарь товара, см. process_offer_fast.
+        :return: True, если товар добавлен.
+        """
+        self.parsed += 1
+        for name in INT_COLUMNS:
+            if not min_value <= offer_data[name] <= max_value:
+                return False
+
+        columns = self.columns
+        columns['uuid'].append(str(offer_data['uuid']))
+        columns['similar_sku'].append(EMPTY_SIMILAR_SKU)
+        for name, column in columns.items():
+            if name != 'uuid' and name != 'similar_sku':
+                column.append(offer_data[name])
+        return True
+
+    def extend(self, other: 'OfferBatch') -> None:
+        """Добавляет в конец товары другой пачки с теми же столбцами."""
+        for name, column in self.columns.items():
+            column.extend(other.columns[name])
+        self.parsed += other.parsed
+
+    def take(self, indices: list) -> 'OfferBatch':
+        """Возвращает новую пачку из товаров с номерами indices."""
+        batch = OfferBatch.__new__(OfferBatch)
+        batch.columns = {name: array(column.typecode, (column[index] for index in indices))
+                         if isinstance(column, array) else [column[index] for index in indices]
+                         for name, column in self.columns.items()}
+        batch.parsed = len(indices)
+        return batch
+
+    def split(self, size: int) -> tuple:
+        """
+        Делит пачку на первые size товаров и остаток.
+        Отброшенные товары учитываются в parsed остатка, поэтому сумма parsed не меняется.
+
+        :return: Кортеж (первые size товаров, остаток).
+        """
+        head = OfferBatch.__new__(OfferBatch)
+        tail = OfferBatch.__new__(OfferBatch)
+        head.columns = {name: column[:size] for name, column in self.columns.items()}
+        tail.columns = {name: column[size:] for name, column in self.columns.items()}
+        head.parsed = len(head)
+        tail.parsed = self.parsed - head.parsed
+        return head, tail
+
+    def iter_rows(self, names: Iterable[str] = None) -> Iterator[tuple]:
+        """Отдает товары кортежами значений столбцов names, по умолчанию всех столбцов."""
+        return zip(*(self.columns[name] for name in (names or self.columns)))
+
+    def iter_dicts(self) -> Iterator[dict]:
+        """Отдает товары словарями, как process_offer_fast."""
+        names = self.column_names
+        for row in self.iter_rows(names):
+            offer_data = dict(zip(names, row))
+            offer_data['similar_sku'] = list(offer_data['similar_sku'])
+            yield offer_data
+
+    def to_frame(self) -> pd.DataFrame:
+        """Возвращает DataFrame, числовые столбцы которого ссылаются на буферы array без копирования."""
+        data = {}
+        for name, column in self.columns.items():
+            if isinstance(column, array):
+                data[name] = np.frombuffer(column, dtype=np.int64 if column.typecode == 'q' else np.float64)
+            elif name == 'similar_sku':
+                data[name] = [list(value) for value in column]
+            else:
+                data[name] = column
+        return pd.DataFrame(data, copy=False)
+
+
+def as_offer_batch(offers: OfferBatch | Iterable[dict]) -> OfferBatch:
+    """Возвращает пачку как есть или собирает OfferBatch из словарей товаров."""
+    if isinstance(offers, OfferBatch):
+        return offers
+    return OfferBatch.from_dicts(offers)
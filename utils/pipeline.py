@@ -0,0 +1,136 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable
+
+_STOP = object()
+
+
+class SinkBatches(dict):
+    """Разные пачки для получателей одного шага конвейера: имя получателя -> пачка."""
+
+
+class IngestPipeline:
+    """
+    Конвейер загрузки: стадия парсинга в текущем потоке и по потоку на каждого получателя (бд, Elasticsearch).
+
+    Каждая пачка передается всем получателям через ограниченные очереди, поэтому парсер ждет,
+    только когда самый медленный получатель отстал на queue_size пачек. Получатели не должны изменять пачку.
+    Первая ошибка любой стадии останавливает конвейер и пробрасывается из run().
+    """
+
+    def __init__(self, sinks: dict, queue_size: int = 2, poll_interval: float = 0.5,
+                 on_batch_done: Callable = None):
+        """
+        :param sinks: Словарь имя -> функция, принимающая пачку.
+        :param queue_size: Максимум пачек в очереди каждого получателя.
+        :param poll_interval: Период проверки остановки при ожидании очереди, сек.
+        :param on_batch_done: Функция, принимающая номер пачки и время ее обработки самым медленным получателем, сек.
+            Вызывается по порядку номеров, когда пачку и все предыдущие обработали все получатели.
+        """
+        self.sinks = sinks
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.on_batch_done = on_batch_done
+
+        self._stop_event = threading.Event()
+        self._errors = []
+        self._errors_lock = threading.Lock()
+
+        self._done_counts = {}
+        self._batch_seconds = {}
+        self._reported_batches = 0
+        self._progress_lock = threading.Lock()
+
+    def _fail(self, stage: str, error: BaseException) -> None:
+        with self._errors_lock:
+            self._errors.append((stage, error))
+        self._stop_event.set()
+
+    def _put(self, sink_queue: queue.Queue, item: object) -> bool:
+        """Кладет элемент в очередь, пока конвейер не остановлен. Возвращает False при остановке."""
+        while not self._stop_event.is_set():
+            try:
+                sink_queue.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _batch_done(self, name: str, seconds: float) -> None:
+        """Учитывает обработанную получателем пачку и сообщает о пачках, обработанных всеми получателями."""
+        if self.on_batch_done is None:
+            return
+        with self._progress_lock:
+            # Получатель обрабатывает пачки по порядку, поэтому его n-я пачка - пачка номер n,
+            # а готовы все пачки до минимума по получателям
+            batch_no = self._done_counts[name]
+            self._batch_seconds[batch_no] = max(self._batch_seconds.get(batch_no, 0.0), seconds)
+            self._done_counts[name] += 1
+            completed = min(self._done_counts.values())
+            while self._reported_batches < completed:
+                self.on_batch_done(self._reported_batches, self._batch_seconds.pop(self._reported_batches))
+                self._reported_batches += 1
+
+    def _consume(self, name: str, sink: Callable, sink_queue: queue.Queue) -> None:
+        while True:
+            try:
+                batch = sink_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self._stop_event.is_set():
+                    return
+                continue
+
+            if batch is _STOP or self._stop_event.is_set():
+                return
+            if isinstance(batch, SinkBatches):
+                batch = batch[name]
+            try:
+                started = time.perf_counter()
+                sink(batch)
+                self._batch_done(name, time.perf_counter() - started)
+            except BaseException as e:
+                self._fail(name, e)
+                return
+
+    def run(self, batches: Iterable) -> int:
+        """
+        Прогоняет пачки через всех получателей.
+
+        :param batches: Итерируемый объект пачек (стадия парсинга). Пачка передается всем получателям,
+            SinkBatches - каждому получателю своя пачка.
+        :return: Кол-во переданных пачек.
+        """
+        queues = {name: queue.Queue(maxsize=self.queue_size) for name in self.sinks}
+        self._done_counts = {name: 0 for name in self.sinks}
+        self._batch_seconds = {}
+        threads = [
+            threading.Thread(target=self._consume, args=(name, sink, queues[name]), name=f'ingest-{name}', daemon=True)
+            for name, sink in self.sinks.items()
+        ]
+        for thread in threads:
+            thread.start()
+
+        batch_count = 0
+        batches = iter(batches)
+        try:
+            for batch in batches:
+                if not all(self._put(sink_queue, batch) for sink_queue in queues.values()):
+                    break
+                batch_count += 1
+        except BaseException as e:
+            self._fail('parser', e)
+        finally:
+            close = getattr(batches, 'close', None)
+            if close is not None:
+                close()
+            for sink_queue in queues.values():
+                self._put(sink_queue, _STOP)
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            stage, error = self._errors[0]
+            print(f'->Ошибка на стадии {stage} конвейера загрузки: {error} <-')
+            raise error
+        return batch_count
@@ -0,0 +1,192 @@
+import os
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable
+from uuid import UUID
+
+from .db_utils import execute_sql_file, load_data_from_bd_chunk_function
+from .metrics import metrics
+
+UUID_SPACE = 1 << 128
+
+
+class ShardLeaseLost(RuntimeError):
+    """Аренду диапазона не удалось продлить: диапазон захвачен другим обработчиком или уже пересчитан."""
+
+
+def split_uuid_space(shards: int) -> list:
+    """
+    Делит пространство uuid на равные диапазоны, порядок совпадает с сортировкой uuid в PostgreSQL.
+
+    :param shards: Кол-во диапазонов.
+    :return: Список (нижняя граница включительно, верхняя граница не включительно или None).
+    """
+    bounds = [str(UUID(int=shard_no * UUID_SPACE // shards)) for shard_no in range(shards)]
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def register_similarity_job(config: dict, base_dir: str, schema: str, table_name: str, job_id: str,
+                            shards: int) -> Any:
+    """
+    Создает таблицу прогресса и диапазоны задания, если задание еще не зарегистрировано.
+    Повторный запуск с тем же job_id продолжает уже созданные диапазоны.
+
+    :return: Строка с полями shards, remaining, created_at.
+    """
+    names = {'schema': schema, 'table': table_name}
+    execute_sql_file(config, 'create_similarity_progress.sql', base_dir, schema, table_name, params_names=names)
+
+    bounds = split_uuid_space(shards)
+    execute_sql_file(config, 'insert_similarity_shards.sql', base_dir, schema, table_name, params_names=names,
+                     params_values={'job_id': job_id,
+                                    'shard_nos': list(range(shards)),
+                                    'lower_uuids': [lower for lower, upper in bounds],
+                                    'upper_uuids': [upper for lower, upper in bounds]},
+                     expanding=False)
+    return select_similarity_job(config, base_dir, schema, table_name, job_id)
+
+
+def select_similarity_job(config: dict, base_dir: str, schema: str, table_name: str, job_id: str) -> Any:
+    """Возвращает состояние задания: всего диапазонов, осталось и время регистрации."""
+    return execute_sql_file(config, 'select_similarity_job.sql', base_dir, schema, table_name,
+                            params_names={'schema': schema, 'table': table_name},
+                            params_values={'job_id': job_id}, expanding=False)[0]
+
+
+def _renew_lease_after(process_function: Callable, config: dict, base_dir: str, schema: str, table_name: str,
+                       shard_params: dict) -> Callable:
+    """
+    Оборачивает process_function: после каждого чанка продлевает аренду диапазона.
+
+    :raises ShardLeaseLost: Если диапазон больше не принадлежит обработчику.
+    """
+    def process_and_renew(chunk: Any, *args, **kwargs) -> None:
+        process_function(chunk, *args, **kwargs)
+        renewed = execute_sql_file(config, 'renew_similarity_shard.sql', base_dir, schema, table_name,
+                                   params_names={'schema': schema, 'table': table_name},
+                                   params_values=shard_params, expanding=False)
+        if not renewed:
+            raise ShardLeaseLost(f'Аренда диапазона {shard_params["shard_no"]} задания {shard_params["job_id"]} '
+                                 f'потеряна обработчиком {shard_params["worker"]}')
+
+    return process_and_renew
+
+
+def run_similarity_shards(main_pid: int,
+                          config: dict,
+                          base_dir: str,
+                          schema: str,
+                          table_name: str,
+                          job_id: str,
+                          process_function: Callable,
+                          updater_factory: Callable,
+                          chunk_size: int = 30000,
+                          lease_seconds: int = 3600) -> int:
+    """
+    Захватывает свободные диапазоны задания и пересчитывает похожие товары в них, пока диапазоны не кончатся.
+
+    Диапазон захватывается через FOR UPDATE SKIP LOCKED, поэтому обработчики в разных процессах и на разных
+    хостах не пересекаются. Диапазон упавшего обработчика освобождается сразу, а убитого - по истечении аренды.
+    Аренда продлевается после каждого чанка. Если ее не удалось продлить или диапазон при завершении принадлежит
+    другому обработчику, диапазон остается новому владельцу, а обработчик переходит к следующему.
+
+    :param main_pid: PID запустившего задание процесса, в других процессах метрики выводятся при завершении.
+
+    :param process_function: Функция (пачка uuid, updater=...), как update_product_with_similar_db.
+    :param updater_factory: Создает поисковик похожих товаров, вызывается один раз в процессе.
+    :param chunk_size: Размер чанков при поиске похожих товаров.
+    :param lease_seconds: Через сколько секунд после захвата или последнего чанка незавершенный диапазон
+        можно захватить повторно.
+    :return: Кол-во обработанных диапазонов.
+    """
+    names = {'schema': schema, 'table': table_name}
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    updater = updater_factory()
+    processed = 0
+
+    while True:
+        claimed = execute_sql_file(config, 'claim_similarity_shard.sql', base_dir, schema, table_name,
+                                   params_names=names,
+                                   params_values={'job_id': job_id, 'worker': worker, 'lease_seconds': lease_seconds},
+                                   expanding=False)
+        if not claimed:
+            # Метрики процесса-обработчика не попадают в метрики главного процесса, выводятся при завершении
+            if os.getpid() != main_pid:
+                metrics.log_json()
+            return processed
+
+        shard = claimed[0]
+        shard_params = {'job_id': job_id, 'shard_no': shard.shard_no, 'worker': worker}
+        try:
+            load_data_from_bd_chunk_function(
+                config,
+                'select_sku_shard.sql',
+                base_dir,
+                schema,
+                table_name,
+                _renew_lease_after(process_function, config, base_dir, schema, table_name, shard_params),
+                chunk_size=chunk_size,
+                params_names=names,
+                params_values={'lower_uuid': str(shard.lower_uuid),
+                               'upper_uuid': str(shard.upper_uuid) if shard.upper_uuid else None},
+                expanding=False,
+                updater=updater,
+            )
+        except ShardLeaseLost as e:
+            print(f'->{e}, диапазон пропущен <-')
+            continue
+        except BaseException:
+            execute_sql_file(config, 'release_similarity_shard.sql', base_dir, schema, table_name,
+                             params_names=names, params_values=shard_params, expanding=False)
+            raise
+
+        completed = execute_sql_file(config, 'complete_similarity_shard.sql', base_dir, schema, table_name,
+                                     params_names=names, params_values=shard_params, expanding=False)
+        if not completed:
+            print(f'->Аренда диапазона {shard.shard_no} задания {job_id} потеряна обработчиком {worker}, '
+                  f'диапазон не отмечен пересчитанным <-')
+            continue
+        processed += 1
+        print(f'->Задание {job_id}: диапазон {shard.shard_no} пересчитан обработчиком {worker} <-')
+
+
+def _init_similarity_worker() -> None:
+    # Процесс-обработчик ведет свои метрики, не унаследованные от главного процесса
+    metrics.reset()
+
+
+def run_similarity_job(config: dict,
+                       base_dir: str,
+                       schema: str,
+                       table_name: str,
+                       job_id: str,
+                       process_function: Callable,
+                       updater_factory: Callable,
+                       shards: int = 64,
+                       workers: int = 1,
+                       chunk_size: int = 30000,
+                       lease_seconds: int = 3600) -> Any:
+    """
+    Пересчитывает похожие товары по диапазонам uuid в workers процессах с сохранением прогресса.
+
+    Каждый процесс создает свой поисковик и свой пул соединений с бд. Другие запуски с тем же job_id,
+    в том числе на других хостах, подключаются к обработке оставшихся диапазонов.
+
+    :param job_id: ID задания, по нему продолжается прерванный пересчет.
+    :param shards: Кол-во диапазонов uuid, учитывается только при регистрации задания.
+    :param workers: Кол-во процессов, 1 - обработка в текущем процессе.
+    :return: Состояние задания после обработки, см. select_similarity_job.
+    """
+    job = register_similarity_job(config, base_dir, schema, table_name, job_id, shards)
+    print(f'->Задание {job_id}: осталось {job.remaining} из {job.shards} диапазонов <-')
+
+    args = (os.getpid(), config, base_dir, schema, table_name, job_id, process_function, updater_factory, chunk_size,
+            lease_seconds)
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_init_similarity_worker) as executor:
+            for future in [executor.submit(run_similarity_shards, *args) for _ in range(workers)]:
+                future.result()
+    else:
+        run_similarity_shards(*args)
+
+    return select_similarity_job(config, base_dir, schema, table_name, job_id)
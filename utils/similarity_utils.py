@@ -0,0 +1,161 @@
+import re
+from array import array
+from typing import Any
+
+import numpy as np
+import scipy.sparse as sp
+
+from .metrics import metrics
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+class TfidfSimilarityEngine:
+    """
+    Локальный поиск похожих товаров по TF-IDF title + description, альтернатива more_like_this в Elasticsearch.
+
+    Интерфейс поиска совпадает с SimilarProductsESUpdater. Соседи считаются блоками: блок из block_size товаров
+    умножается на candidate_block_size кандидатов за раз, поэтому память на произведение ограничена
+    block_size * candidate_block_size * 4 байт независимо от размера каталога.
+    """
+
+    def __init__(self, block_size: int = 256, candidate_block_size: int = 65536, max_df_ratio: float = 0.5):
+        """
+        :param block_size: Кол-во товаров, для которых соседи ищутся одним умножением.
+        :param candidate_block_size: Кол-во кандидатов в одном умножении.
+        :param max_df_ratio: Термины, встречающиеся в большей доле товаров, не учитываются (как стоп-слова).
+        """
+        self.block_size = block_size
+        self.candidate_block_size = candidate_block_size
+        self.max_df_ratio = max_df_ratio
+
+        self.uuids = []
+        self.row_by_uuid = {}
+        self.matrix = None
+
+        self._vocabulary = {}
+        # Части CSR матрицы частот копятся в плотных буферах и отдаются scipy без копирования
+        self._indptr = array('q', [0])
+        self._indices = array('i')
+        self._counts = array('f')
+
+    def add_documents(self, chunk: Any) -> None:
+        """
+        Добавляет товары в индекс, вызывается по чанкам до build().
+
+        :param chunk: DataFrame или словарь со столбцами uuid, title, description.
+        """
+        vocabulary = self._vocabulary
+        term_ids = array('i')
+        lengths = array('q')
+        for product_uuid, title, description in zip(chunk['uuid'], chunk['title'], chunk['description']):
+            tokens = TOKEN_RE.findall(f'{title or ""} {description or ""}'.lower())
+            term_ids.extend([vocabulary.setdefault(token, len(vocabulary)) for token in tokens])
+            lengths.append(len(tokens))
+
+            self.row_by_uuid[str(product_uuid)] = len(self.uuids)
+            self.uuids.append(str(product_uuid))
+
+        # Пары (товар, термин) чанка считаются одним np.unique, ключи отсортированы по товару и термину
+        terms = max(len(vocabulary), 1)
+        rows = np.repeat(np.arange(len(lengths), dtype=np.int64), np.frombuffer(lengths, dtype=np.int64))
+        keys, counts = np.unique(rows * terms + np.frombuffer(term_ids, dtype=np.int32), return_counts=True)
+        row_terms = np.bincount(keys // terms, minlength=len(lengths))
+
+        self._indices.frombytes((keys % terms).astype(np.int32).tobytes())
+        self._counts.frombytes(counts.astype(np.float32).tobytes())
+        self._indptr.frombytes((self._indptr[-1] + np.cumsum(row_terms, dtype=np.int64)).tobytes())
+
+    def build(self) -> 'TfidfSimilarityEngine':
+        """Строит нормированную TF-IDF матрицу по добавленным товарам."""
+        with metrics.timer('tfidf_build', items=len(self.uuids)):
+            return self._build()
+
+    def _build(self) -> 'TfidfSimilarityEngine':
+        documents = len(self.uuids)
+        counts = sp.csr_matrix(
+            (np.frombuffer(self._counts, dtype=np.float32),
+             np.frombuffer(self._indices, dtype=np.int32),
+             np.frombuffer(self._indptr, dtype=np.int64)),
+            shape=(documents, len(self._vocabulary)),
+            copy=False,
+        )
+        self._indptr, self._indices, self._counts = array('q', [0]), array('i'), array('f')
+
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = np.log((1 + documents) / (1 + document_frequency)).astype(np.float32) + 1
+        idf[document_frequency > max(1, self.max_df_ratio * documents)] = 0
+
+        counts.data = np.log1p(counts.data) * idf[counts.indices]
+        norms = np.sqrt(np.asarray(counts.multiply(counts).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        self.matrix = sp.csr_matrix(sp.diags(1 / norms, dtype=np.float32) @ counts)
+        self.matrix.eliminate_zeros()
+        return self
+
+    def refresh_index(self) -> None:
+        """Совместимость с SimilarProductsESUpdater: индекс в памяти всегда актуален."""
+
+    def delete_documents(self, product_uuids: list) -> None:
+        """Исключает товары из кандидатов в похожие."""
+        rows = [self.row_by_uuid.pop(str(product_uuid)) for product_uuid in product_uuids
+                if str(product_uuid) in self.row_by_uuid]
+        if rows:
+            keep = np.ones(self.matrix.shape[0], dtype=np.float32)
+            keep[rows] = 0
+            self.matrix = sp.csr_matrix(sp.diags(keep) @ self.matrix)
+            self.matrix.eliminate_zeros()
+
+    def _top_similar(self, rows: np.ndarray, size: int) -> list:
+        """Возвращает для каждой строки rows индексы size самых похожих строк матрицы."""
+        queries_t = self.matrix[rows].T.tocsr()
+        best_scores = np.full((len(rows), size), -np.inf, dtype=np.float32)
+        best_rows = np.full((len(rows), size), -1, dtype=np.int64)
+
+        for start in range(0, self.matrix.shape[0], self.candidate_block_size):
+            stop = min(start + self.candidate_block_size, self.matrix.shape[0])
+            scores = (self.matrix[start:stop] @ queries_t).T.toarray()
+
+            # Сам товар и кандидаты без общих терминов не считаются похожими
+            own = (rows >= start) & (rows < stop)
+            scores[np.flatnonzero(own), rows[own] - start] = 0
+            scores[scores <= 0] = -np.inf
+
+            candidate_rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            merged_scores = np.concatenate((best_scores, scores), axis=1)
+            merged_rows = np.concatenate((best_rows, candidate_rows), axis=1)
+            top = np.argpartition(-merged_scores, size - 1, axis=1)[:, :size]
+            best_scores = np.take_along_axis(merged_scores, top, axis=1)
+            best_rows = np.take_along_axis(merged_rows, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind='stable')
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [row[np.isfinite(scores)].tolist() for row, scores in zip(best_rows, best_scores)]
+
+    def find_similar_products(self, product_uuid: str, size: int = 5) -> list:
+        """Находит похожие товары по ID товара."""
+        return self.find_similar_products_batch([product_uuid], size)[str(product_uuid)]
+
+    def find_similar_products_batch(self, product_uuids: list, size: int = 5, batch_size: int = None) -> dict:
+        """
+            Находит похожие товары для списка товаров блочным умножением разреженных матриц.
+
+            :param product_uuids: Список ID товаров.
+            :param size: Кол-во похожих товаров для каждого товара.
+            :param batch_size: Размер блока, по умолчанию block_size.
+            :return: Словарь uuid -> список uuid похожих товаров. Неизвестные товары получают пустой список.
+        """
+        batch_size = batch_size or self.block_size
+        similar = {str(product_uuid): [] for product_uuid in product_uuids}
+        known = [product_uuid for product_uuid in similar if product_uuid in self.row_by_uuid]
+
+        for start in range(0, len(known), batch_size):
+            group = known[start:start + batch_size]
+            rows = np.fromiter((self.row_by_uuid[product_uuid] for product_uuid in group), dtype=np.int64)
+            with metrics.timer('tfidf_topk', items=len(group)):
+                top_similar = self._top_similar(rows, size)
+            for product_uuid, similar_rows in zip(group, top_similar):
+                similar[product_uuid] = [self.uuids[row] for row in similar_rows]
+
+        return similar
@@ -1,15 +1,21 @@
 import configparser
+import hashlib
 import io
+import json
 import locale
 import os
 import textwrap
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass
 
 import pandas as pd
 import sqlalchemy as sa
 from pandas import DataFrame
+from psycopg2.extras import NamedTupleCursor
+from sqlalchemy.dialects.postgresql import psycopg2 as pg_psycopg2
 from pathlib import Path
-from typing import Any, List
+from typing import Any, ClassVar, Iterable, Iterator, List
 
 
 @dataclass
@@ -37,6 +43,17 @@ class SQLProcessor:
 
     inside_logger: object = None
 
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_pre_ping: bool = True
+    pool_recycle: int = 1800
+
+    # Реестр engine на процесс: ключ (pid, url), чтобы дочерние процессы не делили пул родителя
+    _engines: ClassVar[dict] = {}
+    _engines_lock: ClassVar[threading.Lock] = threading.Lock()
+    # Реестры SQL-запросов по директории, общие для всех экземпляров
+    _query_registries: ClassVar[dict] = {}
+
     @staticmethod
     def config(file_dir: str, file_name: str) -> dict:
         """COMMON Метод осуществляет парсинг конфигурационного файла и возвращает словарь
@@ -64,23 +81,53 @@ class SQLProcessor:
             :param str file_path: Путь к файлу
         """
         with io.open(file_path, "rb") as f:
-            data = f.read(5)
+            return SQLProcessor.guess_bytes_encoding(f.read())
+
+    @staticmethod
+    def guess_bytes_encoding(data: bytes) -> str:
+        """ COMMON Метод определяет кодировку прочитанного файла SQL-запроса по BOM и проверке UTF-8
+            :param bytes data: Содержимое файла
+        """
         if data.startswith(b"\xEF\xBB\xBF"):
             return "utf-8-sig"
         elif data.startswith(b"\xFF\xFE") or data.startswith(b"\xFE\xFF"):
             return "utf-16"
         else:
             try:
-                with io.open(file_path, encoding="utf-8"):
-                    return "utf-8"
-            except:
+                data.decode("utf-8")
+                return "utf-8"
+            except UnicodeDecodeError:
                 return locale.getdefaultlocale()[1]
 
+    @staticmethod
+    def read_sql_file(file_path: str) -> str:
+        """ COMMON Метод читает файл SQL-запроса за одно открытие и приводит его к шаблону запроса:
+            убирает общий отступ и заменяет ? на {} для format
+            :param str file_path: Путь к файлу
+        """
+        with io.open(file_path, "rb") as f:
+            data = f.read()
+        return textwrap.dedent(data.decode(SQLProcessor.guess_bytes_encoding(data))).replace('?', '{}')
+
+    @classmethod
+    def query_registry(cls, query_dir: str) -> 'QueryRegistry':
+        """ COMMON Метод возвращает реестр запросов директории, при первом обращении читая все ее SQL-файлы
+            :param str query_dir: Директория с запросами
+        """
+        key = os.path.realpath(query_dir)
+        registry = cls._query_registries.get(key)
+        if registry is None:
+            with cls._engines_lock:
+                registry = cls._query_registries.get(key)
+                if registry is None:
+                    registry = cls._query_registries[key] = QueryRegistry(key)
+        return registry
+
     @staticmethod
     def get_query_from_sql_file(file_name: str, base_dir: str, params_names: object = None,
                                 params_values: object = None, expanding: bool = True,
                                 query_dir: str = 'sql_queries') -> str:
-        """ COMMON Метод возвращает SQL-запрос в строковом виде из SQL-файла
+        """ COMMON Метод возвращает SQL-запрос в строковом виде из SQL-файла, запрос берется из реестра директории
             :param str file_name: Название файла SQL
             :param str base_dir: Путь к базовой директории проекта
             :param object params_names: Параметры табличных имен запроса - строка, словарь или кортеж
@@ -88,31 +135,38 @@ class SQLProcessor:
             :param bool expanding: Параметр expanding для sa.bindparam
             :param str query_dir: Директория с запросами
         """
-        need_path = os.path.join(base_dir, query_dir, file_name)
-        with open(need_path, 'r', encoding=SQLProcessor.guess_encoding(need_path)) as sql_file:
-            lines = sql_file.read()
-            query_string = textwrap.dedent(f"""{lines}""").replace('?', '{}')
-            if params_names:
-                if isinstance(params_names, str):
-                    query_string = query_string.format(params_names)
-                elif isinstance(params_names, dict):
-                    query_string = query_string.format(**params_names)
-                else:
-                    try:
-                        query_string = query_string.format(*params_names)
-                    except Exception as e:
-                        print(e)
-                        raise ValueError('Параметры табличных имен запроса не валидны!')
-
-            if params_values:
-                query_string = sa.text(query_string)
-                names_list = params_values
-                if isinstance(params_values, dict):
-                    names_list = params_values.keys()
-                for key in names_list:
-                    query_string = query_string.bindparams(sa.bindparam(key, expanding=expanding))
-
-            return query_string
+        registry = SQLProcessor.query_registry(os.path.join(base_dir, query_dir))
+        return registry.get(file_name, params_names, params_values, expanding)
+
+    @staticmethod
+    def prepared_value(value: Any) -> Any:
+        """ COMMON Метод приводит значение параметра EXECUTE: списки передаются литералом массива без типа,
+            чтобы PostgreSQL привел его к типу параметра prepared statement
+            :param Any value: значение параметра
+        """
+        if isinstance(value, (list, tuple)):
+            return '{' + ','.join(SQLProcessor.copy_array_element(item) for item in value) + '}'
+        return value
+
+    @staticmethod
+    def execute_prepared(connection: sa.engine.Connection, prepared: 'PreparedQuery', params: dict = None) -> Any:
+        """ COMMON Метод выполняет запрос серверным prepared statement: PREPARE выполняется один раз на соединение
+            psycopg2, дальше только EXECUTE, и PostgreSQL не разбирает и не планирует запрос заново.
+            Prepared statement не откатывается вместе с транзакцией и живет до закрытия соединения пулом.
+            :param sa.engine.Connection connection: объект соединения
+            :param PreparedQuery prepared: запрос из QueryRegistry.prepared
+            :param dict params: параметры запроса
+            :return: курсор psycopg2 с результатом, строки - namedtuple
+        """
+        dbapi_connection = connection.connection
+        prepared_names = dbapi_connection.info.setdefault('prepared_statements', set())
+        cursor = dbapi_connection.cursor(cursor_factory=NamedTupleCursor)
+        if prepared.name not in prepared_names:
+            cursor.execute(prepared.prepare_sql)
+            prepared_names.add(prepared.name)
+        cursor.execute(prepared.execute_sql,
+                       [SQLProcessor.prepared_value(params[name]) for name in prepared.param_names])
+        return cursor
 
     def sql_query(self, sql_query: str, connection: object, params: dict = None) -> object:
         """ COMMON Метод выполняет SQL запрос
@@ -177,10 +231,57 @@ class SQLProcessor:
         self.settings_connection = self.settings_engine.connect()
         return self.settings_connection
 
+    def get_engine(self, url: str, **kwargs) -> sa.engine.Engine:
+        """ COMMON Метод возвращает engine из реестра процесса, создавая его при первом обращении к url
+            :param str url: url соединения
+            :param kwargs: параметры sa.create_engine, перекрывают настройки пула экземпляра
+        """
+        key = (os.getpid(), url)
+        engine = self._engines.get(key)
+        if engine is None:
+            with self._engines_lock:
+                engine = self._engines.get(key)
+                if engine is None:
+                    engine_kwargs = {
+                        'pool_size': self.pool_size,
+                        'max_overflow': self.max_overflow,
+                        'pool_pre_ping': self.pool_pre_ping,
+                        'pool_recycle': self.pool_recycle,
+                    }
+                    engine_kwargs.update(kwargs)
+                    engine = sa.create_engine(url, **engine_kwargs)
+                    self._engines[key] = engine
+        return engine
+
+    @classmethod
+    def dispose_engines(cls) -> None:
+        """ COMMON Метод закрывает пулы всех engine текущего процесса и очищает реестр"""
+        with cls._engines_lock:
+            for (pid, _), engine in cls._engines.items():
+                if pid == os.getpid():
+                    engine.dispose()
+            cls._engines.clear()
+
+    @contextmanager
+    def connect(self, url: str, **kwargs) -> Iterator[sa.engine.Connection]:
+        """ COMMON Контекстный менеджер соединения из пула engine
+            :param str url: url соединения
+        """
+        with self.get_engine(url, **kwargs).connect() as connection:
+            yield connection
+
+    @contextmanager
+    def begin(self, url: str, **kwargs) -> Iterator[sa.engine.Connection]:
+        """ COMMON Контекстный менеджер соединения с транзакцией: commit при успехе, rollback при ошибке
+            :param str url: url соединения
+        """
+        with self.get_engine(url, **kwargs).begin() as connection:
+            yield connection
+
     # EXTRACT LOGIC
     def create_extract_engine(self, **kwargs) -> object:
         """EXTRACT Метод создает engine для соединения с БД"""
-        self.extract_settings_engine = sa.create_engine(self.extract_settings_url, **kwargs)
+        self.extract_settings_engine = self.get_engine(self.extract_settings_url, **kwargs)
         return self.extract_settings_engine
 
     def extract_settings_connect(self) -> object:
@@ -201,10 +302,38 @@ class SQLProcessor:
             current_connection = connection
         return pd.read_sql(sql_query, current_connection, params=params, chunksize=chunksize, parse_dates=parse_dates)
 
+    def stream_data_sql(self, sql_query: Any, params: dict = None, connection: object = None, chunksize: Any = 30000,
+                        as_frame: bool = False) -> Iterator:
+        """ EXTRACT Метод читает результат SQL-запроса серверным курсором пачками по chunksize строк,
+            в памяти клиента одновременно находится только одна пачка
+            :param sql_query: строка запроса SQL или sa.text
+            :param dict params: параметры запроса
+            :param object connection: объект соединения
+            :param chunksize: размер пакета, int или AdaptiveBatchSizer - размер читается перед каждым пакетом
+            :param bool as_frame: отдавать пачки DataFrame вместо словаря столбец -> список значений
+        """
+        current_connection = self.extract_settings_connection
+        if connection:
+            current_connection = connection
+        if isinstance(sql_query, str):
+            sql_query = sa.text(sql_query)
+
+        result = current_connection.execute(sql_query, params or {},
+                                            execution_options={'stream_results': True, 'yield_per': int(chunksize)})
+        columns = list(result.keys())
+        try:
+            for rows in iter(lambda: result.fetchmany(int(chunksize)), []):
+                if as_frame:
+                    yield pd.DataFrame.from_records(rows, columns=columns)
+                else:
+                    yield {column: list(values) for column, values in zip(columns, zip(*rows))}
+        finally:
+            result.close()
+
 
     def create_load_engine(self, **kwargs) -> object:
         """LOAD Метод создает engine для соединения с БД"""
-        self.load_settings_engine = sa.create_engine(self.load_settings_url, **kwargs)
+        self.load_settings_engine = self.get_engine(self.load_settings_url, **kwargs)
         return self.load_settings_engine
 
     def load_settings_connect(self) -> object:
@@ -226,3 +355,181 @@ class SQLProcessor:
         if not connection:
             connection = self.load_settings_connection
         return dataframe.to_sql(table, connection, if_exists=if_exists, index=index, **kwargs)
+
+    @staticmethod
+    def copy_array_element(value: Any) -> str:
+        """ LOAD Метод приводит элемент массива к литералу массива PostgreSQL
+            :param Any value: элемент массива
+        """
+        if value is None:
+            return 'NULL'
+        return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    @staticmethod
+    def copy_csv_value(value: Any) -> str:
+        """ LOAD Метод приводит значение к полю CSV для COPY: None и NaN - NULL, списки - массивы, словари - json
+            :param Any value: значение
+        """
+        if value is None or (isinstance(value, float) and value != value):
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, (int, float)):
+            return str(value)
+        if isinstance(value, (list, tuple)):
+            value = '{' + ','.join(SQLProcessor.copy_array_element(item) for item in value) + '}'
+        elif isinstance(value, dict):
+            value = json.dumps(value)
+        return '"' + str(value).replace('"', '""') + '"'
+
+    def copy_rows_sql(self, rows: Iterable[tuple], columns: List[str], table: str, schema: str = None,
+                      connection: sa.engine.Connection = None) -> int:
+        """ LOAD Метод загружает строки в таблицу через COPY FROM STDIN в формате CSV
+            :param Iterable[tuple] rows: строки в порядке columns
+            :param List[str] columns: названия столбцов
+            :param str table: название таблицы
+            :param str schema: название схемы
+            :param sa.engine.Connection connection: соединение psycopg2, транзакцией управляет вызывающий код
+        """
+        if not connection:
+            connection = self.load_settings_connection
+
+        buffer = io.StringIO()
+        row_count = 0
+        for row in rows:
+            buffer.write(','.join(map(self.copy_csv_value, row)))
+            buffer.write('\n')
+            row_count += 1
+        buffer.seek(0)
+
+        table_name = f'"{schema}"."{table}"' if schema else f'"{table}"'
+        column_names = ', '.join(f'"{column}"' for column in columns)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(f'COPY {table_name} ({column_names}) FROM STDIN WITH (FORMAT csv)', buffer)
+        return row_count
+
+    def load_data_copy(self, dataframe: DataFrame, table: str, schema: str = None,
+                       connection: sa.engine.Connection = None) -> int:
+        """ LOAD Метод осуществляет загрузку записей, хранящихся в DataFrame, в БД через COPY FROM STDIN
+            :param DataFrame dataframe: датафрейм
+            :param str table: название таблицы
+            :param str schema: название схемы
+            :param sa.engine.Connection connection: соединение psycopg2, транзакцией управляет вызывающий код
+        """
+        return self.copy_rows_sql(dataframe.itertuples(index=False, name=None), list(dataframe.columns),
+                                  table, schema=schema, connection=connection)
+
+
+@dataclass(frozen=True)
+class PreparedQuery:
+    """Запрос для серверного PREPARE: имя statement, текст с параметрами $n и имена параметров по порядку"""
+
+    name: str
+    statement: str
+    param_names: tuple
+
+    @property
+    def prepare_sql(self) -> str:
+        return f'PREPARE {self.name} AS {self.statement}'
+
+    @property
+    def execute_sql(self) -> str:
+        if not self.param_names:
+            return f'EXECUTE {self.name}'
+        return f'EXECUTE {self.name} ({", ".join(["%s"] * len(self.param_names))})'
+
+
+class QueryRegistry:
+    """Реестр SQL-запросов директории: все SQL-файлы читаются один раз при создании,
+        собранные запросы кэшируются по (файл, параметры табличных имен, имена параметров значений, expanding)
+    """
+
+    # Диалект для компиляции :name в $n серверного PREPARE
+    prepare_dialect = pg_psycopg2.dialect(paramstyle='numeric_dollar')
+
+    def __init__(self, query_dir: str):
+        """
+            :param str query_dir: Директория с запросами
+        """
+        self.query_dir = query_dir
+        self._templates = {}
+        self._queries = {}
+        self._prepared = {}
+        self.load()
+
+    def load(self) -> None:
+        """Читает все SQL-файлы директории и сбрасывает собранные запросы"""
+        templates = {}
+        for file_name in sorted(os.listdir(self.query_dir)):
+            if file_name.endswith('.sql'):
+                templates[file_name] = SQLProcessor.read_sql_file(os.path.join(self.query_dir, file_name))
+        self._templates = templates
+        self._queries = {}
+        self._prepared = {}
+
+    def template(self, file_name: str) -> str:
+        """Возвращает шаблон запроса файла, файл не из директории на момент загрузки читается при обращении"""
+        template = self._templates.get(file_name)
+        if template is None:
+            template = self._templates[file_name] = SQLProcessor.read_sql_file(
+                os.path.join(self.query_dir, file_name))
+        return template
+
+    @staticmethod
+    def _names_key(params_names: object) -> object:
+        if isinstance(params_names, dict):
+            return tuple(sorted(params_names.items()))
+        if isinstance(params_names, (list, tuple)):
+            return tuple(params_names)
+        return params_names
+
+    def format(self, file_name: str, params_names: object = None) -> str:
+        """ Подставляет табличные имена в шаблон запроса
+            :param str file_name: Название файла SQL
+            :param object params_names: Параметры табличных имен запроса - строка, словарь или кортеж
+        """
+        query_string = self.template(file_name)
+        if params_names:
+            if isinstance(params_names, str):
+                query_string = query_string.format(params_names)
+            elif isinstance(params_names, dict):
+                query_string = query_string.format(**params_names)
+            else:
+                try:
+                    query_string = query_string.format(*params_names)
+                except Exception as e:
+                    print(e)
+                    raise ValueError('Параметры табличных имен запроса не валидны!')
+        return query_string
+
+    def get(self, file_name: str, params_names: object = None, params_values: object = None,
+            expanding: bool = True) -> Any:
+        """ Возвращает запрос: строку или sa.text с bindparams по именам params_values
+            :param str file_name: Название файла SQL
+            :param object params_names: Параметры табличных имен запроса - строка, словарь или кортеж
+            :param object params_values: Параметры значений запроса - список, кортеж или словарь
+            :param bool expanding: Параметр expanding для sa.bindparam
+        """
+        values_names = tuple(params_values) if params_values else None
+        key = (file_name, self._names_key(params_names), values_names, expanding)
+        query = self._queries.get(key)
+        if query is None:
+            query = self.format(file_name, params_names)
+            if values_names:
+                query = sa.text(query).bindparams(*(sa.bindparam(name, expanding=expanding) for name in values_names))
+            self._queries[key] = query
+        return query
+
+    def prepared(self, file_name: str, params_names: object = None) -> PreparedQuery:
+        """ Возвращает запрос для серверного PREPARE, имя statement - хэш текста запроса
+            :param str file_name: Название файла SQL
+            :param object params_names: Параметры табличных имен запроса - строка, словарь или кортеж
+        """
+        key = (file_name, self._names_key(params_names))
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            compiled = sa.text(self.format(file_name, params_names)).compile(dialect=self.prepare_dialect)
+            statement = str(compiled).strip().rstrip(';')
+            name = 'sql_' + hashlib.sha1(statement.encode()).hexdigest()[:16]
+            prepared = self._prepared[key] = PreparedQuery(name, statement, tuple(compiled.positiontup or ()))
+        return prepared
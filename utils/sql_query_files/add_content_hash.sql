@@ -0,0 +1,9 @@
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1
+                   FROM information_schema.columns
+                   WHERE table_schema = '{schema}' AND table_name = '{table}' AND column_name = 'content_hash') THEN
+        ALTER TABLE {schema}.{table} ADD COLUMN content_hash text;
+    END IF;
+END
+$$;
\ No newline at end of file
@@ -0,0 +1,12 @@
+UPDATE {schema}.sku_similarity_progress
+SET claimed_by = :worker,
+    claimed_at = clock_timestamp()
+WHERE (job_id, shard_no) = (SELECT job_id, shard_no
+                            FROM {schema}.sku_similarity_progress
+                            WHERE job_id = :job_id
+                              AND done_at IS NULL
+                              AND (claimed_at IS NULL
+                                OR claimed_at < clock_timestamp() - make_interval(secs => :lease_seconds))
+                            ORDER BY shard_no
+                            LIMIT 1 FOR UPDATE SKIP LOCKED)
+RETURNING shard_no, lower_uuid, upper_uuid;
\ No newline at end of file
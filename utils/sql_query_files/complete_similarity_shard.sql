@@ -0,0 +1,7 @@
+UPDATE {schema}.sku_similarity_progress
+SET done_at = clock_timestamp()
+WHERE job_id = :job_id
+  AND shard_no = :shard_no
+  AND claimed_by = :worker
+  AND done_at IS NULL
+RETURNING shard_no;
\ No newline at end of file
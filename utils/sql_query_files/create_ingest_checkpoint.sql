@@ -0,0 +1,10 @@
+CREATE TABLE IF NOT EXISTS {schema}.sku_ingest_checkpoint
+(
+    feed_id      text PRIMARY KEY,
+    feed_path    text      NOT NULL,
+    feed_size    bigint    NOT NULL,
+    feed_mtime   timestamp NOT NULL,
+    offers_done  bigint    NOT NULL DEFAULT 0,
+    completed_at timestamp,
+    updated_at   timestamp NOT NULL DEFAULT clock_timestamp()
+);
\ No newline at end of file
@@ -0,0 +1,12 @@
+CREATE TABLE IF NOT EXISTS {schema}.sku_similarity_progress
+(
+    job_id     text      NOT NULL,
+    shard_no   integer   NOT NULL,
+    lower_uuid uuid      NOT NULL,
+    upper_uuid uuid,
+    created_at timestamp NOT NULL DEFAULT clock_timestamp(),
+    claimed_by text,
+    claimed_at timestamp,
+    done_at    timestamp,
+    PRIMARY KEY (job_id, shard_no)
+);
\ No newline at end of file
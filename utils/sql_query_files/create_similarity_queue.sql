@@ -0,0 +1,62 @@
+CREATE TABLE IF NOT EXISTS {schema}.sku_similarity_queue
+(
+    uuid        uuid PRIMARY KEY,
+    change_type text      NOT NULL,
+    changed_at  timestamp NOT NULL DEFAULT clock_timestamp()
+);
+
+ALTER TABLE {schema}.sku_similarity_queue ADD COLUMN IF NOT EXISTS processing_id text;
+
+CREATE OR REPLACE FUNCTION {schema}.sku_similarity_enqueue() RETURNS trigger AS
+$fn$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO {schema}.sku_similarity_queue (uuid, change_type)
+        SELECT uuid, 'inserted' FROM new_rows WHERE uuid IS NOT NULL
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO {schema}.sku_similarity_queue (uuid, change_type)
+        SELECT new_rows.uuid, 'changed'
+        FROM new_rows
+        JOIN old_rows ON old_rows.uuid = new_rows.uuid
+        WHERE old_rows.title IS DISTINCT FROM new_rows.title
+           OR old_rows.description IS DISTINCT FROM new_rows.description
+           OR old_rows.category_id IS DISTINCT FROM new_rows.category_id
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    ELSE
+        INSERT INTO {schema}.sku_similarity_queue (uuid, change_type)
+        SELECT uuid, 'deleted' FROM old_rows WHERE uuid IS NOT NULL
+        ON CONFLICT (uuid) DO UPDATE SET change_type = EXCLUDED.change_type, changed_at = EXCLUDED.changed_at,
+            processing_id = NULL;
+    END IF;
+    RETURN NULL;
+END
+$fn$ LANGUAGE plpgsql;
+
+DO
+$$
+BEGIN
+    IF to_regclass('{schema}.sku_similar_sku_index') IS NULL THEN
+        CREATE INDEX sku_similar_sku_index ON {schema}.{table} USING gin (similar_sku);
+    END IF;
+
+    IF NOT EXISTS (SELECT 1
+                   FROM pg_trigger
+                   WHERE tgrelid = '{schema}.{table}'::regclass AND tgname = 'sku_similarity_enqueue_insert') THEN
+        CREATE TRIGGER sku_similarity_enqueue_insert
+            AFTER INSERT ON {schema}.{table}
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {schema}.sku_similarity_enqueue();
+        CREATE TRIGGER sku_similarity_enqueue_update
+            AFTER UPDATE ON {schema}.{table}
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {schema}.sku_similarity_enqueue();
+        CREATE TRIGGER sku_similarity_enqueue_delete
+            AFTER DELETE ON {schema}.{table}
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION {schema}.sku_similarity_enqueue();
+    END IF;
+END
+$$;
\ No newline at end of file
@@ -0,0 +1 @@
+CREATE TEMP TABLE sku_delta (LIKE {schema}.{table} INCLUDING DEFAULTS) ON COMMIT DROP;
\ No newline at end of file
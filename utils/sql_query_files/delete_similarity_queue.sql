@@ -0,0 +1,3 @@
+DELETE
+FROM {schema}.sku_similarity_queue
+WHERE processing_id = :processing_id;
\ No newline at end of file
@@ -0,0 +1,6 @@
+INSERT INTO {schema}.sku_similarity_progress (job_id, shard_no, lower_uuid, upper_uuid)
+SELECT :job_id, shard.shard_no, shard.lower_uuid, shard.upper_uuid
+FROM unnest(CAST(:shard_nos AS integer[]), CAST(:lower_uuids AS uuid[]), CAST(:upper_uuids AS uuid[]))
+    AS shard (shard_no, lower_uuid, upper_uuid)
+WHERE NOT EXISTS (SELECT 1 FROM {schema}.sku_similarity_progress WHERE job_id = :job_id)
+ON CONFLICT (job_id, shard_no) DO NOTHING;
\ No newline at end of file
@@ -0,0 +1,2 @@
+UPDATE {schema}.sku_similarity_queue
+SET processing_id = :processing_id;
\ No newline at end of file
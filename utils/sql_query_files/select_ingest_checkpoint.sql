@@ -0,0 +1,3 @@
+SELECT offers_done, completed_at
+FROM {schema}.sku_ingest_checkpoint
+WHERE feed_id = :feed_id;
\ No newline at end of file
@@ -0,0 +1,5 @@
+SELECT count(*)                                AS shards,
+       count(*) FILTER (WHERE done_at IS NULL) AS remaining,
+       min(created_at)                         AS created_at
+FROM {schema}.sku_similarity_progress
+WHERE job_id = :job_id;
\ No newline at end of file
@@ -0,0 +1,3 @@
+SELECT uuid, change_type
+FROM {schema}.sku_similarity_queue
+WHERE processing_id = :processing_id;
\ No newline at end of file
@@ -0,0 +1,4 @@
+SELECT sku.marketplace_id, sku.product_id, sku.uuid, sku.content_hash
+FROM ?.? AS sku
+JOIN unnest(CAST(:marketplace_ids AS integer[]), CAST(:product_ids AS bigint[])) AS feed (marketplace_id, product_id)
+    ON sku.marketplace_id = feed.marketplace_id AND sku.product_id = feed.product_id;
\ No newline at end of file
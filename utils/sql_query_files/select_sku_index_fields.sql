@@ -0,0 +1,3 @@
+SELECT CAST(uuid AS text) AS uuid, title, description, brand, price_after_discounts, category_id,
+       category_lvl_1, category_lvl_2, category_lvl_3
+FROM {schema}.{table};
\ No newline at end of file
@@ -0,0 +1,3 @@
+SELECT uuid
+FROM {schema}.{table}
+WHERE similar_sku && CAST(:uuids AS uuid[]);
\ No newline at end of file
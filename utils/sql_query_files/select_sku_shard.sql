@@ -0,0 +1,5 @@
+SELECT uuid
+FROM {schema}.{table}
+WHERE uuid >= CAST(:lower_uuid AS uuid)
+  AND (CAST(:upper_uuid AS uuid) IS NULL OR uuid < CAST(:upper_uuid AS uuid))
+ORDER BY uuid;
\ No newline at end of file
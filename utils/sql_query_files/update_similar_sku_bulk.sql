@@ -0,0 +1,4 @@
+UPDATE ?.? AS sku
+SET similar_sku = CAST(data.similar_sku AS uuid[])
+FROM unnest(CAST(:uuids AS uuid[]), CAST(:similar_skus AS text[])) AS data (uuid, similar_sku)
+WHERE sku.uuid = data.uuid;
\ No newline at end of file
@@ -0,0 +1,8 @@
+INSERT INTO {schema}.sku_ingest_checkpoint (feed_id, feed_path, feed_size, feed_mtime, offers_done, completed_at)
+VALUES (:feed_id, :feed_path, :feed_size, to_timestamp(:feed_mtime), :offers_done,
+        CASE WHEN :completed THEN clock_timestamp() END)
+ON CONFLICT (feed_id) DO UPDATE SET feed_path    = EXCLUDED.feed_path,
+                                    feed_mtime   = EXCLUDED.feed_mtime,
+                                    offers_done  = EXCLUDED.offers_done,
+                                    completed_at = EXCLUDED.completed_at,
+                                    updated_at   = clock_timestamp();
\ No newline at end of file
@@ -0,0 +1,6 @@
+INSERT INTO {schema}.{table} AS sku ({columns})
+SELECT {columns}
+FROM sku_delta
+ON CONFLICT (marketplace_id, product_id) DO UPDATE
+SET {update_columns}, updated_at = now()
+WHERE sku.content_hash IS DISTINCT FROM EXCLUDED.content_hash;
\ No newline at end of file